@@ -84,7 +84,10 @@ create_es() {
 create_search_suggest_archive() {
     # Build suggest lambda
     cd search_lambda/suggest
-    zip -FSr9 bin/search-suggest.zip * -x "bin/*" -x "test/*" -x "README.md" -x "event_suggest.json"
+    zip -FSr9 bin/search-suggest.zip * -x "bin/*" -x "test/*" -x "README.md" -x "event_suggest.json" -x "server.py"
+    # Bundle requests with the lambda, botocore no longer vendors it
+    python3.7 -m pip install -r requirements/requirements.in -t bin/package
+    (cd bin/package && zip -r9 ../search-suggest.zip . -x "*.dist-info/*" -x "bin/*")
 
     # Create suggest lambda in localstack
     awslocal lambda create-function --function-name search_suggest --zip-file fileb://bin/search-suggest.zip --handler search_suggest.lambda_handler --runtime python3.7 --role basic_lambda_role --region ${REGION}
@@ -160,6 +163,15 @@ create_api_gateway_suggest_config() {
     --passthrough-behavior WHEN_NO_MATCH \
     --endpoint-url=http://localhost:4567)
 
+    # Create POST method on resource for batched suggest queries, sent to the same lambda function
+    RESOURCE_BATCH_METHOD=$(awslocal apigateway put-method --rest-api-id $1 --resource-id ${RESOURCE_ID} --http-method POST --authorization-type NONE --region ${REGION} | jq -r '.httpMethod')
+    API_GATEWAY_BATCH=$(awslocal apigateway put-integration --rest-api-id $1 --resource-id ${RESOURCE_ID} \
+    --region ${REGION} \
+    --http-method POST --type AWS_PROXY --integration-http-method POST \
+    --uri arn:aws:apigateway:${REGION}:lambda:path/functions/arn:aws:lambda:${REGION}:000000000000:function:search_suggest \
+    --passthrough-behavior WHEN_NO_MATCH \
+    --endpoint-url=http://localhost:4567)
+
     # Set response of api to JSON
     API_RESPONSE_STATUS=$(awslocal apigateway put-method-response --rest-api-id $1 \
     --region ${REGION} \
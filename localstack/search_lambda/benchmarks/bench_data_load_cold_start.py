@@ -0,0 +1,68 @@
+"""
+Cold start benchmark for the data load lambda.
+
+Every iteration starts a fresh interpreter, imports data_load and invokes lambda_handler twice,
+once cold and once warm, against the local S3 and Elasticsearch stub. Run it from the
+localstack directory:
+
+    python -m search_lambda.benchmarks.bench_data_load_cold_start --iterations 20
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from os import path
+
+from search_lambda.benchmarks.stub_server import StubServer
+
+BUCKET_NAME = 'localstack-search'
+FILE_KEY = 'workspaces-10000-10002.txt'
+ROOT_DIR = path.abspath(path.join(path.dirname(__file__), '..', '..'))
+WORKSPACES_FILE = path.join(ROOT_DIR, 'es', FILE_KEY)
+
+CHILD_CODE = '''
+import json, time
+started = time.perf_counter()
+from search_lambda.data_load import data_load
+imported = time.perf_counter()
+event = {"Records": [{"s3": {"bucket": {"name": "%s"}, "object": {"key": "%s"}}}]}
+data_load.lambda_handler(event, None)
+cold = time.perf_counter()
+data_load.lambda_handler(event, None)
+warm = time.perf_counter()
+print(json.dumps({"import_ms": (imported - started) * 1000, "cold_invoke_ms": (cold - imported) * 1000,
+                  "warm_invoke_ms": (warm - cold) * 1000}))
+''' % (BUCKET_NAME, FILE_KEY)
+
+
+def run(iterations):
+    stub = StubServer().start()
+    try:
+        with open(WORKSPACES_FILE, 'rb') as workspaces_file:
+            stub.put_object(BUCKET_NAME, FILE_KEY, workspaces_file.read())
+        env = dict(os.environ, ES_HOST='127.0.0.1', ES_PORT=str(stub.port), S3_ENDPOINT_URL=stub.url,
+                   AWS_ACCESS_KEY_ID='test', AWS_SECRET_ACCESS_KEY='test', AWS_DEFAULT_REGION='ap-southeast-2')
+        samples = []
+        for _ in range(iterations):
+            output = subprocess.check_output([sys.executable, '-c', CHILD_CODE], cwd=ROOT_DIR, env=env,
+                                             stderr=subprocess.DEVNULL)
+            samples.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+        es_requests = [request for request in stub.requests if not request[1].startswith('/' + BUCKET_NAME)]
+    finally:
+        stub.stop()
+
+    report = {'iterations': iterations,
+              'es_requests_per_container': len(es_requests) / float(iterations)}
+    for metric in ('import_ms', 'cold_invoke_ms', 'warm_invoke_ms'):
+        values = [sample[metric] for sample in samples]
+        report[metric] = {'median': statistics.median(values), 'min': min(values), 'max': max(values)}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps(run(args.iterations), indent=2))
@@ -0,0 +1,206 @@
+"""
+End to end benchmark of the suggest and data load lambdas against the local S3 and Elasticsearch stub.
+
+The suggest suite invokes search_suggest.lambda_handler with a mix of prefixes, numbers and land
+identifiers and reports p50/p95/p99 latency plus the time spent in each stage. The data load suite
+invokes data_load.lambda_handler on a file from generate_workspaces in the stub S3 and reports docs/sec and peak
+RSS. Every suite runs in its own interpreter, so module level settings and peak RSS are its own.
+Run it from the localstack directory:
+
+    python -m search_lambda.benchmarks.bench_end_to_end --output bench.json
+    python -m search_lambda.benchmarks.bench_end_to_end --output new.json --compare bench.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from os import path
+from unittest import mock
+
+from search_lambda.benchmarks.generate_workspaces import iter_bulk_lines, iter_workspaces
+from search_lambda.benchmarks.stub_server import StubServer
+
+BUCKET_NAME = 'localstack-search'
+FILE_KEY = 'bench-workspaces.ndjson'
+ROOT_DIR = path.abspath(path.join(path.dirname(__file__), '..', '..'))
+SUITES = ('suggest', 'data_load')
+
+# Typed prefixes, workspace numbers, land identifiers and mixed inputs, as sent by the suggest box.
+SUGGEST_QUERIES = ['col', 'coll', 'colli', 'collins', 'mel', 'melb', 'melbourne', 'bou', 'bourke st',
+                   'dav', 'davina', 'davina jay', 'big bank', 'nation', '190', '19001', '190010001',
+                   '190010002', '11111/111', '11111/', '12/5', '123 coll', 'vic 3000', 'in-mort']
+
+# Three workspaces matched on their number, address and parties, like the indexed sample documents.
+SEARCH_RESPONSE = {'took': 3, 'timed_out': False, 'hits': {'total': 3, 'hits': [
+    {'sort': [1.0, 10000 + n, 1000000 + n],
+     'highlight': {'workspace.number.ngram': ['<em>19001000{}</em>'.format(n)]},
+     'inner_hits': {
+         'propertys': {'hits': {'total': 1, 'hits': [{'highlight': {
+             'propertys.address.ngram': ['<em>12{} Collins St</em> Melbourne VIC 3000'.format(n)],
+             'propertys.landIdentifier.ngram': ['<em>11111/111</em>']}}]}},
+         'parties': {'hits': {'total': 2, 'hits': [
+             {'highlight': {'parties.name.ngram': ['<em>Davina</em> Jay']}},
+             {'highlight': {'parties.titlePartyFullName.ngram': ['<em>Big Bank</em> Australia']}}]}}}}
+    for n in range(3)]}}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    return {'p50': percentile(values, 0.5), 'p95': percentile(values, 0.95), 'p99': percentile(values, 0.99),
+            'mean': sum(values) / len(values), 'count': len(values)}
+
+
+class StageTimer(object):
+    """
+    Wraps module functions so every call adds its duration to the stage it belongs to.
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.samples.setdefault(stage, []).append((time.perf_counter() - started) * 1000)
+        return timed
+
+
+def run_suggest(iterations):
+    # The stub port is only known here, so search_suggest is imported once ES_HOST is set.
+    from search_lambda.suggest import search_suggest
+
+    timer = StageTimer()
+    patches = [
+        mock.patch.object(search_suggest, 'get_event_data',
+                          timer.wrap('validate', search_suggest.get_event_data)),
+        mock.patch.object(search_suggest, 'build_suggest_search_query',
+                          timer.wrap('build', search_suggest.build_suggest_search_query)),
+        mock.patch.object(search_suggest, 'serialize_query', timer.wrap('serialize', search_suggest.serialize_query)),
+        mock.patch.object(search_suggest.SESSION, 'get', timer.wrap('elasticsearch', search_suggest.SESSION.get)),
+        mock.patch.object(search_suggest, 'shape_results', timer.wrap('shape', search_suggest.shape_results))
+    ]
+    events = [{'queryStringParameters': {'q': q, 'workGroups': '1086,724', 'subscriberId': '4281'}}
+              for q in SUGGEST_QUERIES]
+    for event in events:
+        # Warm up the connection pool and the lazily built parts.
+        search_suggest.lambda_handler(event, None)
+
+    latencies = []
+    for patch in patches:
+        patch.start()
+    try:
+        for event in itertools.islice(itertools.cycle(events), iterations):
+            started = time.perf_counter()
+            response = search_suggest.lambda_handler(event, None)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response['statusCode'] != 200:
+                raise RuntimeError('Suggest failed for {}: {}'.format(event, response))
+    finally:
+        for patch in patches:
+            patch.stop()
+    return {'latency_ms': summarize(latencies),
+            'stage_ms': {stage: summarize(samples) for stage, samples in timer.samples.items()},
+            'queries': len(SUGGEST_QUERIES), 'iterations': iterations}
+
+
+def run_data_load(docs):
+    from search_lambda.data_load import data_load
+
+    event = {'Records': [{'s3': {'bucket': {'name': BUCKET_NAME}, 'object': {'key': FILE_KEY}}}]}
+    # The first call creates the clients and bootstraps the index, it is not part of the throughput.
+    data_load.get_es_client()
+    started = time.perf_counter()
+    result = data_load.lambda_handler(event, None)['results'][FILE_KEY]
+    elapsed = time.perf_counter() - started
+    if 'error' in result:
+        raise RuntimeError('Data load failed: {}'.format(result))
+    return {'docs': docs, 'indexed': result['indexed'], 'batches': result['batches'], 'seconds': elapsed,
+            'docs_per_sec': result['indexed'] / elapsed,
+            # ru_maxrss is reported in kilobytes on Linux.
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+
+def run_suite(suite, args):
+    # The stub runs in this process, so the peak RSS of the suite process is the lambda's own.
+    stub = StubServer()
+    stub.search_response = SEARCH_RESPONSE
+    if suite == 'data_load':
+        stub.put_object(BUCKET_NAME, FILE_KEY, b''.join(iter_bulk_lines(iter_workspaces(args.docs))))
+    stub.start()
+    env = dict(os.environ, ES_SCHEME='http://', S3_ENDPOINT_URL=stub.url, AWS_ACCESS_KEY_ID='test',
+               AWS_SECRET_ACCESS_KEY='test', AWS_DEFAULT_REGION='ap-southeast-2', SUGGEST_SINGLE_FLIGHT='False')
+    if suite == 'suggest':
+        env['ES_HOST'] = '127.0.0.1:{}'.format(stub.port)
+        if not args.cache:
+            env['SUGGEST_CACHE_SIZE'] = '0'
+    else:
+        env.update(ES_HOST='127.0.0.1', ES_PORT=str(stub.port))
+    try:
+        command = [sys.executable, '-m', 'search_lambda.benchmarks.bench_end_to_end', '--child', suite,
+                   '--iterations', str(args.iterations), '--docs', str(args.docs)]
+        output = subprocess.check_output(command, cwd=ROOT_DIR, env=env)
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        stub.stop()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    # Ratios of this run over the baseline, below 1 is faster for latencies and slower for throughput.
+    ratios = {}
+    for suite in SUITES:
+        new, old = report['suites'].get(suite), baseline.get('suites', {}).get(suite)
+        if not new or not old:
+            continue
+        if suite == 'suggest':
+            ratios[suite] = {name: new['latency_ms'][name] / old['latency_ms'][name] for name in ('p50', 'p95', 'p99')}
+        else:
+            ratios[suite] = {name: new[name] / old[name] for name in ('docs_per_sec', 'peak_rss_mb')}
+    return ratios
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', choices=SUITES + ('all',), default='all')
+    parser.add_argument('--iterations', type=int, default=2000, help='suggest invocations')
+    parser.add_argument('--docs', type=int, default=20000, help='documents loaded by the data load suite')
+    parser.add_argument('--cache', action='store_true', help='keep the suggest result cache on')
+    parser.add_argument('--output', help='file the JSON report is written to')
+    parser.add_argument('--compare', help='JSON report of an earlier run to compare against')
+    parser.add_argument('--child', choices=SUITES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_suggest(args.iterations) if args.child == 'suggest' else run_data_load(args.docs)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    report = {'revision': git_revision(), 'python': platform.python_version(), 'created': time.time(),
+              'settings': {'iterations': args.iterations, 'docs': args.docs, 'cache': args.cache},
+              'suites': {suite: run_suite(suite, args) for suite in (SUITES if args.suite == 'all' else [args.suite])}}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            report['compared_to'] = {'file': args.compare, 'ratios': compare(report, json.load(baseline_file))}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    print(json.dumps(report, indent=2))
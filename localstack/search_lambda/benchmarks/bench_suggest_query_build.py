@@ -0,0 +1,67 @@
+"""
+Micro-benchmark of the per request suggest query build and serialization.
+
+Times build_suggest_search_query plus serializing the query the way search() sends it. With
+--baseline-ref the search_suggest.py of that git revision is loaded next to the current one,
+so both are timed in the same run. Run it from the localstack directory:
+
+    python -m search_lambda.benchmarks.bench_suggest_query_build --baseline-ref HEAD~1
+"""
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import tempfile
+import timeit
+from os import path
+
+from search_lambda.suggest import search_suggest
+
+ROOT_DIR = path.abspath(path.join(path.dirname(__file__), '..', '..'))
+SEARCH_SUGGEST_PATH = 'localstack/search_lambda/suggest/search_suggest.py'
+EVENT_DATA = {
+    'q': 'collins',
+    'page_size': 10,
+    'from_record': 0,
+    'work_groups': ['1086', '724', '1299'],
+    'subscriber_id': '4281'
+}
+
+
+def load_baseline(ref):
+    source = subprocess.check_output(['git', 'show', '{}:{}'.format(ref, SEARCH_SUGGEST_PATH)], cwd=ROOT_DIR)
+    with tempfile.NamedTemporaryFile(suffix='.py', delete=False) as module_file:
+        module_file.write(source)
+    spec = importlib.util.spec_from_file_location('search_suggest_baseline', module_file.name)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        os.unlink(module_file.name)
+    return module
+
+
+def time_build(module, iterations):
+    # Older revisions serialized with json.dumps, newer ones through serialize_query.
+    serialize = getattr(module, 'serialize_query', json.dumps)
+
+    def build():
+        serialize(module.build_suggest_search_query(dict(EVENT_DATA)))
+
+    best = min(timeit.repeat(build, number=iterations, repeat=5))
+    return {'us_per_query': best / iterations * 1e6}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--baseline-ref', help='git revision to compare against, e.g. HEAD~1')
+    args = parser.parse_args()
+
+    report = {'current': time_build(search_suggest, args.iterations)}
+    if args.baseline_ref:
+        report['baseline'] = time_build(load_baseline(args.baseline_ref), args.iterations)
+        report['baseline']['ref'] = args.baseline_ref
+        report['speedup'] = report['baseline']['us_per_query'] / report['current']['us_per_query']
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,157 @@
+"""
+Deterministic generator of synthetic workspace documents for scale testing.
+
+Writes bulk format NDJSON in the shape data_load consumes, an index action line followed by the
+workspace document, the same as es/workspaces-10000-10002.txt. The same seed and options always give
+the same documents, however the output is split. Documents are streamed, so memory use stays flat for
+any document count. Run it from the localstack directory:
+
+    python -m search_lambda.benchmarks.generate_workspaces --docs 10000000 --out-dir /tmp/workspaces \\
+        --compress gzip --part-bytes 268435456
+"""
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import random
+import sys
+from os import path
+
+FIRST_NAMES = ['Davina', 'Alana', 'Cayden', 'Willy', 'Oliver', 'Charlotte', 'Jack', 'Amelia', 'Noah', 'Isla',
+               'William', 'Mia', 'Thomas', 'Grace', 'Lucas', 'Chloe', 'Henry', 'Zoe', 'Leo', 'Ruby']
+LAST_NAMES = ['Jay', 'Wonker', 'Smith', 'Nguyen', 'Brown', 'Wilson', 'Taylor', 'Johnson', 'White', 'Martin',
+              'Anderson', 'Thompson', 'Lee', 'Walker', 'Harris', 'Ryan', 'Robinson', 'Kelly', 'King', 'Chen']
+BANKS = ['Big Bank Australia', 'Small Bank Australia', 'National Bank Australia', 'Monkey Money',
+         'Harbour Credit Union', 'Coastal Building Society', 'Capital Mutual']
+STREETS = ['Collins St', 'Bourke St', 'Flinders St', 'Swanston St', 'George St', 'Pitt St', 'Queen St',
+           'Adelaide St', 'Hay St', 'King William St', 'Macquarie St', 'Elizabeth St', 'Smith St', 'High St']
+# Suburb, jurisdiction and postcode of the property addresses.
+SUBURBS = [('Melbourne', 'VIC', '3000'), ('Richmond', 'VIC', '3121'), ('Geelong', 'VIC', '3220'),
+           ('Sydney', 'NSW', '2000'), ('Parramatta', 'NSW', '2150'), ('Brisbane', 'QLD', '4000'),
+           ('Perth', 'WA', '6000'), ('Adelaide', 'SA', '5000'), ('Hobart', 'TAS', '7000'),
+           ('Canberra', 'ACT', '2600'), ('Darwin', 'NT', '0800')]
+ROLES = ['Role1', 'Role2', 'Role3']
+REFERENCE_KINDS = ['in-prop', 'in-mort', 'out-prop', 'out-mort', 'disch']
+PARTY_SOURCES = ['RIQ', 'MANUAL']
+
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def iter_workspaces(docs, seed=0, parties=(1, 4), properties=(1, 2), workgroups=1000, subscribers=500,
+                    abandoned_ratio=0.05, inactive_ratio=0.02, first_id=10000):
+    # Yields (doc_id, document) pairs, one random stream per seed so documents never depend on the output split.
+    rng = random.Random(seed)
+    for n in range(docs):
+        workspace_id = first_id + n
+        participant_id = 1000000 + n
+        suburb, jurisdiction, postcode = rng.choice(SUBURBS)
+        document = {
+            'workspace': {
+                'status': 'ABANDONED' if rng.random() < abandoned_ratio else 'ACTIVE',
+                'jurisdiction': jurisdiction,
+                'id': workspace_id,
+                'number': str(190000000 + workspace_id),
+                'workgroups': sorted(rng.sample(range(1, workgroups + 1), min(workgroups, rng.randint(1, 3))))
+            },
+            'propertys': [{
+                'id': 50000000 + n * 10 + p,
+                'landIdentifier': '{}/{}'.format(rng.randint(1000, 99999), rng.randint(1, 999)),
+                'lvReportAddress': None,
+                'lotInUnregisteredPlan': ('Lot {} PS{}'.format(rng.randint(1, 99), rng.randint(100000, 999999))
+                                          if rng.random() < 0.1 else None),
+                'address': '{}{} {} {} {} {}'.format(
+                    '{}/'.format(rng.randint(1, 40)) if rng.random() < 0.2 else '', rng.randint(1, 999),
+                    rng.choice(STREETS), suburb, jurisdiction, postcode)
+            } for p in range(rng.randint(*properties))],
+            'parties': [{
+                'id': 2000000 + n * 10 + p,
+                'name': random_party(rng),
+                'partySource': rng.choice(PARTY_SOURCES),
+                'titlePartyFullName': random_party(rng)
+            } for p in range(rng.randint(*parties))],
+            'participant': {
+                'id': participant_id,
+                'status': 'INACTIVE' if rng.random() < inactive_ratio else 'ACTIVE',
+                'role': rng.choice(ROLES),
+                'subscriberId': rng.randint(1, subscribers),
+                'reference': '{}-{}'.format(rng.choice(REFERENCE_KINDS), rng.randint(1, 99999))
+            },
+            'created_date': '2019-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.000+10:00'.format(
+                rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59)),
+            'schema_version': '1.0'
+        }
+        yield '{}-{}'.format(workspace_id, participant_id), document
+
+
+def random_party(rng):
+    if rng.random() < 0.3:
+        return rng.choice(BANKS)
+    return '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+def iter_bulk_lines(workspaces):
+    # One action and source pair per document, as bytes ready to write.
+    for doc_id, document in workspaces:
+        yield (json.dumps({'index': {'_id': doc_id}}, separators=(',', ':')) + '\n' +
+               json.dumps(document, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+@contextlib.contextmanager
+def open_part(file_name, compress):
+    # The compressed writer is closed first, so its last frame is flushed before the file is closed.
+    with open(file_name, 'wb') as raw:
+        if compress == 'gzip':
+            with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as part:
+                yield part
+        elif compress == 'zstd':
+            import zstandard
+            with zstandard.ZstdCompressor(level=3).stream_writer(raw) as part:
+                yield part
+        else:
+            yield raw
+
+
+def write_parts(pairs, out_dir, prefix='workspaces', compress=None, part_bytes=0):
+    # Starts a new part once part_bytes of uncompressed NDJSON are written, parts never split a document.
+    os.makedirs(out_dir, exist_ok=True)
+    pairs = iter(pairs)
+    parts = []
+    pair = next(pairs, None)
+    while pair is not None:
+        file_name = path.join(out_dir, '{}-{:05d}.ndjson{}'.format(prefix, len(parts), COMPRESSIONS[compress]))
+        parts.append(file_name)
+        written = 0
+        with open_part(file_name, compress) as part:
+            while pair is not None and not (part_bytes and written >= part_bytes):
+                part.write(pair)
+                written += len(pair)
+                pair = next(pairs, None)
+    return parts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parties-min', type=int, default=1)
+    parser.add_argument('--parties-max', type=int, default=4)
+    parser.add_argument('--properties-min', type=int, default=1)
+    parser.add_argument('--properties-max', type=int, default=2)
+    parser.add_argument('--workgroups', type=int, default=1000, help='distinct workgroup ids')
+    parser.add_argument('--subscribers', type=int, default=500, help='distinct subscriber ids')
+    parser.add_argument('--abandoned-ratio', type=float, default=0.05, help='share of ABANDONED workspaces')
+    parser.add_argument('--inactive-ratio', type=float, default=0.02, help='share of INACTIVE participants')
+    parser.add_argument('--first-id', type=int, default=10000, help='workspace id of the first document')
+    parser.add_argument('--out-dir', default='.')
+    parser.add_argument('--prefix', default='workspaces')
+    parser.add_argument('--compress', choices=['gzip', 'zstd'])
+    parser.add_argument('--part-bytes', type=int, default=0, help='uncompressed bytes per part, 0 for one file')
+    args = parser.parse_args()
+
+    workspaces = iter_workspaces(args.docs, args.seed, (args.parties_min, args.parties_max),
+                                 (args.properties_min, args.properties_max), args.workgroups, args.subscribers,
+                                 args.abandoned_ratio, args.inactive_ratio, args.first_id)
+    for file_name in write_parts(iter_bulk_lines(workspaces), args.out_dir, args.prefix, args.compress,
+                                 args.part_bytes):
+        sys.stdout.write(file_name + '\n')
@@ -0,0 +1,131 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import unquote, urlparse
+
+
+class StubServer(object):
+    """
+    Local HTTP stand-in for the S3 and Elasticsearch endpoints used by the lambdas, so the
+    benchmarks run offline. Paths under a known bucket are served as S3 objects, everything
+    else answers like a single node Elasticsearch.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+        self.search_response = {'took': 1, 'timed_out': False, 'hits': {'total': 0, 'hits': []}}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def put_object(self, bucket_name, file_key, body):
+        self.objects[(bucket_name, file_key)] = body
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, without this keep-alive responses wait on delayed acks.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self._dispatch(head=True)
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_PUT(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def do_DELETE(self):
+                self._dispatch()
+
+            def _dispatch(self, head=False):
+                url = urlparse(self.path)
+                path = unquote(url.path)
+                body = self._read_body()
+                with stub._lock:
+                    stub.requests.append((self.command, path))
+                parts = path.lstrip('/').split('/', 1)
+                if len(parts) == 2 and any(bucket == parts[0] for bucket, key in stub.objects):
+                    self._s3(parts[0], parts[1], body, head)
+                else:
+                    self._es(path, body, head)
+
+            def _read_body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _s3(self, bucket_name, file_key, body, head):
+                if self.command == 'PUT':
+                    stub.put_object(bucket_name, file_key, body)
+                    return self._send(200, b'')
+                data = stub.objects.get((bucket_name, file_key))
+                if data is None:
+                    return self._send(404, b'<Error><Code>NoSuchKey</Code></Error>', 'application/xml')
+                status = 200
+                byte_range = self.headers.get('Range')
+                if byte_range:
+                    start = int(byte_range[len('bytes='):].split('-')[0])
+                    data = data[start:]
+                    status = 206
+                self._send(status, data, 'application/octet-stream', head)
+
+            def _es(self, path, body, head):
+                if path.endswith('/_bulk'):
+                    actions = [json.loads(line) for line in body.splitlines() if line.strip()]
+                    items = []
+                    for action in actions:
+                        name = next(iter(action))
+                        if len(action) == 1 and name in ('index', 'create', 'update', 'delete'):
+                            items.append({name: dict(action[name], status=201)})
+                    return self._json({'took': 1, 'errors': False, 'items': items})
+                if path.endswith('/_search'):
+                    return self._json(stub.search_response)
+                if path.endswith('/_msearch'):
+                    # Header and query lines alternate, every query gets the search response.
+                    searches = len([line for line in body.splitlines() if line.strip()]) // 2
+                    return self._json({'responses': [stub.search_response] * searches})
+                self._json({'acknowledged': True}, head=head)
+
+            def _json(self, document, head=False):
+                self._send(200, json.dumps(document).encode('utf-8'), 'application/json', head)
+
+            def _send(self, status, data, content_type='text/plain', head=False):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if not head:
+                    self.wfile.write(data)
+
+        return Handler
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
@@ -0,0 +1,51 @@
+import gzip
+import json
+import tempfile
+import unittest
+from os import path
+from search_lambda.benchmarks import generate_workspaces
+
+
+class TestGenerateWorkspaces(unittest.TestCase):
+    """
+    Synthetic workspace generator tests
+    """
+
+    def test_same_seed_gives_the_same_documents(self):
+        first = list(generate_workspaces.iter_bulk_lines(generate_workspaces.iter_workspaces(50, seed=7)))
+        second = list(generate_workspaces.iter_bulk_lines(generate_workspaces.iter_workspaces(50, seed=7)))
+        other = list(generate_workspaces.iter_bulk_lines(generate_workspaces.iter_workspaces(50, seed=8)))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        action, document = first[0].decode('utf-8').splitlines()
+        self.assertEqual(json.loads(action), {'index': {'_id': '10000-1000000'}})
+        self.assertEqual(json.loads(document)['workspace']['id'], 10000)
+
+    def test_parts_split_at_the_part_size_between_documents(self):
+        pairs = list(generate_workspaces.iter_bulk_lines(generate_workspaces.iter_workspaces(40)))
+        part_bytes = sum(len(pair) for pair in pairs[:10])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            whole = generate_workspaces.write_parts(iter(pairs), path.join(tmp_dir, 'whole'))
+            parts = generate_workspaces.write_parts(iter(pairs), path.join(tmp_dir, 'parts'), compress='gzip',
+                                                    part_bytes=part_bytes)
+            with open(whole[0], 'rb') as whole_file:
+                expected = whole_file.read()
+            contents = []
+            for part in parts:
+                with gzip.open(part, 'rb') as part_file:
+                    contents.append(part_file.read())
+
+        self.assertEqual(len(whole), 1)
+        self.assertGreater(len(parts), 2)
+        self.assertEqual([path.basename(part) for part in parts],
+                         ['workspaces-{:05d}.ndjson.gz'.format(n) for n in range(len(parts))])
+        self.assertEqual(contents[0], b''.join(pairs[:10]))
+        self.assertEqual(b''.join(contents), expected)
+        # Every part but the last is closed by the first document that reaches the part size.
+        longest = max(len(pair) for pair in pairs)
+        for content in contents[:-1]:
+            self.assertTrue(part_bytes <= len(content) < part_bytes + longest)
+
+
+if __name__ == '__main__':
+    unittest.main()
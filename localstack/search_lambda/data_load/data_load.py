@@ -1,34 +1,92 @@
+import copy
+import gzip
+import hashlib
+import json
 import logging
 import os
-import boto3
-from elasticsearch import Elasticsearch, RequestsHttpConnection
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import unquote_plus
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.WARNING)
 
-s3 = None
-
 ES_USE_SSL = os.getenv('ES_USE_SSL', 'False')
 ES_VERIFY_CERTS = os.getenv('ES_VERIFY_CERTS', 'False')
 ES_PORT = os.getenv('ES_PORT', '4571')
 ES_HOST = os.getenv('ES_HOST', '172.17.0.2')
 ES_INDEX = os.getenv('ES_INDEX', 'workspace')
 ES_DOC_TYPE = os.getenv('ES_DOC_TYPE', 'doc')
+# S3 endpoint used when not running against aws.
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL', 'http://172.17.0.2:4572')
+# Gzip the bulk request bodies sent to Elasticsearch.
+ES_HTTP_COMPRESS = os.getenv('ES_HTTP_COMPRESS', 'False')
 SCHEMA_VERSION = os.getenv('SCHEMA_VERSION', '1.0')
+# Bulk requests are capped by document count and payload size, whichever is reached first.
+# The document count starts at ES_BULK_INITIAL_DOCS and adapts between the min and max to the measured latency.
+ES_BULK_INITIAL_DOCS = os.getenv('ES_BULK_INITIAL_DOCS', '500')
+ES_BULK_MIN_DOCS = os.getenv('ES_BULK_MIN_DOCS', '50')
+ES_BULK_MAX_DOCS = os.getenv('ES_BULK_MAX_DOCS', '5000')
+ES_BULK_MAX_BYTES = os.getenv('ES_BULK_MAX_BYTES', '5242880')
+ES_BULK_TARGET_LATENCY_MS = os.getenv('ES_BULK_TARGET_LATENCY_MS', '1000')
+ES_BULK_TIMEOUT = os.getenv('ES_BULK_TIMEOUT', '120')
+# Number of bulk requests kept in flight, and the backoff used when the cluster rejects them.
+ES_BULK_WORKERS = os.getenv('ES_BULK_WORKERS', '4')
+ES_BULK_MAX_RETRIES = os.getenv('ES_BULK_MAX_RETRIES', '8')
+ES_BULK_BACKOFF_BASE = os.getenv('ES_BULK_BACKOFF_BASE', '0.5')
+ES_BULK_BACKOFF_MAX = os.getenv('ES_BULK_BACKOFF_MAX', '30')
+# Number of S3 records of one event that are loaded at the same time.
+S3_RECORD_WORKERS = os.getenv('S3_RECORD_WORKERS', '4')
+# Plain objects of at least S3_RANGE_CUTOVER_BYTES are downloaded as S3_RANGE_PARTS parallel byte ranges.
+S3_RANGE_CUTOVER_BYTES = os.getenv('S3_RANGE_CUTOVER_BYTES', '268435456')
+S3_RANGE_PARTS = os.getenv('S3_RANGE_PARTS', '4')
+# Incremental mode only indexes documents whose content fingerprint changed since the last load.
+# Fingerprints are kept in a side index in Elasticsearch, or in a local SQLite file for local runs.
+ES_INCREMENTAL = os.getenv('ES_INCREMENTAL', 'False')
+FINGERPRINT_STORE = os.getenv('FINGERPRINT_STORE', 'es')
+FINGERPRINT_INDEX = os.getenv('FINGERPRINT_INDEX', ES_INDEX + '_fingerprints')
+FINGERPRINT_SQLITE_PATH = os.getenv('FINGERPRINT_SQLITE_PATH', '/tmp/data_load_fingerprints.sqlite')
+# A full rebuild loads into a new versioned index, e.g. workspace_v1559278164123, with refresh and replicas turned
+# off, then restores the settings below, force merges and swaps the ES_INDEX alias over to it in one step.
+# It is only run for an explicit {"rebuild": {"bucket": ..., "keys": [...]}} or {"rebuild": {..., "manifest": ...}}.
+ES_REFRESH_INTERVAL = os.getenv('ES_REFRESH_INTERVAL', '1s')
+ES_NUMBER_OF_REPLICAS = os.getenv('ES_NUMBER_OF_REPLICAS', '1')
+ES_FORCEMERGE_SEGMENTS = os.getenv('ES_FORCEMERGE_SEGMENTS', '1')
+ES_FORCEMERGE_TIMEOUT = os.getenv('ES_FORCEMERGE_TIMEOUT', '600')
+ES_REBUILD_DELETE_OLD = os.getenv('ES_REBUILD_DELETE_OLD', 'False')
+# Per subscriber filtered aliases, e.g. workspace_subscriber_{}, holding the security filters of the suggest query.
+# They are created with {"subscriber_aliases": [4281]} and moved along with a rebuild.
+ES_SUBSCRIBER_ALIAS = os.getenv('ES_SUBSCRIBER_ALIAS', '')
+# When set, every searchable value of a workspace is also written to this index as a small flat document.
+ES_SUGGESTION_INDEX = os.getenv('ES_SUGGESTION_INDEX', '')
+# Per file stage timings and bulk figures are written as CloudWatch embedded metric format lines.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'Search/DataLoad')
+# Documents that are permanently rejected are written next to the source key with this suffix.
+DEAD_LETTER_SUFFIX = os.getenv('DEAD_LETTER_SUFFIX', '.dead-letter.ndjson')
+S3_READ_CHUNK_SIZE = os.getenv('S3_READ_CHUNK_SIZE', '1048576')
 
 LOG_PREFIX = '[Elastic Search][Data Load]'
 
+# File extensions and S3 ContentEncoding values of the compressed inputs.
+GZIP_EXTENSIONS = ('.gz', '.gzip')
+ZSTD_EXTENSIONS = ('.zst', '.zstd')
+GZIP_ENCODINGS = ('gzip', 'x-gzip')
+ZSTD_ENCODINGS = ('zstd',)
 
-def str2bool(v):
-    return v.lower() in ("yes", "true", "t", "1")
+# Bulk actions that are followed by a source line, delete is the only action without one.
+BULK_SOURCE_ACTIONS = ('index', 'create', 'update')
+BULK_ACTIONS = BULK_SOURCE_ACTIONS + ('delete',)
+# Per document bulk item statuses that are worth sending again.
+BULK_RETRY_STATUSES = (429, 503)
 
 
-if str2bool(ES_USE_SSL):
-    # Running against aws
-    s3 = boto3.client('s3')
-else:
-    # Running against localstack
-    s3 = boto3.client('s3', endpoint_url='http://172.17.0.2:4572')
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
 
 # Elastic search mapping
 INDEX_MAPPING = {
@@ -59,6 +117,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -107,6 +169,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -121,6 +187,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -150,6 +220,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -167,6 +241,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -181,6 +259,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -216,6 +298,10 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
@@ -230,10 +316,14 @@ INDEX_MAPPING = {
                                     "type": "text",
                                     "analyzer": "keyword_analyzer"
                                 },
+                                "ngram": {
+                                    "type": "text",
+                                    "analyzer": "ngram_analyzer"
+                                },
                                 "keyword": {
                                     "type": "keyword",
                                     "ignore_above": 256
-                                },
+                                }
                             },
                             "analyzer": "standard"
                         },
@@ -262,7 +352,13 @@ INDEX_MAPPING = {
     "settings": {
         "index": {
             "analysis": {
-                "filter": {},
+                "filter": {
+                    "ngram_filter": {
+                        "type": "ngram",
+                        "min_gram": 3,
+                        "max_gram": 3
+                    }
+                },
                 "analyzer": {
                     "keyword_analyzer": {
                         "filter": [
@@ -273,6 +369,17 @@ INDEX_MAPPING = {
                         "char_filter": [],
                         "type": "custom",
                         "tokenizer": "keyword"
+                    },
+                    "ngram_analyzer": {
+                        "filter": [
+                            "lowercase",
+                            "asciifolding",
+                            "trim",
+                            "ngram_filter"
+                        ],
+                        "char_filter": [],
+                        "type": "custom",
+                        "tokenizer": "keyword"
                     }
                 }
             }
@@ -280,61 +387,1109 @@ INDEX_MAPPING = {
     }
 }
 
+# Suggestion index mapping, the workspace filters of the suggest query keep their field names.
+SUGGESTION_INDEX_MAPPING = {
+    "mappings": {
+        ES_DOC_TYPE: {
+            "dynamic": False,
+            "properties": {
+                "doc_id": {
+                    "type": "keyword"
+                },
+                "field": {
+                    "type": "keyword"
+                },
+                "position": {
+                    "type": "integer"
+                },
+                "values": {
+                    "type": "integer",
+                    "index": False
+                },
+                "value": {
+                    "type": "keyword",
+                    "index": False,
+                    "doc_values": False,
+                    "fields": {
+                        "ngram": {
+                            "type": "text",
+                            "analyzer": "ngram_analyzer"
+                        }
+                    }
+                },
+                "workspace": {
+                    "properties": {
+                        "id": {
+                            "type": "long"
+                        },
+                        "status": {
+                            "type": "keyword",
+                            "index": False,
+                            "fields": {
+                                "keyword": {
+                                    "type": "keyword",
+                                    "ignore_above": 256
+                                }
+                            }
+                        },
+                        "workgroups": {
+                            "type": "long"
+                        }
+                    }
+                },
+                "participant": {
+                    "properties": {
+                        "id": {
+                            "type": "long"
+                        },
+                        "status": {
+                            "type": "keyword",
+                            "index": False,
+                            "fields": {
+                                "keyword": {
+                                    "type": "keyword",
+                                    "ignore_above": 256
+                                }
+                            }
+                        },
+                        "subscriberId": {
+                            "type": "long"
+                        }
+                    }
+                }
+            }
+        }
+    },
+    "settings": copy.deepcopy(INDEX_MAPPING["settings"])
+}
+
+# Suggested values and the display name suggest returns them under, kept in sync with MATCHED_FIELDS of
+# search_suggest. The workspace values come first, then those of each property and party, as suggest orders them.
+SUGGESTION_WORKSPACE_FIELDS = [('participant.reference', 'subscriberRef'), ('workspace.number', 'workspaceNumber'),
+                               ('workspace.jurisdiction', 'jurisdiction')]
+SUGGESTION_NESTED_FIELDS = [
+    ('propertys', [('landIdentifier', 'landIdentifier'), ('address', 'address'),
+                   ('lotInUnregisteredPlan', 'lotInUnregisteredPlan')]),
+    ('parties', [('name', 'partyName')])
+]
+
+
+class ElasticsearchFingerprints(object):
+    """
+    Document content fingerprints stored in a side index, keyed on the document _id.
+    """
+
+    MAPPING = {
+        "mappings": {
+            ES_DOC_TYPE: {
+                "dynamic": False,
+                "properties": {
+                    "hash": {
+                        "type": "keyword",
+                        "index": False
+                    }
+                }
+            }
+        }
+    }
+
+    def __init__(self, client, index):
+        self.client = client
+        self.index = index
+        if client.indices.exists(index) is False:
+            client.indices.create(index, body=self.MAPPING)
+            LOGGER.warning("{} Fingerprint index created {}".format(LOG_PREFIX, index))
+
+    def get(self, ids):
+        response = self.client.mget(body={'ids': ids}, index=self.index, doc_type=ES_DOC_TYPE)
+        return {doc['_id']: doc['_source']['hash'] for doc in response['docs'] if doc.get('found')}
+
+    def put(self, hashes):
+        lines = []
+        for doc_id, doc_hash in hashes.items():
+            lines.append(json.dumps({'index': {'_id': doc_id}}))
+            lines.append(json.dumps({'hash': doc_hash}))
+        self._bulk(lines)
+
+    def delete(self, ids):
+        self._bulk([json.dumps({'delete': {'_id': doc_id}}) for doc_id in ids])
+
+    def clear(self):
+        self.client.indices.delete(self.index, ignore=404)
+        self.client.indices.create(self.index, body=self.MAPPING)
+
+    def _bulk(self, lines):
+        if lines:
+            self.client.bulk(body='\n'.join(lines) + '\n', index=self.index, doc_type=ES_DOC_TYPE,
+                             request_timeout=int(ES_BULK_TIMEOUT))
+
+
+class SqliteFingerprints(object):
+    """
+    Document content fingerprints stored in a local SQLite file, for local runs without a side index.
+    """
 
+    # Stay below the SQLite limit on the number of query parameters.
+    MAX_PARAMETERS = 500
+
+    def __init__(self, path):
+        import sqlite3
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS fingerprints (id TEXT PRIMARY KEY, hash TEXT NOT NULL)')
+
+    def get(self, ids):
+        hashes = {}
+        with self._lock:
+            for start in range(0, len(ids), self.MAX_PARAMETERS):
+                chunk = ids[start:start + self.MAX_PARAMETERS]
+                hashes.update(self._db.execute(
+                    'SELECT id, hash FROM fingerprints WHERE id IN ({})'.format(','.join('?' * len(chunk))), chunk))
+        return hashes
+
+    def put(self, hashes):
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO fingerprints (id, hash) VALUES (?, ?)', hashes.items())
+
+    def delete(self, ids):
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM fingerprints WHERE id = ?', [(doc_id,) for doc_id in ids])
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM fingerprints')
+
+
+# The clients are created on first use and cached, so warm invocations skip the connection and index bootstrap.
+s3 = None
 es_client = None
-try:
-    es_client = Elasticsearch(
+fingerprints = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    global s3
+    if s3 is None:
+        with _client_lock:
+            if s3 is None:
+                import boto3
+                if str2bool(ES_USE_SSL):
+                    # Running against aws
+                    s3 = boto3.client('s3')
+                else:
+                    # Running against localstack
+                    s3 = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL)
+    return s3
+
+
+def get_es_client():
+    global es_client, fingerprints
+    if es_client is None:
+        with _client_lock:
+            if es_client is None:
+                client = create_es_client()
+                created = bootstrap_index(client)
+                fingerprints = create_fingerprints(client)
+                # A new index holds none of the documents the stored fingerprints would skip.
+                if created and fingerprints is not None:
+                    fingerprints.clear()
+                es_client = client
+    return es_client
+
+
+def create_es_client():
+    from elasticsearch import Elasticsearch, RequestsHttpConnection
+    from requests.adapters import HTTPAdapter
+
+    class PooledRequestsHttpConnection(RequestsHttpConnection):
+        """
+        Requests connection with a keep-alive pool big enough for every bulk worker of every record.
+        """
+
+        def __init__(self, pool_maxsize=10, **kwargs):
+            super(PooledRequestsHttpConnection, self).__init__(**kwargs)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+    return Elasticsearch(
         hosts=[{'host': ES_HOST, 'port': int(ES_PORT)}],
         use_ssl=str2bool(ES_USE_SSL),
         verify_certs=str2bool(ES_VERIFY_CERTS),
-        connection_class=RequestsHttpConnection)
-    if not es_client.ping():
-        raise Exception('ConnectTimeout')
-except Exception as E:
-    LOGGER.error("{} Unable to connect to {} with Exception {}".format(LOG_PREFIX, ES_HOST, str(E)))
-    exit(1)
-
-try:
-    if es_client.indices.exists(ES_INDEX) is False:
+        http_compress=str2bool(ES_HTTP_COMPRESS),
+        connection_class=PooledRequestsHttpConnection,
+        pool_maxsize=int(S3_RECORD_WORKERS) * int(ES_BULK_WORKERS))
+
+
+def bootstrap_index(client):
+    # The exists call doubles as the connection check, so there is no separate ping round trip.
+    created = False
+    if client.indices.exists(ES_INDEX) is False:
         LOGGER.warning("{} Index does not exists {}".format(LOG_PREFIX, ES_INDEX))
-        es_client.indices.create(ES_INDEX, body=INDEX_MAPPING)
+        client.indices.create(ES_INDEX, body=INDEX_MAPPING)
         LOGGER.warning("{} Index created {}".format(LOG_PREFIX, ES_INDEX))
-except Exception as E:
-    LOGGER.error("{} Unable to Create Index {} with Exception {}".format(LOG_PREFIX, ES_INDEX, str(E)))
-    exit(1)
+        created = True
+    if ES_SUGGESTION_INDEX and client.indices.exists(ES_SUGGESTION_INDEX) is False:
+        client.indices.create(ES_SUGGESTION_INDEX, body=SUGGESTION_INDEX_MAPPING)
+        LOGGER.warning("{} Suggestion index created {}".format(LOG_PREFIX, ES_SUGGESTION_INDEX))
+    return created
+
+
+def create_fingerprints(client):
+    if not str2bool(ES_INCREMENTAL):
+        return None
+    if FINGERPRINT_STORE == 'sqlite':
+        return SqliteFingerprints(FINGERPRINT_SQLITE_PATH)
+    return ElasticsearchFingerprints(client, FINGERPRINT_INDEX)
 
 
 def lambda_handler(event, context):
-    bucket_name = ''
-    file_key = ''
+    if 'subscriber_aliases' in event:
+        return {'subscriber_aliases': create_subscriber_aliases(event['subscriber_aliases'])}
+    if 'rebuild' in event:
+        return {'rebuild': rebuild_index(event['rebuild'])}
+
+    records = []
     try:
-        bucket_name = event['Records'][0]['s3']['bucket']['name']
-        file_key = event['Records'][0]['s3']['object']['key']
-        LOGGER.warning('{} Reading {} from {}'.format(LOG_PREFIX, file_key, bucket_name))
+        for record in event['Records']:
+            # S3 event keys are url encoded, e.g. spaces arrive as '+'.
+            records.append((record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])))
     except KeyError as ex:
         LOGGER.error(
             '{} Failed parsing S3 trigger event:{} : {}'.format(LOG_PREFIX, event, str(ex)))
-        exit(1)
+        raise
+
+    connect()
+    return {'results': load_records(records, ES_INDEX)}
+
 
+def connect():
     try:
-        # get the object
-        obj = s3.get_object(Bucket=bucket_name, Key=file_key)
-        payload = obj['Body'].read().decode("utf-8")
-        bulk_index_doc_element(payload, bucket_name, file_key)
+        get_es_client()
     except Exception as ex:
-        LOGGER.error(
-            '{} Failed indexing Elasticsearch to ES_HOST: {} and ES_INDEX: {} with Exception {}'.format(LOG_PREFIX,
-                                                                                                        ES_HOST,
-                                                                                                        ES_INDEX,
-                                                                                                        str(ex)))
-        exit(1)
+        LOGGER.error("{} Unable to connect to {} and bootstrap {} with Exception {}".format(LOG_PREFIX, ES_HOST,
+                                                                                           ES_INDEX, str(ex)))
+        raise
+
+
+def load_records(records, index_name):
+    # Every record gets its own result, so one bad file doesn't fail the rest of the event.
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(len(records), int(S3_RECORD_WORKERS)))) as executor:
+        futures = [(file_key, executor.submit(load_s3_object, bucket_name, file_key, index_name))
+                   for bucket_name, file_key in records]
+        for file_key, future in futures:
+            results[file_key] = future.result()
+            if str2bool(METRICS_ENABLED):
+                emit_metrics(file_key, results[file_key])
+    return results
+
+
+def rebuild_index(request):
+    # A rebuild loads every key of the request into a new index, and only then moves the alias over to it.
+    try:
+        bucket_name = request['bucket']
+        file_keys = request['keys'] if 'keys' in request else read_manifest(bucket_name, request['manifest'])
+    except KeyError as ex:
+        LOGGER.error('{} Failed parsing rebuild request:{} : {}'.format(LOG_PREFIX, request, str(ex)))
+        raise
+    if not file_keys:
+        raise ValueError('The rebuild request has no keys to load')
+    connect()
+
+    try:
+        index_name = start_rebuild()
+    except Exception as ex:
+        LOGGER.error('{} Unable to start a rebuild of {} with Exception {}'.format(LOG_PREFIX, ES_INDEX, str(ex)))
+        return {'index': None, 'swapped': False, 'error': str(ex)}
+
+    results = load_records([(bucket_name, file_key) for file_key in file_keys], index_name)
+    rebuild = {'index': index_name, 'swapped': False, 'results': results}
+    # Files that failed or were skipped leave the new index incomplete, and an empty one would hide every workspace.
+    if any('error' in result or result.get('skipped') is True for result in results.values()):
+        LOGGER.error('{} Rebuild of {} failed, {} is left on the previous index'.format(LOG_PREFIX, index_name,
+                                                                                      ES_INDEX))
+    elif sum(result.get('indexed', 0) for result in results.values()) == 0:
+        LOGGER.error('{} Rebuild of {} indexed no documents, {} is left on the previous index'.format(
+            LOG_PREFIX, index_name, ES_INDEX))
+    else:
+        try:
+            finish_rebuild(index_name)
+            rebuild['swapped'] = True
+        except Exception as ex:
+            LOGGER.error('{} Unable to swap {} to {} with Exception {}'.format(LOG_PREFIX, ES_INDEX, index_name,
+                                                                             str(ex)))
+            rebuild['error'] = str(ex)
+    if not rebuild['swapped']:
+        rebuild['swapped'] = discard_rebuild(index_name)
+    return rebuild
+
+
+def read_manifest(bucket_name, manifest_key):
+    # A manifest is an S3 object listing one key to load per line.
+    body = get_s3_client().get_object(Bucket=bucket_name, Key=manifest_key)['Body'].read()
+    return [line.strip() for line in body.decode('utf-8').splitlines() if line.strip()]
+
+
+def create_subscriber_aliases(subscriber_ids):
+    if not ES_SUBSCRIBER_ALIAS:
+        raise ValueError('ES_SUBSCRIBER_ALIAS is not set')
+    # Adding an alias that exists only replaces its filter, so this can be run again for the same subscribers.
+    actions = [{'add': {'index': ES_INDEX, 'alias': ES_SUBSCRIBER_ALIAS.format(int(subscriber_id)),
+                        'filter': subscriber_filter(subscriber_id)}} for subscriber_id in subscriber_ids]
+    get_es_client().indices.update_aliases(body={'actions': actions})
+    aliases = [action['add']['alias'] for action in actions]
+    LOGGER.warning('{} Created subscriber aliases {} on {}'.format(LOG_PREFIX, aliases, ES_INDEX))
+    return aliases
+
+
+def subscriber_filter(subscriber_id):
+    # The security filters of the suggest query, kept in sync with search_suggest.
+    return {
+        'bool': {
+            'filter': [
+                {'term': {'participant.subscriberId': int(subscriber_id)}},
+                {'term': {'participant.status.keyword': 'ACTIVE'}}
+            ],
+            'must_not': {'term': {'workspace.status.keyword': 'ABANDONED'}}
+        }
+    }
+
+
+def subscriber_alias_actions(client, old_indices, index_name):
+    # Subscriber aliases follow the main alias to the new index in the same request.
+    if not ES_SUBSCRIBER_ALIAS or not old_indices:
+        return []
+    found = client.indices.get_alias(index=','.join(old_indices), name=ES_SUBSCRIBER_ALIAS.format('*'), ignore=404)
+    actions = []
+    for old_index, aliases in found.items():
+        if not isinstance(aliases, dict) or 'aliases' not in aliases:
+            continue
+        for alias, definition in aliases['aliases'].items():
+            actions.append({'remove': {'index': old_index, 'alias': alias}})
+            actions.append({'add': dict(definition, index=index_name, alias=alias)})
+    return actions
+
+
+def emit_metrics(file_key, summary):
+    # One embedded metric format line per loaded file, the counts of the summary become the metrics.
+    values = {name: value for name, value in summary.items()
+              if isinstance(value, (int, float)) and not isinstance(value, bool)}
+    if summary.get('total_ms'):
+        values['docs_per_sec'] = summary.get('indexed', 0) / (summary['total_ms'] / 1000.0)
+    metrics = [{'Name': name, 'Unit': 'Milliseconds' if name.endswith('_ms') else 'Bytes' if name.endswith('_bytes')
+                else 'Count/Second' if name.endswith('_per_sec') else 'Count'} for name in values]
+    document = {'_aws': {'Timestamp': int(time.time() * 1000),
+                         'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['Function']],
+                                                'Metrics': metrics}]},
+                'Function': 'data_load', 'key': file_key}
+    if 'error' in summary:
+        document['error'] = summary['error']
+    document.update(values)
+    sys.stdout.write(json.dumps(document) + '\n')
+
+
+def start_rebuild():
+    # Milliseconds keep two rebuilds started in the same second apart, the create fails on any other collision.
+    index_name = '{}_v{}'.format(ES_INDEX, int(time.time() * 1000))
+    body = copy.deepcopy(INDEX_MAPPING)
+    body['settings']['index'].update({'refresh_interval': '-1', 'number_of_replicas': 0})
+    client = get_es_client()
+    remove_abandoned_rebuilds(client)
+    client.indices.create(index_name, body=body)
+    if ES_SUGGESTION_INDEX:
+        suggestion_body = copy.deepcopy(SUGGESTION_INDEX_MAPPING)
+        suggestion_body['settings']['index'].update({'refresh_interval': '-1', 'number_of_replicas': 0})
+        try:
+            client.indices.create(suggestion_index_name(index_name), body=suggestion_body)
+        except Exception:
+            client.indices.delete(index_name, ignore=404)
+            raise
+    LOGGER.warning('{} Rebuilding {} into {}'.format(LOG_PREFIX, ES_INDEX, index_name))
+    return index_name
+
+
+def remove_abandoned_rebuilds(client):
+    # A rebuild stopped by a timeout leaves its index with refresh turned off and no alias, the settings a finished
+    # rebuild restores. Only one rebuild runs at a time, so any such index is left over and removed here.
+    found = client.indices.get_settings(index=ES_INDEX + '_v*', name='index.refresh_interval', ignore=404)
+    for index_name, settings in found.items() if isinstance(found, dict) else []:
+        if not isinstance(settings, dict) or \
+                settings.get('settings', {}).get('index', {}).get('refresh_interval') != '-1':
+            continue
+        discard_rebuild(index_name)
+
+
+def discard_rebuild(index_name):
+    # Deletes the indices of a rebuild that was not swapped in, unless the alias moved after all, e.g. when the
+    # alias request timed out on the client only. Returns whether the alias points to the rebuilt index.
+    client = get_es_client()
+    try:
+        if client.indices.exists_alias(name=ES_INDEX, index=index_name) is True:
+            LOGGER.warning('{} Alias {} is on {}, it is kept'.format(LOG_PREFIX, ES_INDEX, index_name))
+            return True
+        for rebuilt_index in [index_name] + ([suggestion_index_name(index_name)] if ES_SUGGESTION_INDEX else []):
+            client.indices.delete(rebuilt_index, ignore=404)
+            LOGGER.warning('{} Deleted unfinished rebuild index {}'.format(LOG_PREFIX, rebuilt_index))
+    except Exception as ex:
+        LOGGER.error('{} Unable to delete unfinished rebuild {} with Exception {}'.format(LOG_PREFIX, index_name,
+                                                                                          str(ex)))
+    return False
+
 
+def suggestion_index_name(index_name):
+    # A rebuild loads the suggestions into a versioned index next to the versioned workspace index.
+    return ES_SUGGESTION_INDEX + index_name[len(ES_INDEX):]
+
+
+def finish_rebuild(index_name):
+    client = get_es_client()
+    rebuilt = [index_name] + ([suggestion_index_name(index_name)] if ES_SUGGESTION_INDEX else [])
+    for rebuilt_index in rebuilt:
+        client.indices.put_settings(body={'index': {'refresh_interval': ES_REFRESH_INTERVAL,
+                                                    'number_of_replicas': int(ES_NUMBER_OF_REPLICAS)}},
+                                    index=rebuilt_index)
+        client.indices.refresh(rebuilt_index)
+        client.indices.forcemerge(index=rebuilt_index, max_num_segments=int(ES_FORCEMERGE_SEGMENTS),
+                                  request_timeout=int(ES_FORCEMERGE_TIMEOUT))
+
+    # Move the alias in one request, so searches see either the old or the new index and never a partial one.
+    actions = []
+    previous = []
+    if client.indices.exists_alias(name=ES_INDEX):
+        previous = list(client.indices.get_alias(name=ES_INDEX))
+        actions += subscriber_alias_actions(client, previous, index_name)
+        actions += [{'remove': {'index': old_index, 'alias': ES_INDEX}} for old_index in previous]
+    elif client.indices.exists(ES_INDEX):
+        # The first rebuild replaces the index created in place by the bootstrap.
+        actions += [action for action in subscriber_alias_actions(client, [ES_INDEX], index_name)
+                    if 'add' in action]
+        actions.append({'remove_index': {'index': ES_INDEX}})
+    actions.append({'add': {'index': index_name, 'alias': ES_INDEX}})
+    if ES_SUGGESTION_INDEX:
+        suggestion_actions, suggestion_previous = alias_swap_actions(client, ES_SUGGESTION_INDEX,
+                                                                     suggestion_index_name(index_name))
+        actions += suggestion_actions
+        previous += suggestion_previous
+    client.indices.update_aliases(body={'actions': actions})
+    LOGGER.warning('{} Alias {} swapped to {}'.format(LOG_PREFIX, ES_INDEX, index_name))
+
+    # The alias has moved, so nothing after this point may fail the rebuild.
+    try:
+        # The fingerprints describe the previous index, every document is written again on its next load.
+        if fingerprints is not None:
+            fingerprints.clear()
+        if str2bool(ES_REBUILD_DELETE_OLD):
+            for old_index in previous:
+                if old_index != index_name:
+                    client.indices.delete(old_index)
+                    LOGGER.warning('{} Deleted previous index {}'.format(LOG_PREFIX, old_index))
+    except Exception as ex:
+        LOGGER.error('{} Failed to clean up after swapping {} to {} with Exception {}'.format(
+            LOG_PREFIX, ES_INDEX, index_name, str(ex)))
+
+
+def alias_swap_actions(client, alias, index_name):
+    # Returns the actions moving the alias to index_name, and the indices it is moved off.
+    if client.indices.exists_alias(name=alias):
+        previous = list(client.indices.get_alias(name=alias))
+        actions = [{'remove': {'index': old_index, 'alias': alias}} for old_index in previous]
+        return actions + [{'add': {'index': index_name, 'alias': alias}}], previous
+    if client.indices.exists(alias):
+        return [{'remove_index': {'index': alias}}, {'add': {'index': index_name, 'alias': alias}}], []
+    return [{'add': {'index': index_name, 'alias': alias}}], []
+
+
+def load_s3_object(bucket_name, file_key, index_name=ES_INDEX):
+    LOGGER.warning('{} Reading {} from {}'.format(LOG_PREFIX, file_key, bucket_name))
+    # Dead letter objects land in the same bucket, so they trigger this lambda too.
+    if file_key.endswith(DEAD_LETTER_SUFFIX):
+        LOGGER.warning('{} Skipping dead letter object {}'.format(LOG_PREFIX, file_key))
+        return {'skipped': True}
 
-def bulk_index_doc_element(body, bucket_name, file_key):
     try:
-        es_client.bulk(body=body, index=ES_INDEX, doc_type=ES_DOC_TYPE, _source=False, request_timeout=120)
-        LOGGER.warning("{} Created bulk index for bucket: {} and key: {}".format(LOG_PREFIX, bucket_name, file_key))
+        started = time.perf_counter()
+        # get the object, the body is streamed so the file is never held in memory
+        obj = get_s3_client().get_object(Bucket=bucket_name, Key=file_key)
+        s3_get_ms = (time.perf_counter() - started) * 1000
+        read_timer = S3ReadTimer() if str2bool(METRICS_ENABLED) else None
+        if read_timer is not None:
+            obj['Body'] = read_timer.wrap(obj['Body'])
+        if obj.get('ContentLength', 0) >= int(S3_RANGE_CUTOVER_BYTES) and not compression(obj, file_key):
+            # Large plain objects are read as parallel byte ranges, the body already open reads the first of them.
+            summary = bulk_index_ranges(bucket_name, file_key, obj['ContentLength'], index_name, obj['Body'],
+                                        read_timer)
+        else:
+            summary = bulk_index_doc_element(open_s3_body(obj, file_key), bucket_name, file_key, index_name)
+        if read_timer is not None:
+            # The batch time was measured around the source, which includes reading the S3 bodies.
+            summary['batch_ms'] = max(0, summary.get('batch_ms', 0) - read_timer.ms)
+            summary.update(s3_get_ms=s3_get_ms, s3_read_ms=read_timer.ms, s3_bytes=obj.get('ContentLength', 0),
+                           total_ms=(time.perf_counter() - started) * 1000)
+        return summary
     except Exception as ex:
         LOGGER.error(
-            "{} Failed to index document for bucket: {} and key: {} with Exception {}".format(LOG_PREFIX, bucket_name,
-                                                                                              file_key, str(ex)))
+            '{} Failed indexing {} from {} to ES_HOST: {} and ES_INDEX: {} with Exception {}'.format(LOG_PREFIX,
+                                                                                                  file_key,
+                                                                                                  bucket_name,
+                                                                                                  ES_HOST,
+                                                                                                  ES_INDEX,
+                                                                                                  str(ex)))
+        return {'error': str(ex)}
+
+
+def compression(obj, file_key):
+    encoding = obj.get('ContentEncoding', '').lower()
+    if encoding in GZIP_ENCODINGS or file_key.lower().endswith(GZIP_EXTENSIONS):
+        return 'gzip'
+    if encoding in ZSTD_ENCODINGS or file_key.lower().endswith(ZSTD_EXTENSIONS):
+        return 'zstd'
+    return None
+
+
+def open_s3_body(obj, file_key):
+    # Compressed objects are decompressed while they are streamed, the uncompressed file is never held in memory.
+    file_compression = compression(obj, file_key)
+    if file_compression == 'gzip':
+        return gzip.GzipFile(fileobj=obj['Body'], mode='rb')
+    if file_compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError('zstandard is required to load {}'.format(file_key))
+        return zstandard.ZstdDecompressor().stream_reader(obj['Body'])
+    return obj['Body']
+
+
+def bulk_index_doc_element(body, bucket_name, file_key, index_name=ES_INDEX):
+    return bulk_index_actions([iter_bulk_actions(iter_lines(body))], bucket_name, file_key, index_name)
+
+
+def bulk_index_ranges(bucket_name, file_key, content_length, index_name=ES_INDEX, first_body=None, read_timer=None):
+    ranges = split_ranges(content_length, int(S3_RANGE_PARTS))
+    LOGGER.warning('{} Reading {} bytes of {} from {} in {} ranges'.format(LOG_PREFIX, content_length, file_key,
+                                                                          bucket_name, len(ranges)))
+    sources = [iter_bulk_actions(iter_range_lines(bucket_name, file_key, start, end, first_body if start == 0 else None,
+                                                  read_timer)) for start, end in ranges]
+    return bulk_index_actions(sources, bucket_name, file_key, index_name)
+
+
+def bulk_index_actions(sources, bucket_name, file_key, index_name=ES_INDEX):
+    summary = {'indexed': 0, 'retried': 0, 'failed': 0, 'batches': 0}
+    batch_size = AdaptiveBatchSize(int(ES_BULK_INITIAL_DOCS), int(ES_BULK_MIN_DOCS), int(ES_BULK_MAX_DOCS),
+                                   int(ES_BULK_TARGET_LATENCY_MS) / 1000.0)
+    lock = threading.Lock()
+    # Rejected documents are spooled to disk, so a badly broken file doesn't use up the lambda memory.
+    with tempfile.TemporaryFile() as dead_letters:
+        try:
+            with ThreadPoolExecutor(max_workers=int(ES_BULK_WORKERS)) as executor:
+                if len(sources) == 1:
+                    feed_bulk_batches(sources[0], executor, batch_size, summary, dead_letters, lock, index_name)
+                else:
+                    # Every byte range is read by its own thread, feeding its batches to the shared bulk workers.
+                    with ThreadPoolExecutor(max_workers=len(sources)) as readers:
+                        futures = [readers.submit(feed_bulk_batches, source, executor, batch_size, summary,
+                                                  dead_letters, lock, index_name) for source in sources]
+                        for future in futures:
+                            future.result()
+            LOGGER.warning("{} Created bulk index for bucket: {} and key: {} with {}".format(
+                LOG_PREFIX, bucket_name, file_key, summary))
+        except Exception as ex:
+            summary['error'] = str(ex)
+            LOGGER.error(
+                "{} Failed to index document for bucket: {} and key: {} after {} with Exception {}".format(
+                    LOG_PREFIX, bucket_name, file_key, summary, str(ex)))
+
+        if summary['failed']:
+            summary['dead_letter_key'] = file_key + DEAD_LETTER_SUFFIX
+            dead_letters.seek(0)
+            get_s3_client().upload_fileobj(dead_letters, bucket_name, summary['dead_letter_key'])
+            LOGGER.warning("{} Wrote {} rejected documents to bucket: {} and key: {}".format(
+                LOG_PREFIX, summary['failed'], bucket_name, summary['dead_letter_key']))
+    return summary
+
+
+def feed_bulk_batches(actions, executor, batch_size, summary, dead_letters, lock, index_name):
+    workers = int(ES_BULK_WORKERS)
+    pending = set()
+    # Time spent reading and batching the source, and waiting on busy bulk workers.
+    timings = {'batch_ms': 0, 'wait_ms': 0} if str2bool(METRICS_ENABLED) else None
+    try:
+        batches = iter_bulk_batches(actions, batch_size.get, int(ES_BULK_MAX_BYTES))
+        while True:
+            started = time.perf_counter()
+            batch = next(batches, None)
+            if timings is not None:
+                timings['batch_ms'] += (time.perf_counter() - started) * 1000
+            if batch is None:
+                break
+            # Bound the queued batches so only a few of them are held in memory at once.
+            if len(pending) >= workers * 2:
+                started = time.perf_counter()
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if timings is not None:
+                    timings['wait_ms'] += (time.perf_counter() - started) * 1000
+                add_batch_results(done, summary, dead_letters, lock)
+            pending.add(executor.submit(index_batch, batch, batch_size, index_name))
+            with lock:
+                summary['batches'] += 1
+        started = time.perf_counter()
+        done, pending = pending, set()
+        add_batch_results(done, summary, dead_letters, lock)
+        if timings is not None:
+            timings['wait_ms'] += (time.perf_counter() - started) * 1000
+            add_batch_result(summary, (timings, []), dead_letters, lock)
+    except Exception:
+        # Batches that have not started are dropped, those already sent are counted and dead lettered first.
+        started = [future for future in pending if not future.cancel()]
+        with lock:
+            summary['cancelled_batches'] = summary.get('cancelled_batches', 0) + len(pending) - len(started)
+        try:
+            add_batch_results(started, summary, dead_letters, lock)
+        except Exception as ex:
+            LOGGER.error('{} Bulk batch failed while stopping: {}'.format(LOG_PREFIX, str(ex)))
+        raise
+
+
+def add_batch_results(futures, summary, dead_letters, lock):
+    # Every finished batch is recorded before the first error is raised, so none of them goes uncounted.
+    error = None
+    for future in futures:
+        try:
+            add_batch_result(summary, future.result(), dead_letters, lock)
+        except Exception as ex:
+            error = error or ex
+    if error is not None:
+        raise error
+
+
+def add_batch_result(summary, result, dead_letters, lock):
+    counts, failed = result
+    with lock:
+        for name, count in counts.items():
+            summary[name] = summary.get(name, 0) + count
+        summary['failed'] += len(failed)
+        for dead_letter in failed:
+            dead_letters.write(dead_letter + b'\n')
+
+
+def index_batch(batch, batch_size, index_name):
+    # Returns the document counts of the batch, plus dead letter lines for the rejected documents.
+    counts = {'indexed': 0, 'retried': 0}
+    # Bulk timings are added to the counts, and so summed up per file.
+    timings = counts if str2bool(METRICS_ENABLED) else None
+    # Fingerprints describe the live index, a rebuild writes every document of its new index.
+    if fingerprints is None or index_name != ES_INDEX:
+        indexed, counts['retried'], failed = send_batch(batch, batch_size, index_name, timings=timings)
+        counts['indexed'] = len(indexed)
+        if ES_SUGGESTION_INDEX:
+            suggestions, suggestions_failed, unfinished = index_suggestions(indexed, batch_size, index_name, timings)
+            counts.update(suggestions)
+            failed += suggestions_failed
+        return counts, failed
+
+    counts.update({'skipped': 0, 'added': 0, 'updated': 0})
+    changed, hashes, previous = filter_unchanged(batch)
+    counts['skipped'] = len(batch) - len(changed)
+    if not changed:
+        return counts, []
+    indexed, counts['retried'], failed = send_batch(changed, batch_size, index_name, timings=timings)
+    counts['indexed'] = len(indexed)
+    unfinished = set()
+    if ES_SUGGESTION_INDEX:
+        suggestions, suggestions_failed, unfinished = index_suggestions(indexed, batch_size, index_name, timings)
+        counts.update(suggestions)
+        failed += suggestions_failed
+    # Workspaces whose suggestions were not written keep their old fingerprint, so the next load writes them again.
+    record_fingerprints(indexed, hashes, previous, counts, unfinished)
+    return counts, failed
+
+
+def filter_unchanged(batch):
+    # Drop the documents whose source hashes the same as when they were last indexed.
+    doc_ids = [bulk_doc_id(action) for action, source in batch]
+    hashes = {}
+    for (action, source), doc_id in zip(batch, doc_ids):
+        if doc_id is not None and source is not None:
+            hashes[doc_id] = hashlib.blake2b(source, digest_size=16).hexdigest()
+    previous = fingerprints.get(list(hashes)) if hashes else {}
+    changed = [(action, source) for (action, source), doc_id in zip(batch, doc_ids)
+               if doc_id not in hashes or previous.get(doc_id) != hashes[doc_id]]
+    return changed, hashes, previous
+
+
+def record_fingerprints(indexed, hashes, previous, counts, unfinished=()):
+    updated = {}
+    deleted = []
+    for action, source in indexed:
+        doc_id = bulk_doc_id(action)
+        if doc_id is None:
+            counts['added'] += 1
+        elif source is None:
+            deleted.append(doc_id)
+        else:
+            counts['updated' if doc_id in previous else 'added'] += 1
+            if doc_id not in unfinished:
+                updated[doc_id] = hashes[doc_id]
+    # The documents are already indexed, a failed fingerprint write only means they are indexed again next time.
+    try:
+        fingerprints.put(updated)
+        if deleted:
+            fingerprints.delete(deleted)
+    except Exception as ex:
+        LOGGER.error("{} Failed to record {} fingerprints with Exception {}".format(LOG_PREFIX, len(updated), str(ex)))
+
+
+def bulk_doc_id(action):
+    return next(iter(json.loads(action).values())).get('_id')
+
+
+def send_batch(batch, batch_size, index_name, attempt=0, timings=None):
+    # Returns the indexed pairs and retried document count, plus dead letter lines for the rejected documents.
+    response = send_bulk(build_bulk_body(batch), batch_size, index_name, timings)
+    if not response.get('errors'):
+        return batch, 0, []
+
+    indexed = []
+    retry = []
+    failed = []
+    for (action, source), item in zip(batch, response['items']):
+        result, = item.values()
+        if 'error' not in result:
+            indexed.append((action, source))
+        elif result.get('status') in BULK_RETRY_STATUSES and attempt < int(ES_BULK_MAX_RETRIES):
+            retry.append((action, source))
+        else:
+            failed.append(build_dead_letter(action, source, result))
+    retried = len(retry)
+    if retry:
+        batch_size.record_rejection()
+        delay = backoff_delay(attempt)
+        LOGGER.warning("{} Retrying {} rejected documents in {:.2f}s".format(LOG_PREFIX, len(retry), delay))
+        time.sleep(delay)
+        # Retry in smaller batches, the cluster is already pushing back.
+        retry_docs = max(1, min(batch_size.get(), (len(retry) + 1) // 2))
+        for start in range(0, len(retry), retry_docs):
+            retry_indexed, retry_retried, retry_failed = send_batch(retry[start:start + retry_docs], batch_size,
+                                                                    index_name, attempt + 1, timings)
+            indexed += retry_indexed
+            retried += retry_retried
+            failed += retry_failed
+    return indexed, retried, failed
+
+
+def index_suggestions(indexed, batch_size, index_name, timings=None):
+    # Writes the suggestions of the indexed workspaces, after they are in the workspace index. Returns their counts,
+    # dead letter lines for the rejected suggestions and the ids of the workspaces they belong to.
+    counts = {'suggestions': 0, 'suggestions_failed': 0}
+    suggestion_index = suggestion_index_name(index_name)
+    workspaces = []
+    updated = []
+    for action, source in indexed:
+        doc_id = bulk_doc_id(action)
+        # Documents without an _id can't be replaced later.
+        if doc_id is None:
+            continue
+        if bulk_action_name(action) == 'update':
+            # Partial updates don't hold the whole workspace, its suggestions are built from the merged document.
+            updated.append(doc_id)
+        else:
+            workspaces.append((doc_id, build_suggestions(doc_id, source) if source is not None else []))
+    if updated:
+        workspaces += merged_suggestions(index_name, updated)
+    if not workspaces:
+        return counts, [], set()
+
+    # Suggestion ids are the workspace _id and value position, so a workspace that lost values only needs the
+    # positions past its new count deleted. The count of the earlier load is read from its first suggestion.
+    value_counts = suggestion_counts(suggestion_index, [doc_id for doc_id, suggestions in workspaces])
+    batch = []
+    owners = {}
+    for doc_id, suggestions in workspaces:
+        for position in range(len(suggestions), value_counts.get(doc_id, 0)):
+            action = json.dumps({'delete': {'_id': '{}:{}'.format(doc_id, position)}}).encode('utf-8')
+            batch.append((action, None))
+            owners[action] = doc_id
+        for suggestion_id, suggestion in suggestions:
+            action = json.dumps({'index': {'_id': suggestion_id}}).encode('utf-8')
+            batch.append((action, json.dumps(suggestion).encode('utf-8')))
+            owners[action] = doc_id
+        value_counts[doc_id] = len(suggestions)
+    if not batch:
+        return counts, [], set()
+    # Rejected suggestions are retried and dead lettered like the workspaces.
+    written, counts['suggestions_retried'], failed = send_batch(batch, batch_size, suggestion_index, timings=timings)
+    counts['suggestions'] = sum(1 for action, source in written if source is not None)
+    counts['suggestions_failed'] = len(failed)
+    written = {action for action, source in written}
+    failed_ids = {owners[action] for action, source in batch if action not in written}
+    if failed:
+        LOGGER.error('{} Failed to write {} suggestions to {}'.format(LOG_PREFIX, len(failed), suggestion_index))
+    return counts, failed, failed_ids
+
+
+def merged_suggestions(index_name, doc_ids):
+    # The realtime get returns the workspaces as merged by their partial updates.
+    response = get_es_client().mget(body={'ids': list(dict.fromkeys(doc_ids))}, index=index_name,
+                                    doc_type=ES_DOC_TYPE)
+    return [(doc['_id'], build_suggestions(doc['_id'], json.dumps(doc['_source']).encode('utf-8'))
+             if doc.get('found') else []) for doc in response['docs']]
+
+
+def suggestion_counts(suggestion_index, doc_ids):
+    # The realtime get sees suggestions that are not refreshed yet, unlike a search or delete by query.
+    docs = [{'_id': '{}:0'.format(doc_id), '_source': ['values']} for doc_id in dict.fromkeys(doc_ids)]
+    response = get_es_client().mget(body={'docs': docs}, index=suggestion_index, doc_type=ES_DOC_TYPE)
+    return {doc['_id'][:-len(':0')]: doc['_source'].get('values', 0) for doc in response['docs'] if doc.get('found')}
+
+
+def build_suggestions(doc_id, source):
+    # One flat document per searchable value, carrying the workspace filters so suggest needs no nested query.
+    document = json.loads(source)
+    workspace = document.get('workspace') or {}
+    participant = document.get('participant') or {}
+    common = {
+        'doc_id': doc_id,
+        'workspace': {'id': workspace.get('id'), 'status': workspace.get('status'),
+                      'workgroups': workspace.get('workgroups')},
+        'participant': {'id': participant.get('id'), 'status': participant.get('status'),
+                        'subscriberId': participant.get('subscriberId')}
+    }
+    values = []
+    for field, display_value in SUGGESTION_WORKSPACE_FIELDS:
+        section, name = field.split('.')
+        values.append((display_value, (document.get(section) or {}).get(name)))
+    for path, fields in SUGGESTION_NESTED_FIELDS:
+        for item in document.get(path) or []:
+            values += [(display_value, item.get(name)) for name, display_value in fields]
+    values = [(display_value, value) for display_value, value in values if value is not None and value != '']
+    # Every suggestion carries the number of values of its workspace, the next load deletes the positions past it.
+    return [('{}:{}'.format(doc_id, position),
+             dict(common, field=display_value, value=value, position=position, values=len(values)))
+            for position, (display_value, value) in enumerate(values)]
+
+
+def build_dead_letter(action, source, result):
+    return b'{"status":%s,"error":%s,"action":%s,"source":%s}' % (
+        json.dumps(result.get('status')).encode('utf-8'), json.dumps(result.get('error')).encode('utf-8'),
+        action, source if source is not None else b'null')
+
+
+def send_bulk(body, batch_size, index_name=ES_INDEX, timings=None):
+    from elasticsearch import TransportError
+    attempt = 0
+    while True:
+        try:
+            started = time.monotonic()
+            response = get_es_client().bulk(body=body, index=index_name, doc_type=ES_DOC_TYPE, _source=False,
+                                      request_timeout=int(ES_BULK_TIMEOUT))
+            latency = time.monotonic() - started
+            batch_size.record_latency(latency)
+            if timings is not None:
+                for name, value in (('bulk_ms', latency * 1000), ('bulk_bytes', len(body)),
+                                    ('es_took_ms', response.get('took', 0)), ('bulk_requests', 1)):
+                    timings[name] = timings.get(name, 0) + value
+            return response
+        except TransportError as ex:
+            if not is_rejected(ex) or attempt >= int(ES_BULK_MAX_RETRIES):
+                raise
+            batch_size.record_rejection()
+            delay = backoff_delay(attempt)
+            LOGGER.warning("{} Bulk request rejected, retrying in {:.2f}s".format(LOG_PREFIX, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def is_rejected(ex):
+    return ex.status_code == 429 or 'es_rejected_execution_exception' in str(ex.error)
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter, so rejected workers don't retry in lockstep.
+    return random.uniform(0, min(float(ES_BULK_BACKOFF_MAX), float(ES_BULK_BACKOFF_BASE) * 2 ** attempt))
+
+
+class S3ReadTimer(object):
+    """
+    Time spent reading the S3 bodies of one file, summed over the threads reading its ranges.
+    """
+
+    def __init__(self):
+        self.ms = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, body):
+        return TimedBody(body, self)
+
+    def add(self, elapsed_ms):
+        with self._lock:
+            self.ms += elapsed_ms
+
+
+class TimedBody(object):
+    def __init__(self, body, timer):
+        self.body = body
+        self.timer = timer
+
+    def read(self, *args):
+        started = time.perf_counter()
+        try:
+            return self.body.read(*args)
+        finally:
+            self.timer.add((time.perf_counter() - started) * 1000)
+
+    def close(self):
+        self.body.close()
+
+
+class AdaptiveBatchSize(object):
+    """
+    Bulk batch document count, grown while the cluster answers faster than the target latency
+    and shrunk when it slows down or rejects requests.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_latency):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.docs = max(minimum, min(initial, maximum))
+        self._lock = threading.Lock()
+
+    def get(self):
+        return self.docs
+
+    def record_latency(self, latency):
+        with self._lock:
+            if latency < self.target_latency / 2:
+                self.docs = min(self.maximum, int(self.docs * 1.25) + 1)
+            elif latency > self.target_latency:
+                self.docs = max(self.minimum, int(self.docs * max(0.5, self.target_latency / latency)))
+
+    def record_rejection(self):
+        with self._lock:
+            self.docs = max(self.minimum, self.docs // 2)
+
+
+def iter_lines(stream, chunk_size=None):
+    # Read the stream in fixed size chunks and yield complete lines, without the trailing newline.
+    chunk_size = chunk_size or int(S3_READ_CHUNK_SIZE)
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def split_ranges(content_length, parts):
+    part_size = max(1, -(-content_length // max(1, parts)))
+    return [(start, min(content_length, start + part_size)) for start in range(0, content_length, part_size)]
+
+
+def iter_range_lines(bucket_name, file_key, start, end, body=None, read_timer=None):
+    # Yield the lines of the bulk pairs whose action line starts in [start, end). The range is read open ended,
+    # so the source line of the last pair is finished even when it runs past the end of the range. A body that is
+    # already open must start at the offset of the range.
+    offset = max(0, start - 1)
+    if body is None:
+        body = get_s3_client().get_object(Bucket=bucket_name, Key=file_key,
+                                          Range='bytes={}-'.format(offset))['Body']
+        if read_timer is not None:
+            body = read_timer.wrap(body)
+    try:
+        lines = iter_lines(body)
+        if start:
+            # Drop the rest of the line started in the previous range, or the newline right before this range.
+            offset += len(next(lines, b'')) + 1
+        aligned = start == 0
+        for line in lines:
+            line_offset = offset
+            offset += len(line) + 1
+            if not line.strip():
+                continue
+            if not aligned:
+                aligned = True
+                # A source line here belongs to the action that ends the previous range.
+                if not is_bulk_action(line):
+                    continue
+            if line_offset >= end and is_bulk_action(line):
+                break
+            yield line
+    finally:
+        body.close()
+
+
+def is_bulk_action(line):
+    try:
+        action = json.loads(line)
+    except ValueError:
+        return False
+    return (isinstance(action, dict) and len(action) == 1 and next(iter(action)) in BULK_ACTIONS and
+            isinstance(next(iter(action.values())), dict))
+
+
+def iter_bulk_actions(lines):
+    # Pair each bulk action line with its source line, e.g. {"index":{"_id":"10000-1000000"}} and its workspace.
+    action = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if action is None:
+            action_name = bulk_action_name(line)
+            if action_name == 'delete':
+                yield line, None
+            else:
+                action = line
+        else:
+            yield action, line
+            action = None
+    if action is not None:
+        raise ValueError('Bulk action {} has no source line'.format(action[:256]))
+
+
+def bulk_action_name(line):
+    try:
+        action = json.loads(line)
+        action_name, = action.keys()
+    except (ValueError, AttributeError):
+        raise ValueError('Invalid bulk action line {}'.format(line[:256]))
+    if action_name not in BULK_ACTIONS:
+        raise ValueError('Unsupported bulk action {}'.format(action_name))
+    return action_name
+
+
+def iter_bulk_batches(actions, max_docs, max_bytes):
+    # max_docs is a callable so the batch size can change while the file is being read.
+    batch = []
+    batch_bytes = 0
+    for action, source in actions:
+        size = bulk_pair_size(action, source)
+        if batch and (len(batch) >= max_docs() or batch_bytes + size > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((action, source))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def bulk_pair_size(action, source):
+    return len(action) + 1 + (len(source) + 1 if source is not None else 0)
+
+
+def build_bulk_body(batch):
+    lines = []
+    for action, source in batch:
+        lines.append(action)
+        if source is not None:
+            lines.append(source)
+    lines.append(b'')
+    return b'\n'.join(lines)
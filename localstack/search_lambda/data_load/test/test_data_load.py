@@ -1,4 +1,18 @@
+import gzip
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from unittest import mock
+from os import path
+from elasticsearch import TransportError
+from search_lambda.data_load import data_load
+
+basepath = path.dirname(__file__)
+WORKSPACES_FILE = path.abspath(path.join(basepath, '..', '..', '..', 'es', 'workspaces-10000-10002.txt'))
 
 
 class TestDatLoad(unittest.TestCase):
@@ -6,9 +20,567 @@ class TestDatLoad(unittest.TestCase):
     Data Load lambda tests
     """
 
-    def test_data_load(self):
+    def setUp(self):
+        with open(WORKSPACES_FILE, 'rb') as workspaces_file:
+            self.payload = workspaces_file.read()
+
+    def test_iter_lines_across_chunk_boundaries(self):
+        lines = list(data_load.iter_lines(io.BytesIO(b'a\nbb\n\nccc'), chunk_size=2))
+        self.assertEqual(lines, [b'a', b'bb', b'', b'ccc'])
+
+    def test_iter_bulk_actions_pairs_action_and_source_lines(self):
+        actions = list(data_load.iter_bulk_actions(data_load.iter_lines(io.BytesIO(self.payload), chunk_size=7)))
+        self.assertEqual(len(actions), 3)
+        action, source = actions[0]
+        self.assertEqual(json.loads(action), {'index': {'_id': '10000-1000000'}})
+        self.assertEqual(json.loads(source)['workspace']['number'], '190010000')
+
+    def test_iter_bulk_actions_delete_has_no_source(self):
+        lines = [b'{"delete":{"_id":"1"}}', b'{"index":{"_id":"2"}}', b'{"a":1}']
+        self.assertEqual(list(data_load.iter_bulk_actions(lines)),
+                         [(b'{"delete":{"_id":"1"}}', None), (b'{"index":{"_id":"2"}}', b'{"a":1}')])
+
+    def test_iter_bulk_actions_rejects_dangling_action(self):
+        with self.assertRaises(ValueError):
+            list(data_load.iter_bulk_actions([b'{"index":{"_id":"1"}}']))
+
+    def test_iter_bulk_batches_caps_docs_and_bytes(self):
+        pairs = [(b'{"index":{}}', b'x' * 10)] * 5
+        self.assertEqual([len(b) for b in data_load.iter_bulk_batches(iter(pairs), lambda: 2, 10000)], [2, 2, 1])
+        self.assertEqual([len(b) for b in data_load.iter_bulk_batches(iter(pairs), lambda: 100, 50)], [2, 2, 1])
+
+    def test_bulk_index_doc_element_sends_batches(self):
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'ES_BULK_INITIAL_DOCS', '2'), \
+                mock.patch.object(data_load, 'ES_BULK_MIN_DOCS', '2'), \
+                mock.patch.object(data_load, 'ES_BULK_MAX_DOCS', '2'):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            summary = data_load.bulk_index_doc_element(io.BytesIO(self.payload), 'bucket', 'key')
+        self.assertEqual(summary, {'indexed': 3, 'retried': 0, 'failed': 0, 'batches': 2})
+        self.assertEqual(es_client.bulk.call_count, 2)
+        bodies = b''.join(c[1]['body'] for c in es_client.bulk.call_args_list)
+        self.assertEqual(sorted(bodies.split(b'\n')), sorted(self.payload.strip().split(b'\n') + [b'']))
+
+    def test_bulk_index_doc_element_retries_and_dead_letters_failed_items(self):
+        first = {'errors': True, 'items': [
+            {'index': {'_id': '10000-1000000', 'status': 201}},
+            {'index': {'_id': '10001-1000001', 'status': 429, 'error': {'type': 'es_rejected_execution_exception'}}},
+            {'index': {'_id': '10002-1000002', 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}}]}
+        retry = {'errors': False, 'items': [{'index': {'_id': '10001-1000001', 'status': 201}}]}
+        uploaded = {}
+
+        def upload_fileobj(fileobj, bucket, key):
+            uploaded[key] = fileobj.read()
+
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load.time, 'sleep'):
+            es_client.bulk.side_effect = [first, retry]
+            s3.upload_fileobj.side_effect = upload_fileobj
+            summary = data_load.bulk_index_doc_element(io.BytesIO(self.payload), 'bucket', 'exports/key.txt')
+
+        self.assertEqual(summary, {'indexed': 2, 'retried': 1, 'failed': 1, 'batches': 1,
+                                   'dead_letter_key': 'exports/key.txt.dead-letter.ndjson'})
+        self.assertIn(b'"_id":"10001-1000001"', es_client.bulk.call_args_list[1][1]['body'])
+        self.assertNotIn(b'"_id":"10000-1000000"', es_client.bulk.call_args_list[1][1]['body'])
+        dead_letter = json.loads(uploaded['exports/key.txt.dead-letter.ndjson'])
+        self.assertEqual(dead_letter['status'], 400)
+        self.assertEqual(dead_letter['action'], {'index': {'_id': '10002-1000002'}})
+        self.assertEqual(dead_letter['source']['workspace']['number'], '190010002')
+
+    def test_batches_in_flight_are_recorded_when_reading_fails(self):
+        uploaded = {}
+        sent = threading.Semaphore(0)
+
+        def bulk(body, **kwargs):
+            sent.release()
+            if b'10001-1000001' in body:
+                return {'errors': True, 'items': [
+                    {'index': {'_id': '10001-1000001', 'status': 400, 'error': {'type': 'mapper_parsing_exception'}}}]}
+            return {'errors': False, 'items': []}
+
+        def upload_fileobj(fileobj, bucket, key):
+            uploaded[key] = fileobj.read()
+
+        def lines():
+            for line in self.payload.split(b'\n'):
+                yield line
+            # The dangling action fails the read once the first two documents are sent.
+            sent.acquire(timeout=5)
+            sent.acquire(timeout=5)
+            yield b'{"index":{"_id":"1"}}'
+
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load, 'ES_BULK_INITIAL_DOCS', '1'), \
+                mock.patch.object(data_load, 'ES_BULK_MIN_DOCS', '1'), \
+                mock.patch.object(data_load, 'ES_BULK_MAX_DOCS', '1'):
+            es_client.bulk.side_effect = bulk
+            s3.upload_fileobj.side_effect = upload_fileobj
+            summary = data_load.bulk_index_actions([data_load.iter_bulk_actions(lines())], 'bucket', 'key.txt')
+
+        self.assertIn('has no source line', summary['error'])
+        self.assertEqual((summary['batches'], summary['indexed'], summary['failed']), (2, 1, 1))
+        self.assertIn(b'10001-1000001', uploaded['key.txt.dead-letter.ndjson'])
+
+    def test_open_s3_body_decompresses_gzip_by_extension_and_encoding(self):
+        compressed = gzip.compress(self.payload)
+        by_extension = data_load.open_s3_body({'Body': io.BytesIO(compressed)}, 'workspaces.txt.gz')
+        by_encoding = data_load.open_s3_body({'Body': io.BytesIO(compressed), 'ContentEncoding': 'gzip'},
+                                             'workspaces.txt')
+        self.assertEqual(b''.join(data_load.iter_lines(by_extension, chunk_size=16)),
+                         self.payload.replace(b'\n', b''))
+        self.assertEqual(by_encoding.read(), self.payload)
+
+    def test_open_s3_body_leaves_plain_objects_alone(self):
+        body = io.BytesIO(self.payload)
+        self.assertIs(data_load.open_s3_body({'Body': body}, 'workspaces.txt'), body)
+
+    def test_range_lines_never_split_or_repeat_bulk_pairs(self):
+        lines = []
+        for doc_id in range(40):
+            if doc_id % 7 == 3:
+                lines.append(b'{"delete":{"_id":"%d"}}' % doc_id)
+            else:
+                lines.append(b'{"index":{"_id":"%d"}}' % doc_id)
+                lines.append(b'{"workspace":{"number":"%s"}}' % (b'9' * doc_id))
+        payload = b'\n'.join(lines) + b'\n'
+        expected = list(data_load.iter_bulk_actions(payload.split(b'\n')))
+
+        with mock.patch.object(data_load, 's3') as s3:
+            s3.get_object.side_effect = ranged_get_object(payload)
+            for parts in (1, 2, 3, 5, 8, 13, 64, len(payload)):
+                actions = []
+                for start, end in data_load.split_ranges(len(payload), parts):
+                    actions += data_load.iter_bulk_actions(data_load.iter_range_lines('bucket', 'key', start, end))
+                self.assertEqual(actions, expected, 'split in {} parts'.format(parts))
+
+    def test_load_s3_object_uses_ranges_for_large_objects(self):
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load, 'S3_RANGE_CUTOVER_BYTES', '100'):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            s3.get_object.side_effect = ranged_get_object(self.payload)
+            summary = data_load.load_s3_object('bucket', 'workspaces.txt')
+        self.assertEqual(summary['indexed'], 3)
+        # The first GET decides on the split and reads the first range, the others are ranged GETs.
+        ranges = [c[1].get('Range') for c in s3.get_object.call_args_list]
+        self.assertEqual(len(ranges), int(data_load.S3_RANGE_PARTS))
+        self.assertEqual(ranges[0], None)
+        self.assertNotIn(None, ranges[1:])
+
+    def test_incremental_load_skips_unchanged_documents(self):
+        changed = self.payload.replace(b'Davina Jay', b'Davina May')
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'fingerprints', data_load.SqliteFingerprints(tmp_dir + '/fp.sqlite')):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            first = data_load.bulk_index_doc_element(io.BytesIO(self.payload), 'bucket', 'key')
+            second = data_load.bulk_index_doc_element(io.BytesIO(self.payload), 'bucket', 'key')
+            third = data_load.bulk_index_doc_element(io.BytesIO(changed), 'bucket', 'key')
+
+        self.assertEqual((first['indexed'], first['added'], first['updated'], first['skipped']), (3, 3, 0, 0))
+        self.assertEqual((second['indexed'], second['added'], second['updated'], second['skipped']), (0, 0, 0, 3))
+        self.assertEqual((third['indexed'], third['added'], third['updated'], third['skipped']), (1, 0, 1, 2))
+        self.assertEqual(es_client.bulk.call_count, 2)
+        self.assertIn(b'Davina May', es_client.bulk.call_args_list[1][1]['body'])
+
+    def test_sqlite_fingerprints_put_get_and_delete(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store = data_load.SqliteFingerprints(tmp_dir + '/fp.sqlite')
+            store.put({'10000-1000000': 'a', '10001-1000001': 'b'})
+            self.assertEqual(store.get(['10000-1000000', '10001-1000001', 'missing']),
+                             {'10000-1000000': 'a', '10001-1000001': 'b'})
+            store.delete(['10000-1000000'])
+            self.assertEqual(store.get(['10000-1000000', '10001-1000001']), {'10001-1000001': 'b'})
+
+    def test_suggestions_are_written_per_value_after_the_workspaces(self):
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'ES_SUGGESTION_INDEX', 'workspace_suggestions'):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            # The first workspace had nine values and the deleted one two when they were loaded before.
+            es_client.mget.return_value = {'docs': [
+                {'_id': '10000-1000000:0', 'found': True, '_source': {'values': 9}},
+                {'_id': '10001-1000001:0', 'found': False},
+                {'_id': '10002-1000002:0', 'found': True, '_source': {'values': 7}},
+                {'_id': '1-2:0', 'found': True, '_source': {'values': 2}}]}
+            summary = data_load.bulk_index_doc_element(io.BytesIO(self.payload + b'\n{"delete":{"_id":"1-2"}}'),
+                                                       'bucket', 'key')
+
+        self.assertEqual(summary['indexed'], 4)
+        # Reference, number, jurisdiction, land identifier, address and two party names of each workspace.
+        self.assertEqual(summary['suggestions'], 21)
+        workspace_call, suggestion_call = es_client.bulk.call_args_list
+        self.assertEqual(suggestion_call[1]['index'], 'workspace_suggestions')
+        lines = suggestion_call[1]['body'].strip().split(b'\n')
+        deletes = [json.loads(line)['delete']['_id'] for line in lines if line.startswith(b'{"delete"')]
+        lines = [line for line in lines if not line.startswith(b'{"delete"')]
+        self.assertEqual(json.loads(lines[0]), {'index': {'_id': '10000-1000000:0'}})
+        self.assertEqual(json.loads(lines[1]), {
+            'doc_id': '10000-1000000', 'field': 'subscriberRef', 'value': 'in-prop-1', 'position': 0, 'values': 7,
+            'workspace': {'id': 10000, 'status': 'ACTIVE', 'workgroups': [1086]},
+            'participant': {'id': 1000000, 'status': 'ACTIVE', 'subscriberId': 4281}})
+        self.assertEqual([json.loads(line)['field'] for line in lines[1:14:2]],
+                         ['subscriberRef', 'workspaceNumber', 'jurisdiction', 'landIdentifier', 'address',
+                          'partyName', 'partyName'])
+        # Only the positions past the new count of each workspace are deleted, by id in the same bulk request.
+        self.assertEqual(es_client.mget.call_args[1]['body']['docs'][0], {'_id': '10000-1000000:0',
+                                                                          '_source': ['values']})
+        self.assertEqual(deletes, ['10000-1000000:7', '10000-1000000:8', '1-2:0', '1-2:1'])
+        es_client.delete_by_query.assert_not_called()
+        self.assertIsNot(data_load.SUGGESTION_INDEX_MAPPING['settings']['index'],
+                         data_load.INDEX_MAPPING['settings']['index'])
+
+    def test_rejected_suggestions_are_retried_dead_lettered_and_loaded_again(self):
+        suggestion_bodies = []
+        uploaded = {}
+
+        def bulk(body, index, **kwargs):
+            if index == 'workspace':
+                return {'errors': False, 'items': []}
+            suggestion_bodies.append(body)
+            ids = [json.loads(line)['index']['_id'] for line in body.split(b'\n') if line.startswith(b'{"index"')]
+            items = [{'index': {'_id': suggestion_id, 'status': 201}} for suggestion_id in ids]
+            if len(suggestion_bodies) == 1:
+                items[0]['index'].update(status=429, error={'type': 'es_rejected_execution_exception'})
+                items[1]['index'].update(status=400, error={'type': 'mapper_parsing_exception'})
+            return {'errors': any('error' in item['index'] for item in items), 'items': items}
+
+        def upload_fileobj(fileobj, bucket, key):
+            uploaded[key] = fileobj.read()
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load, 'fingerprints', data_load.SqliteFingerprints(tmp_dir + '/fp.sqlite')), \
+                mock.patch.object(data_load, 'ES_SUGGESTION_INDEX', 'workspace_suggestions'), \
+                mock.patch.object(data_load.time, 'sleep'):
+            es_client.bulk.side_effect = bulk
+            es_client.mget.return_value = {'docs': []}
+            s3.upload_fileobj.side_effect = upload_fileobj
+            first = data_load.bulk_index_doc_element(io.BytesIO(self.payload), 'bucket', 'key')
+            second = data_load.bulk_index_doc_element(io.BytesIO(self.payload), 'bucket', 'key')
+
+        self.assertEqual((first['suggestions'], first['suggestions_retried'], first['suggestions_failed']), (20, 1, 1))
+        self.assertEqual(first['failed'], 1)
+        self.assertEqual(suggestion_bodies[1].count(b'{"index"'), 1)
+        self.assertIn(b'"_id": "10000-1000000:0"', suggestion_bodies[1])
+        dead_letter = json.loads(uploaded['key.dead-letter.ndjson'])
+        self.assertEqual(dead_letter['action'], {'index': {'_id': '10000-1000000:1'}})
+        # The workspace with the rejected suggestion is not fingerprinted, so the next load writes it again.
+        self.assertEqual((second['indexed'], second['skipped'], second['suggestions']), (1, 2, 7))
+        self.assertIn(b'"_id": "10000-1000000:1"', suggestion_bodies[2])
+
+    def test_suggestions_of_partial_updates_are_built_from_the_merged_workspace(self):
+        merged = json.loads(self.payload.split(b'\n')[1])
+        merged['workspace']['status'] = 'CLOSED'
+
+        def mget(body, index, **kwargs):
+            if index == 'workspace':
+                return {'docs': [{'_id': '10000-1000000', 'found': True, '_source': merged}]}
+            return {'docs': []}
+
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'ES_SUGGESTION_INDEX', 'workspace_suggestions'):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            es_client.mget.side_effect = mget
+            summary = data_load.bulk_index_doc_element(
+                io.BytesIO(b'{"update":{"_id":"10000-1000000"}}\n{"doc":{"workspace":{"status":"CLOSED"}}}'),
+                'bucket', 'key')
+
+        self.assertEqual(summary['suggestions'], 7)
+        self.assertEqual(es_client.mget.call_args_list[0], mock.call(body={'ids': ['10000-1000000']},
+                                                                     index='workspace', doc_type=data_load.ES_DOC_TYPE))
+        lines = es_client.bulk.call_args_list[1][1]['body'].strip().split(b'\n')
+        self.assertEqual({json.loads(line)['workspace']['status'] for line in lines[1::2]}, {'CLOSED'})
+
+    def test_rebuild_swaps_the_suggestion_alias_with_the_workspace_alias(self):
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'ES_SUGGESTION_INDEX', 'workspace_suggestions'):
+            es_client.indices.exists_alias.side_effect = [True, False]
+            es_client.indices.exists.return_value = True
+            es_client.indices.get_alias.side_effect = [{'workspace_v1500000000': {'aliases': {'workspace': {}}}}, {}]
+            data_load.finish_rebuild('workspace_v1559278164')
+        self.assertEqual(es_client.indices.refresh.call_args_list,
+                         [mock.call('workspace_v1559278164'), mock.call('workspace_suggestions_v1559278164')])
+        es_client.indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'remove': {'index': 'workspace_v1500000000', 'alias': 'workspace'}},
+            {'add': {'index': 'workspace_v1559278164', 'alias': 'workspace'}},
+            {'remove_index': {'index': 'workspace_suggestions'}},
+            {'add': {'index': 'workspace_suggestions_v1559278164', 'alias': 'workspace_suggestions'}}]})
+
+    def test_rebuild_loads_into_versioned_index_and_swaps_alias(self):
+        event = {'rebuild': {'bucket': 'bucket', 'keys': ['workspaces.txt']}}
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load, 'ES_REBUILD_DELETE_OLD', 'True'), \
+                mock.patch.object(data_load.time, 'time', return_value=1559278164.123):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            es_client.indices.exists_alias.return_value = True
+            es_client.indices.get_alias.return_value = {'workspace_v1500000000': {'aliases': {'workspace': {}}}}
+            s3.get_object.return_value = {'Body': io.BytesIO(self.payload)}
+            res = data_load.lambda_handler(event, None)
+
+        self.assertEqual((res['rebuild']['index'], res['rebuild']['swapped']), ('workspace_v1559278164123', True))
+        self.assertEqual(res['rebuild']['results']['workspaces.txt']['indexed'], 3)
+        create_args = es_client.indices.create.call_args
+        self.assertEqual(create_args[0][0], 'workspace_v1559278164123')
+        self.assertEqual(create_args[1]['body']['settings']['index']['refresh_interval'], '-1')
+        self.assertEqual(create_args[1]['body']['settings']['index']['number_of_replicas'], 0)
+        self.assertNotIn('refresh_interval', data_load.INDEX_MAPPING['settings']['index'])
+        self.assertEqual(es_client.bulk.call_args[1]['index'], 'workspace_v1559278164123')
+        es_client.indices.put_settings.assert_called_once_with(
+            body={'index': {'refresh_interval': '1s', 'number_of_replicas': 1}}, index='workspace_v1559278164123')
+        es_client.indices.forcemerge.assert_called_once()
+        es_client.indices.update_aliases.assert_called_once_with(body={'actions': [
+            {'remove': {'index': 'workspace_v1500000000', 'alias': 'workspace'}},
+            {'add': {'index': 'workspace_v1559278164123', 'alias': 'workspace'}}]})
+        es_client.indices.delete.assert_called_once_with('workspace_v1500000000')
+
+    def test_rebuild_reads_its_keys_from_a_manifest_and_keeps_the_old_index(self):
+        event = {'rebuild': {'bucket': 'bucket', 'manifest': 'rebuild/manifest.txt'}}
+
+        def get_object(Bucket, Key):
+            return {'Body': io.BytesIO(b'first.txt\n\nsecond.txt\n' if Key == 'rebuild/manifest.txt' else self.payload)}
+
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3:
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            es_client.indices.exists_alias.return_value = True
+            es_client.indices.get_alias.return_value = {'workspace_v1500000000': {'aliases': {'workspace': {}}}}
+            s3.get_object.side_effect = get_object
+            res = data_load.lambda_handler(event, None)
+
+        self.assertTrue(res['rebuild']['swapped'])
+        self.assertEqual(sorted(res['rebuild']['results']), ['first.txt', 'second.txt'])
+        es_client.indices.update_aliases.assert_called_once()
+        es_client.indices.delete.assert_not_called()
+
+    def test_rebuild_never_swaps_to_an_index_without_documents(self):
+        event = {'rebuild': {'bucket': 'bucket', 'keys': ['key.txt.dead-letter.ndjson']}}
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3'):
+            res = data_load.lambda_handler(event, None)
+        self.assertFalse(res['rebuild']['swapped'])
+
+        event = {'rebuild': {'bucket': 'bucket', 'keys': ['empty.txt']}}
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3:
+            s3.get_object.return_value = {'Body': io.BytesIO(b'')}
+            res = data_load.lambda_handler(event, None)
+        self.assertFalse(res['rebuild']['swapped'])
+        self.assertEqual(res['rebuild']['results']['empty.txt']['indexed'], 0)
+        es_client.indices.update_aliases.assert_not_called()
+
+    def test_rebuild_reports_a_failed_start(self):
+        event = {'rebuild': {'bucket': 'bucket', 'keys': ['workspaces.txt']}}
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3:
+            es_client.indices.create.side_effect = Exception('resource_already_exists_exception')
+            res = data_load.lambda_handler(event, None)
+        self.assertEqual(res, {'rebuild': {'index': None, 'swapped': False,
+                                           'error': 'resource_already_exists_exception'}})
+        s3.get_object.assert_not_called()
+
+    def test_s3_events_never_rebuild(self):
+        event = {'Records': [s3_record('bucket', 'workspaces.txt')]}
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3:
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            s3.get_object.return_value = {'Body': io.BytesIO(self.payload)}
+            res = data_load.lambda_handler(event, None)
+        self.assertEqual(list(res), ['results'])
+        self.assertEqual(es_client.bulk.call_args[1]['index'], 'workspace')
+        es_client.indices.create.assert_not_called()
+
+    def test_subscriber_aliases_are_created_and_moved_by_a_rebuild(self):
+        alias_filter = data_load.subscriber_filter(4281)
+        with mock.patch.object(data_load, 'ES_SUBSCRIBER_ALIAS', 'workspace_subscriber_{}'), \
+                mock.patch.object(data_load, 'es_client') as es_client:
+            res = data_load.lambda_handler({'subscriber_aliases': [4281]}, None)
+            es_client.indices.update_aliases.assert_called_once_with(body={'actions': [
+                {'add': {'index': 'workspace', 'alias': 'workspace_subscriber_4281', 'filter': alias_filter}}]})
+
+            es_client.indices.exists_alias.return_value = True
+            es_client.indices.get_alias.side_effect = [
+                {'workspace_v1500000000': {'aliases': {'workspace': {}}}},
+                {'workspace_v1500000000': {'aliases': {'workspace_subscriber_4281': {'filter': alias_filter}}}}]
+            data_load.finish_rebuild('workspace_v1559278164')
+        self.assertEqual(res, {'subscriber_aliases': ['workspace_subscriber_4281']})
+        self.assertEqual(es_client.indices.update_aliases.call_args, mock.call(body={'actions': [
+            {'remove': {'index': 'workspace_v1500000000', 'alias': 'workspace_subscriber_4281'}},
+            {'add': {'index': 'workspace_v1559278164', 'alias': 'workspace_subscriber_4281', 'filter': alias_filter}},
+            {'remove': {'index': 'workspace_v1500000000', 'alias': 'workspace'}},
+            {'add': {'index': 'workspace_v1559278164', 'alias': 'workspace'}}]}))
+
+    def test_rebuild_keeps_alias_when_a_file_fails(self):
+        event = {'rebuild': {'bucket': 'bucket', 'keys': ['workspaces.txt', 'missing.txt']}}
+
+        def get_object(Bucket, Key):
+            if Key == 'missing.txt':
+                raise Exception('NoSuchKey')
+            return {'Body': io.BytesIO(self.payload)}
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load, 'fingerprints', data_load.SqliteFingerprints(tmp_dir + '/fp.sqlite')):
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            es_client.indices.exists_alias.return_value = False
+            s3.get_object.side_effect = get_object
+            res = data_load.lambda_handler(event, None)
+            self.assertEqual(es_client.bulk.call_count, 1)
+            # The rebuild wrote no fingerprints, so the live index still gets every document of the next load.
+            summary = data_load.load_s3_object('bucket', 'workspaces.txt')
+        self.assertFalse(res['rebuild']['swapped'])
+        self.assertEqual(res['rebuild']['results']['missing.txt'], {'error': 'NoSuchKey'})
+        es_client.indices.update_aliases.assert_not_called()
+        es_client.indices.delete.assert_called_once_with(res['rebuild']['index'], ignore=404)
+        self.assertEqual((summary['indexed'], summary['skipped']), (3, 0))
+        self.assertEqual(es_client.bulk.call_args[1]['index'], 'workspace')
+
+    def test_rebuild_clears_fingerprints_after_the_swap_and_removes_abandoned_rebuilds(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'fingerprints', data_load.SqliteFingerprints(tmp_dir + '/fp.sqlite')):
+            data_load.fingerprints.put({'10000-1000000': 'a'})
+            es_client.indices.get_settings.return_value = {
+                'workspace_v1500000000000': {'settings': {'index': {'refresh_interval': '-1'}}},
+                'workspace_v1400000000000': {'settings': {'index': {'refresh_interval': '1s'}}}}
+            es_client.indices.exists_alias.return_value = False
+            index_name = data_load.start_rebuild()
+            es_client.indices.delete.assert_called_once_with('workspace_v1500000000000', ignore=404)
+            self.assertEqual(data_load.fingerprints.get(['10000-1000000']), {'10000-1000000': 'a'})
+            data_load.finish_rebuild(index_name)
+            self.assertEqual(data_load.fingerprints.get(['10000-1000000']), {})
+
+    def test_import_does_not_load_clients(self):
+        code = 'import sys; import search_lambda.data_load.data_load; ' \
+               'print(sorted(m for m in ("boto3", "elasticsearch", "requests") if m in sys.modules))'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=path.join(basepath, '..', '..', '..'))
+        self.assertEqual(output.strip(), b'[]')
+
+    def test_get_es_client_bootstraps_once(self):
+        with mock.patch.object(data_load, 'es_client', None), \
+                mock.patch.object(data_load, 'create_es_client') as create_es_client:
+            client = create_es_client.return_value
+            client.indices.exists.return_value = False
+            self.assertIs(data_load.get_es_client(), client)
+            self.assertIs(data_load.get_es_client(), client)
+        create_es_client.assert_called_once_with()
+        client.indices.create.assert_called_once_with('workspace', body=data_load.INDEX_MAPPING)
+
+    def test_get_es_client_clears_fingerprints_when_it_creates_the_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(data_load, 'es_client', None), \
+                mock.patch.object(data_load, 'fingerprints', None), \
+                mock.patch.object(data_load, 'ES_INCREMENTAL', 'True'), \
+                mock.patch.object(data_load, 'FINGERPRINT_STORE', 'sqlite'), \
+                mock.patch.object(data_load, 'FINGERPRINT_SQLITE_PATH', tmp_dir + '/fp.sqlite'), \
+                mock.patch.object(data_load, 'create_es_client') as create_es_client:
+            data_load.SqliteFingerprints(tmp_dir + '/fp.sqlite').put({'10000-1000000': 'a'})
+            create_es_client.return_value.indices.exists.return_value = False
+            data_load.get_es_client()
+            self.assertEqual(data_load.fingerprints.get(['10000-1000000']), {})
+
+    def test_get_es_client_retries_after_failed_bootstrap(self):
+        with mock.patch.object(data_load, 'es_client', None), \
+                mock.patch.object(data_load, 'create_es_client') as create_es_client:
+            create_es_client.return_value.indices.exists.side_effect = [Exception('ConnectTimeout'), True]
+            with self.assertRaises(Exception):
+                data_load.get_es_client()
+            self.assertIs(data_load.get_es_client(), create_es_client.return_value)
+
+    def test_lambda_handler_skips_dead_letter_objects(self):
+        event = {'Records': [s3_record('bucket', 'key.txt.dead-letter.ndjson')]}
+        with mock.patch.object(data_load, 'es_client'), \
+                mock.patch.object(data_load, 's3') as s3:
+            res = data_load.lambda_handler(event, None)
+        self.assertEqual(res, {'results': {'key.txt.dead-letter.ndjson': {'skipped': True}}})
+        s3.get_object.assert_not_called()
+
+    def test_lambda_handler_loads_every_record(self):
+        event = {'Records': [s3_record('bucket', 'first+file.txt'), s3_record('bucket', 'missing.txt'),
+                             s3_record('bucket', 'second.txt')]}
+
+        def get_object(Bucket, Key):
+            if Key == 'missing.txt':
+                raise Exception('NoSuchKey')
+            return {'Body': io.BytesIO(self.payload)}
+
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3:
+            es_client.bulk.return_value = {'errors': False, 'items': []}
+            s3.get_object.side_effect = get_object
+            res = data_load.lambda_handler(event, None)
+
+        self.assertEqual(res['results']['first file.txt']['indexed'], 3)
+        self.assertEqual(res['results']['second.txt']['indexed'], 3)
+        self.assertEqual(res['results']['missing.txt'], {'error': 'NoSuchKey'})
+
+    def test_lambda_handler_writes_stage_timings_as_emf(self):
+        event = {'Records': [s3_record('bucket', 'file.txt')]}
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 's3') as s3, \
+                mock.patch.object(data_load, 'METRICS_ENABLED', 'True'), \
+                mock.patch.object(data_load.sys, 'stdout', new_callable=io.StringIO) as stdout:
+            es_client.bulk.return_value = {'took': 7, 'errors': False, 'items': []}
+            s3.get_object.return_value = {'Body': io.BytesIO(self.payload), 'ContentLength': len(self.payload)}
+            res = data_load.lambda_handler(event, None)
+
+        result = res['results']['file.txt']
+        for name in ('s3_get_ms', 's3_read_ms', 'batch_ms', 'wait_ms', 'bulk_ms', 'total_ms'):
+            self.assertIn(name, result)
+        self.assertEqual(result['es_took_ms'], 7 * result['bulk_requests'])
+        line = json.loads(stdout.getvalue())
+        self.assertEqual(line['_aws']['CloudWatchMetrics'][0]['Namespace'], data_load.METRICS_NAMESPACE)
+        self.assertEqual(line['key'], 'file.txt')
+        self.assertEqual(line['indexed'], 3)
+        units = {metric['Name']: metric['Unit'] for metric in line['_aws']['CloudWatchMetrics'][0]['Metrics']}
+        self.assertEqual(units['bulk_ms'], 'Milliseconds')
+        self.assertEqual(units['bulk_bytes'], 'Bytes')
+        self.assertEqual(units['docs_per_sec'], 'Count/Second')
+
+    def test_send_bulk_backs_off_on_rejection(self):
+        batch_size = data_load.AdaptiveBatchSize(100, 10, 1000, 1.0)
+        rejected = TransportError(429, 'es_rejected_execution_exception', {})
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load.time, 'sleep') as sleep:
+            es_client.bulk.side_effect = [rejected, rejected, {'errors': False, 'items': []}]
+            data_load.send_bulk(b'{}\n', batch_size)
+        self.assertEqual(es_client.bulk.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertLess(batch_size.get(), 100)
+
+    def test_send_bulk_raises_when_retries_exhausted(self):
+        batch_size = data_load.AdaptiveBatchSize(100, 10, 1000, 1.0)
+        with mock.patch.object(data_load, 'es_client') as es_client, \
+                mock.patch.object(data_load, 'ES_BULK_MAX_RETRIES', '1'), \
+                mock.patch.object(data_load.time, 'sleep'):
+            es_client.bulk.side_effect = TransportError(429, 'es_rejected_execution_exception', {})
+            with self.assertRaises(TransportError):
+                data_load.send_bulk(b'{}\n', batch_size)
+        self.assertEqual(es_client.bulk.call_count, 2)
+
+    def test_adaptive_batch_size_follows_latency(self):
+        batch_size = data_load.AdaptiveBatchSize(100, 10, 120, 1.0)
+        batch_size.record_latency(0.1)
+        self.assertEqual(batch_size.get(), 120)
+        batch_size.record_latency(4.0)
+        self.assertEqual(batch_size.get(), 60)
+        batch_size.record_latency(0.8)
+        self.assertEqual(batch_size.get(), 60)
+
+
+def s3_record(bucket_name, file_key):
+    return {'s3': {'bucket': {'name': bucket_name}, 'object': {'key': file_key}}}
+
 
-        print ('to be implemented')
+def ranged_get_object(payload):
+    def get_object(Bucket, Key, Range=None):
+        start = int(Range[len('bytes='):-1]) if Range else 0
+        return {'Body': io.BytesIO(payload[start:]), 'ContentLength': len(payload) - start}
+    return get_object
 
 
 if __name__ == '__main__':
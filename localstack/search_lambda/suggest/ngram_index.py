@@ -0,0 +1,383 @@
+"""
+Embedded n-gram suggest index, an offline alternative to Elastic search for local development, tests and
+small single tenant deployments.
+
+The index is built from the same bulk NDJSON data_load consumes and written to one file, which is memory
+mapped when it is opened. It answers the suggest query search_suggest builds with a response in the shape
+Elastic search gives, so result shaping, cursors and the result cache work the same on either engine.
+Build it from the localstack directory:
+
+    python -m search_lambda.suggest.ngram_index es/workspaces-10000-10002.txt --out /tmp/workspace.ngram
+
+Values are analyzed like the ngram_analyzer of es/doc_mapping.json, lowercased, ascii folded and trimmed
+into 3-grams, and a match with the and operator needs every gram of the query in one value. Every clause
+runs in filter context, like the suggest query, so all hits score 0. A matched value is highlighted whole,
+as Elastic search does for a keyword tokenized ngram field.
+"""
+import argparse
+import bisect
+import gzip
+import json
+import mmap
+import struct
+import sys
+import time
+import unicodedata
+from array import array
+
+MAGIC = b'SUGNGRAM'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sQ')
+GRAM_SIZE = 3
+
+NGRAM_SUFFIX = '.ngram'
+KEYWORD_SUFFIX = '.keyword'
+# Fields matched on their ngram subfield, nested paths keep the position of each object for inner hits.
+SEARCH_FIELDS = ['propertys.address', 'propertys.landIdentifier', 'propertys.lotInUnregisteredPlan',
+                 'parties.name', 'parties.titlePartyFullName',
+                 'participant.reference', 'workspace.number', 'workspace.jurisdiction']
+NESTED_PATHS = ('propertys', 'parties')
+# Fields of the term and terms filters, matched on their exact value.
+KEYWORD_FIELDS = ['workspace.status', 'participant.status', 'participant.subscriberId', 'workspace.workgroups']
+# Documents are numbered in this order, the tiebreak of the suggest sort.
+SORT_FIELDS = ['workspace.id', 'participant.id']
+# Elastic search returns this many inner hits when the query does not say.
+INNER_HITS_SIZE = 3
+
+
+def analyze(value):
+    # lowercase, asciifolding and trim of the ngram_analyzer.
+    folded = unicodedata.normalize('NFKD', str(value).lower())
+    return ''.join(char for char in folded if not unicodedata.combining(char)).strip()
+
+
+def grams(text):
+    return {text[start:start + GRAM_SIZE] for start in range(len(text) - GRAM_SIZE + 1)}
+
+
+def field_values(document, field):
+    # (object position, value) pairs of a field, fields outside the nested paths are at position 0.
+    path, name = field.split('.', 1)
+    section = document.get(path)
+    if isinstance(section, dict):
+        section = [section]
+    values = []
+    for ordinal, item in enumerate(section or []):
+        value = item.get(name) if isinstance(item, dict) else None
+        for single in value if isinstance(value, list) else [value]:
+            if single is not None and single != '':
+                values.append((ordinal, single))
+    return values
+
+
+def sort_key(document):
+    return tuple(next((value for ordinal, value in field_values(document, field)), 0) for field in SORT_FIELDS)
+
+
+def iter_bulk_documents(lines):
+    # Yields (action, _id, source) of bulk NDJSON, delete actions have no source line.
+    lines = (line for line in lines if line.strip())
+    for line in lines:
+        action, meta = next(iter(json.loads(line).items()))
+        source = None if action == 'delete' else json.loads(next(lines))
+        yield action, meta.get('_id'), source
+
+
+def load_documents(lines):
+    # Later actions on an _id replace earlier ones, as they would in the index.
+    documents = {}
+    for position, (action, doc_id, source) in enumerate(iter_bulk_documents(lines)):
+        doc_id = doc_id if doc_id is not None else '_{}'.format(position)
+        if action == 'delete':
+            documents.pop(doc_id, None)
+        elif action == 'update':
+            documents.setdefault(doc_id, {}).update(source.get('doc', {}))
+        else:
+            documents[doc_id] = source
+    return documents
+
+
+def build_index(lines, file_name):
+    # The documents are held in memory while the index is built, the postings are written sorted.
+    documents = sorted(load_documents(lines).values(), key=sort_key)
+    sections = {
+        'sort_values': array('q'),
+        'doc_values': array('I', [0]),
+        'value_doc': array('I'),
+        'value_field': array('B'),
+        'value_ordinal': array('H'),
+        'value_ends': array('Q'),
+        'postings': array('I'),
+        'keyword_postings': array('I')
+    }
+    strings = bytearray()
+    gram_postings = {field: {} for field in SEARCH_FIELDS}
+    keyword_postings = {field: {} for field in KEYWORD_FIELDS}
+    for doc in range(len(documents)):
+        document = documents[doc]
+        sections['sort_values'].extend(sort_key(document))
+        for field_index, field in enumerate(SEARCH_FIELDS):
+            for ordinal, value in field_values(document, field):
+                value_id = len(sections['value_doc'])
+                sections['value_doc'].append(doc)
+                sections['value_field'].append(field_index)
+                sections['value_ordinal'].append(ordinal)
+                strings += str(value).encode('utf-8')
+                sections['value_ends'].append(len(strings))
+                for gram in grams(analyze(value)):
+                    gram_postings[field].setdefault(gram, array('I')).append(value_id)
+        sections['doc_values'].append(len(sections['value_doc']))
+        for field in KEYWORD_FIELDS:
+            for value in {str(value) for ordinal, value in field_values(document, field)}:
+                keyword_postings[field].setdefault(value, array('I')).append(doc)
+
+    meta = {'version': FORMAT_VERSION, 'byteorder': sys.byteorder, 'docs': len(documents),
+            'fields': SEARCH_FIELDS, 'grams': {}, 'keywords': {}, 'sections': {}}
+    for field, postings in gram_postings.items():
+        meta['grams'][field] = {gram: append_postings(sections['postings'], postings[gram])
+                                for gram in sorted(postings)}
+    for field, postings in keyword_postings.items():
+        meta['keywords'][field] = {value: append_postings(sections['keyword_postings'], postings[value])
+                                   for value in sorted(postings)}
+    sections['strings'] = array('B', strings)
+
+    offset = 0
+    for name, values in sections.items():
+        meta['sections'][name] = [values.typecode, offset, len(values) * values.itemsize]
+        offset = aligned(offset + len(values) * values.itemsize)
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+    with open(file_name, 'wb') as index_file:
+        index_file.write(HEADER.pack(MAGIC, len(meta_bytes)) + meta_bytes)
+        index_file.write(b'\0' * (aligned(HEADER.size + len(meta_bytes)) - HEADER.size - len(meta_bytes)))
+        for name, values in sections.items():
+            data = values.tobytes()
+            index_file.write(data + b'\0' * (aligned(len(data)) - len(data)))
+    return len(documents)
+
+
+def append_postings(target, postings):
+    start = len(target)
+    target.extend(postings)
+    return [start, len(postings)]
+
+
+def aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+class NgramIndex(object):
+    """
+    Read only view of an index file, the postings and values are read from the memory map as needed.
+    """
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as index_file:
+            self._mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError('{} is not a suggest ngram index'.format(file_name))
+        meta = json.loads(self._mmap[HEADER.size:HEADER.size + meta_length].decode('utf-8'))
+        if meta['version'] != FORMAT_VERSION or meta['byteorder'] != sys.byteorder:
+            raise ValueError('{} was built by another version or platform, build it again'.format(file_name))
+        self.docs = meta['docs']
+        self.fields = {field: field_index for field_index, field in enumerate(meta['fields'])}
+        self.grams = meta['grams']
+        self.keywords = meta['keywords']
+        data_start = aligned(HEADER.size + meta_length)
+        view = memoryview(self._mmap)
+        for name, (typecode, offset, length) in meta['sections'].items():
+            setattr(self, name, view[data_start + offset:data_start + offset + length].cast(typecode))
+
+    def search(self, query):
+        # Runs a suggest search body, returning the response Elastic search would give for it.
+        started = time.perf_counter()
+        matched = sorted(self._included(query.get('query', {'match_all': {}})))
+        start = int(query.get('from', 0))
+        if query.get('search_after') is not None:
+            # Hits all score 0 and documents are numbered in tiebreak order, so the cursor is a document number.
+            start = bisect.bisect_left(matched, self._first_after(tuple(query['search_after'][1:])))
+        page = matched[start:start + int(query.get('size', 10))]
+        matches = list(iter_matches(query.get('query', {})))
+        highlight_fields = set(query.get('highlight', {}).get('fields', {}))
+        hits = [self._hit(doc, matches, highlight_fields) for doc in page]
+        return {'took': int((time.perf_counter() - started) * 1000), 'timed_out': False,
+                'hits': {'total': len(matched), 'hits': hits}}
+
+    def _sort_values(self, doc):
+        return tuple(self.sort_values[doc * len(SORT_FIELDS):(doc + 1) * len(SORT_FIELDS)])
+
+    def _first_after(self, sort_values):
+        low, high = 0, self.docs
+        while low < high:
+            middle = (low + high) // 2
+            if self._sort_values(middle) <= sort_values:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _included(self, clause):
+        docs, negated = self._docs(clause)
+        return set(range(self.docs)) - docs if negated else docs
+
+    def _docs(self, clause):
+        # Returns (docs, negated), a negated set holds the documents the clause does not match.
+        kind, body = next(iter(clause.items()))
+        if kind == 'bool':
+            return self._bool_docs(body)
+        if kind == 'nested':
+            return self._docs(body['query'])
+        if kind == 'match':
+            field, spec = next(iter(body.items()))
+            return {self.value_doc[value_id] for value_id in self._match_values(field, spec)}, False
+        if kind in ('term', 'terms'):
+            field, values = next(iter(body.items()))
+            return self._keyword_docs(field, values if kind == 'terms' else [values]), False
+        if kind == 'match_all':
+            return set(), True
+        raise ValueError('Unsupported query clause: {}'.format(kind))
+
+    def _bool_docs(self, body):
+        # Each clause narrows the included documents, or adds to the excluded ones when it is negated.
+        clauses = [self._docs(clause) for clause in as_list(body.get('filter')) + as_list(body.get('must'))]
+        clauses += [(docs, not negated) for docs, negated in map(self._docs, as_list(body.get('must_not')))]
+        should = as_list(body.get('should'))
+        if should and not body.get('filter') and not body.get('must'):
+            # Without filter or must clauses at least one should clause has to match.
+            clauses.append((set().union(*[self._included(clause) for clause in should]), False))
+        included = None
+        excluded = set()
+        for docs, negated in clauses:
+            if negated:
+                excluded |= docs
+            else:
+                included = docs if included is None else included & docs
+        if included is None:
+            return excluded, True
+        return included - excluded, False
+
+    def _match_values(self, field, spec):
+        spec = spec if isinstance(spec, dict) else {'query': spec}
+        field = field[:-len(NGRAM_SUFFIX)] if field.endswith(NGRAM_SUFFIX) else field
+        field_grams = self.grams.get(field, {})
+        postings = [self.postings[start:start + count] for start, count in
+                    (field_grams.get(gram, (0, 0)) for gram in grams(analyze(spec['query'])))]
+        if not postings:
+            return set()
+        if spec.get('operator', 'or').lower() != 'and':
+            return set().union(*postings)
+        # Rarest gram first, so the candidate set only shrinks from the smallest posting list.
+        postings.sort(key=len)
+        values = set(postings[0])
+        for posting in postings[1:]:
+            if not values:
+                break
+            values.intersection_update(posting)
+        return values
+
+    def _keyword_docs(self, field, values):
+        field = field[:-len(KEYWORD_SUFFIX)] if field.endswith(KEYWORD_SUFFIX) else field
+        field_values = self.keywords.get(field, {})
+        docs = set()
+        for value in values:
+            start, count = field_values.get(str(value), (0, 0))
+            docs.update(self.keyword_postings[start:start + count])
+        return docs
+
+    def _values(self, doc):
+        # {(field, object position): value} of one document.
+        values = {}
+        for value_id in range(self.doc_values[doc], self.doc_values[doc + 1]):
+            start = self.value_ends[value_id - 1] if value_id else 0
+            field = SEARCH_FIELDS[self.value_field[value_id]]
+            values[(field, self.value_ordinal[value_id])] = bytes(
+                self.strings[start:self.value_ends[value_id]]).decode('utf-8')
+        return values
+
+    def _hit(self, doc, matches, highlight_fields):
+        values = self._values(doc)
+        hit = {'_score': 0.0, 'sort': [0.0] + list(self._sort_values(doc))}
+        highlight = {}
+        inner_hits = {}
+        for path, inner_hits_spec, clauses in matches:
+            if path is None:
+                for field, spec in clauses:
+                    value = values.get((field, 0))
+                    if field + NGRAM_SUFFIX in highlight_fields and value is not None and value_matches(value, spec):
+                        highlight[field + NGRAM_SUFFIX] = ['<em>{}</em>'.format(value)]
+                continue
+            if inner_hits_spec is None:
+                continue
+            objects = {}
+            for field, spec in clauses:
+                for (value_field, ordinal), value in values.items():
+                    if value_field == field and value_matches(value, spec):
+                        objects.setdefault(ordinal, {})[field + NGRAM_SUFFIX] = ['<em>{}</em>'.format(value)]
+            fields = set(inner_hits_spec.get('highlight', {}).get('fields', {}))
+            inner_hits[path] = {'hits': {'total': len(objects), 'hits': [
+                {'highlight': {field: fragments for field, fragments in objects[ordinal].items() if field in fields}}
+                for ordinal in sorted(objects)[:int(inner_hits_spec.get('size', INNER_HITS_SIZE))]]}}
+        if highlight:
+            hit['highlight'] = highlight
+        if inner_hits:
+            hit['inner_hits'] = inner_hits
+        return hit
+
+    def close(self):
+        for name in ('sort_values', 'doc_values', 'value_doc', 'value_field', 'value_ordinal', 'value_ends',
+                     'postings', 'keyword_postings', 'strings'):
+            getattr(self, name).release()
+        self._mmap.close()
+
+
+def iter_matches(clause, path=None, inner_hits=None):
+    # Yields (nested path, inner hits, [(field, match spec)]) for the match clauses of a query.
+    kind, body = next(iter(clause.items()), (None, None))
+    if kind == 'bool':
+        for occur in ('filter', 'must', 'should'):
+            for child in as_list(body.get(occur)):
+                for match in iter_matches(child, path, inner_hits):
+                    yield match
+    elif kind == 'nested':
+        clauses = [clause for match in iter_matches(body['query'], body['path']) for clause in match[2]]
+        yield body['path'], body.get('inner_hits'), clauses
+    elif kind == 'match':
+        field, spec = next(iter(body.items()))
+        field = field[:-len(NGRAM_SUFFIX)] if field.endswith(NGRAM_SUFFIX) else field
+        yield path, inner_hits, [(field, spec if isinstance(spec, dict) else {'query': spec})]
+
+
+def value_matches(value, spec):
+    query_grams = grams(analyze(spec['query']))
+    value_grams = grams(analyze(value))
+    if spec.get('operator', 'or').lower() != 'and':
+        return bool(query_grams & value_grams)
+    return bool(query_grams) and query_grams <= value_grams
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def open_lines(file_name):
+    if file_name.endswith(('.gz', '.gzip')):
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='bulk NDJSON files, gzipped when they end in .gz')
+    parser.add_argument('--out', default='workspace.ngram')
+    args = parser.parse_args()
+
+    def iter_file_lines(file_names):
+        for file_name in file_names:
+            with open_lines(file_name) as lines:
+                for line in lines:
+                    yield line
+
+    docs = build_index(iter_file_lines(args.files), args.out)
+    sys.stdout.write('{} documents indexed into {}\n'.format(docs, args.out))
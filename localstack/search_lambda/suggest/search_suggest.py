@@ -1,9 +1,20 @@
+import base64
+import binascii
+import contextvars
 import json
 import logging
 import os
+import random
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
 from http import HTTPStatus
-from botocore.vendored import requests
 from urllib.parse import unquote_plus
+import requests
+from requests.adapters import HTTPAdapter
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.WARNING)
@@ -11,17 +22,58 @@ LOGGER.setLevel(logging.WARNING)
 SEARCH_PAGE_SIZE = os.getenv('SEARCH_PAGE_SIZE', '10')
 SEARCH_FROM = os.getenv('SEARCH_FROM', '0')
 SEARCH_MIN_LENGTH = os.getenv('SEARCH_MIN_LENGTH', '3')
+# Deeper pages than SEARCH_MAX_FROM are read with the cursor returned next to the results.
+SEARCH_MAX_FROM = os.getenv('SEARCH_MAX_FROM', '100')
 SEARCH_FIELD_DISPLAY_SIZE = os.getenv('SEARCH_FIELD_DISPLAY_SIZE', '150')
 SEARCH_FIELD_DISPLAY_FRAGMENTS = os.getenv(
     'SEARCH_FIELD_DISPLAY_FRAGMENTS', '10')
-HTTP_TIMEOUT = os.getenv('HTTP_TIMEOUT', '15')
+# Elastic search connections are kept alive in a pool shared by warm invocations.
+HTTP_CONNECT_TIMEOUT = os.getenv('HTTP_CONNECT_TIMEOUT', '3')
+HTTP_READ_TIMEOUT = os.getenv('HTTP_READ_TIMEOUT', os.getenv('HTTP_TIMEOUT', '15'))
+HTTP_POOL_MAXSIZE = os.getenv('HTTP_POOL_MAXSIZE', '10')
+# Shaped results are cached per query, route and profile for SUGGEST_CACHE_TTL seconds, so a document loaded in the
+# meantime can be missing from a cached result. The cache is off until SUGGEST_CACHE_SIZE is above 0.
+SUGGEST_CACHE_SIZE = os.getenv('SUGGEST_CACHE_SIZE', '0')
+SUGGEST_CACHE_TTL = os.getenv('SUGGEST_CACHE_TTL', '30')
+SUGGEST_CACHE_PREFIX_REUSE = os.getenv('SUGGEST_CACHE_PREFIX_REUSE', 'False')
+SUGGEST_CACHE_LOG_EVERY = os.getenv('SUGGEST_CACHE_LOG_EVERY', '100')
+# Prefix reuse matches cached values like the ngram tokenizer of the index, on grams of this size.
+NGRAM_SIZE = 3
+# Concurrent identical queries share one Elastic search call.
+SUGGEST_SINGLE_FLIGHT = os.getenv('SUGGEST_SINGLE_FLIGHT', 'True')
+# Inputs whose shape can only match some fields skip the query branches of the others.
+SUGGEST_ROUTING = os.getenv('SUGGEST_ROUTING', 'True')
+# Shorter numbers are ambiguous with street numbers and postcodes, so they run the full query.
+SUGGEST_ROUTE_NUMBER_MIN_DIGITS = os.getenv('SUGGEST_ROUTE_NUMBER_MIN_DIGITS', '6')
+# With a subscriber alias, e.g. workspace_subscriber_{}, each search goes to the filtered alias of its
+# subscriber, created by the data load lambda, and only sends the workgroup filter.
+SUGGEST_SUBSCRIBER_ALIAS = os.getenv('SUGGEST_SUBSCRIBER_ALIAS', '')
+# Stage timings and Elastic search figures of every request are written as CloudWatch embedded metric format lines.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'False')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'Search/Suggest')
+# A sample of the requests is sent with an Elastic search profile, which is logged with the query and stage timings
+# when the request is slower than SLOW_QUERY_MS. 0 turns it off.
+SLOW_QUERY_MS = os.getenv('SLOW_QUERY_MS', '0')
+SLOW_QUERY_SAMPLE_RATE = os.getenv('SLOW_QUERY_SAMPLE_RATE', '0.1')
+# A batch request runs up to SUGGEST_BATCH_MAX_QUERIES suggest queries in one _msearch.
+SUGGEST_BATCH_MAX_QUERIES = os.getenv('SUGGEST_BATCH_MAX_QUERIES', '10')
+# Suggest queries run on Elastic search, or with 'embedded' on an index file built by ngram_index, without a cluster.
+SUGGEST_ENGINE = os.getenv('SUGGEST_ENGINE', 'elasticsearch')
+SUGGEST_ENGINE_INDEX_PATH = os.getenv('SUGGEST_ENGINE_INDEX_PATH', 'workspace.ngram')
+# 'flattened' searches the suggestion index data_load writes with ES_SUGGESTION_INDEX, one document per value.
+SUGGEST_INDEX_MODE = os.getenv('SUGGEST_INDEX_MODE', 'nested')
+SUGGEST_SUGGESTION_INDEX = os.getenv('SUGGEST_SUGGESTION_INDEX', 'workspace_suggestions')
 ES_SCHEME = os.getenv('ES_SCHEME', 'http://')
 ES_HOST = os.getenv('ES_HOST', '172.17.0.2:4571')
 ES_INDEX = os.getenv('ES_INDEX', 'workspace')
 ES_URL = ES_SCHEME + ES_HOST + "/" + ES_INDEX + "/_search"
+ES_MSEARCH_URL = ES_SCHEME + ES_HOST + "/" + ES_INDEX + "/_msearch"
 
 LOG_PREFIX = '[Elastic Search][Suggestion]'
 
+# Suggest fields are matched and highlighted on their ngram subfield.
+SUGGEST_FIELD_SUFFIX = '.ngram'
+
 # Elastic search key, input request param filter key
 MATCHED_FIELDS = {
     "participant.reference": "subscriberRef",
@@ -34,14 +86,263 @@ MATCHED_FIELDS = {
 }
 
 
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(HTTP_POOL_MAXSIZE))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+SESSION = create_session()
+
+
+class SuggestCache(object):
+    """
+    Bounded LRU cache of shaped suggest results with a time to live, shared by warm invocations.
+    """
+
+    def __init__(self, max_size, ttl, log_every):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.log_every = log_every
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._log_stats()
+            return entry
+
+    def get_prefix(self, key):
+        # A complete result set of a shorter prefix holds every match of the longer query.
+        query = key[0]
+        with self._lock:
+            for length in range(len(query) - 1, int(SEARCH_MIN_LENGTH) - 1, -1):
+                entry = self._lookup((query[:length],) + key[1:])
+                if entry is not None and entry['complete']:
+                    self.prefix_hits += 1
+                    return entry
+        return None
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _lookup(self, key):
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires, entry = item
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _log_stats(self):
+        lookups = self.hits + self.misses
+        if self.log_every and lookups % self.log_every == 0:
+            LOGGER.warning('%s Cache hits: %s prefix hits: %s misses: %s evictions: %s size: %s', LOG_PREFIX,
+                           self.hits, self.prefix_hits, self.misses, self.evictions, len(self._entries))
+
+
+RESULT_CACHE = None
+if int(SUGGEST_CACHE_SIZE) > 0:
+    RESULT_CACHE = SuggestCache(int(SUGGEST_CACHE_SIZE), float(SUGGEST_CACHE_TTL), int(SUGGEST_CACHE_LOG_EVERY))
+
+
+class InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs one call per key at a time, callers arriving while it runs wait for it and share its result.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = InFlightCall()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            # Later callers start a new call, so nothing is shared once it has finished.
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+SINGLE_FLIGHT = SingleFlight()
+
+# Opened on the first embedded search and shared by every request after it.
+EMBEDDED_INDEX = None
+EMBEDDED_INDEX_LOCK = threading.Lock()
+
+
+class RequestMetrics(object):
+    """
+    Stage timings and Elastic search figures of one suggest request, written as one EMF log line.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.values = {}
+        self.properties = {}
+        self.query = None
+        self.profile = None
+        # Sampled up front, so the profile comes back with the query itself rather than from running it again.
+        self.sampled = float(SLOW_QUERY_MS) > 0 and random.random() < float(SLOW_QUERY_SAMPLE_RATE)
+
+    def stage(self, name):
+        return StageTimer(self, name + '_ms')
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def record_search(self, query, resp_json, response_bytes):
+        self.query = query
+        self.profile = resp_json.get('profile')
+        self.add('response_bytes', response_bytes)
+        self.add('es_took_ms', resp_json.get('took', 0))
+        self.add('es_timed_out', 1 if resp_json.get('timed_out') else 0)
+        self.add('hits', hits_total(resp_json.get('hits', {})))
+
+    def finish(self):
+        self.values['total_ms'] = (time.perf_counter() - self.started) * 1000
+        if self.sampled and self.query is not None and float(SLOW_QUERY_MS) <= self.values['total_ms']:
+            log_slow_query(self.query, self.values, self.profile)
+        sys.stdout.write(emf_line(METRICS_NAMESPACE, {'Function': 'search_suggest'}, self.values,
+                                  self.properties) + '\n')
+
+
+class StageTimer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.add(self.name, (time.perf_counter() - self.started) * 1000)
+
+
+class NullMetrics(object):
+    # Stands in when metrics are off, so instrumented code costs next to nothing.
+    sampled = False
+
+    @property
+    def properties(self):
+        # A new dict per use, so the writes of concurrent requests are dropped rather than shared.
+        return {}
+
+    def stage(self, name):
+        return NULL_STAGE
+
+    def add(self, name, value):
+        pass
+
+    def record_search(self, query, resp_json, response_bytes):
+        pass
+
+
+class NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_STAGE = NullStage()
+NULL_METRICS = NullMetrics()
+# Context local, so concurrent requests in threads or on an event loop each record their own.
+CURRENT_METRICS = contextvars.ContextVar('suggest_metrics', default=NULL_METRICS)
+
+
+def emf_line(namespace, dimensions, values, properties):
+    # Metric units follow the name suffix, the rest of the properties are logged alongside for queries.
+    metrics = [{'Name': name, 'Unit': 'Milliseconds' if name.endswith('_ms') else
+                'Bytes' if name.endswith('_bytes') else 'Count'} for name in values]
+    document = {'_aws': {'Timestamp': int(time.time() * 1000),
+                         'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [list(dimensions)],
+                                                'Metrics': metrics}]}}
+    document.update(properties)
+    document.update(dimensions)
+    document.update(values)
+    return json.dumps(document)
+
+
+def log_slow_query(query, values, profile):
+    LOGGER.warning('%s Slow query %.1fms timings: %s query: %s profile: %s', LOG_PREFIX, values['total_ms'],
+                   json.dumps(values, sort_keys=True), json.dumps(query), json.dumps(profile))
+
+
 def lambda_handler(event, context):
+    if not str2bool(METRICS_ENABLED):
+        return handle_event(event)
+    metrics = RequestMetrics()
+    token = CURRENT_METRICS.set(metrics)
+    try:
+        response = handle_event(event)
+        metrics.properties['statusCode'] = response['statusCode']
+        return response
+    finally:
+        CURRENT_METRICS.reset(token)
+        metrics.finish()
+
+
+def handle_event(event):
+    metrics = CURRENT_METRICS.get()
     try:
+        if event.get('body') and not event.get('queryStringParameters'):
+            with metrics.stage('validate'):
+                batch = get_batch_event_data(event)
+            metrics.properties['batch'] = len(batch)
+            LOGGER.info('%s %s %s', LOG_PREFIX, 'BATCH_EVENT_DATA:', batch)
+            return create_response(HTTPStatus.OK.value, json.dumps({'responses': batch_search(batch)}))
         if not event['queryStringParameters']:
             return create_response(HTTPStatus.OK.value, "UP")
-        event_data = get_event_data(event)
+        with metrics.stage('validate'):
+            event_data = get_event_data(event)
         LOGGER.info('%s %s %s', LOG_PREFIX, 'EVENT_DATA:', event_data)
-        query = build_suggest_search_query(event_data)
-        results = search(query)
+        results = cached_search(event_data)
         return create_response(HTTPStatus.OK.value, results)
     except ValidationError as err:
         return create_response(HTTPStatus.BAD_REQUEST.value, err.data)
@@ -63,17 +364,26 @@ def lambda_handler(event, context):
 
 
 def build_suggest_search_query(event_data):
+    # Only the query string, workgroups and paging change per request, the rest of the query is shared.
     profile_data = build_profile(
         event_data['subscriber_id'], event_data['work_groups'])
-    query = unquote_plus((event_data['q']).lower())
-    sanitized = ''
-    for character in query:
-        if needs_escaping(character):
-            sanitized += '\\%s' % character
-        else:
-            sanitized += character
+    query_string = unquote_plus((event_data['q']).lower())
+    route = classify_query(query_string)
+    CURRENT_METRICS.get().properties['route'] = route
+    if flattened_mode():
+        query = build_suggestion_query(event_data, profile_data, query_string, route)
+    else:
+        query = build_workspace_query(event_data, profile_data, query_string, route)
+    if event_data.get('search_after') is not None:
+        # search_after pages always start at the first hit after the cursor.
+        query['from'] = 0
+        query['search_after'] = event_data['search_after']
+    if LOGGER.isEnabledFor(logging.INFO):
+        LOGGER.info('%s ROUTE: %s %s', LOG_PREFIX, route, json.dumps(query, indent=2))
+    return query
 
-    query_string = '*' + sanitized + '*'
+
+def build_workspace_query(event_data, profile_data, query_string, route):
     query = {
         "size": event_data['page_size'],
         "from": event_data['from_record'],
@@ -82,241 +392,565 @@ def build_suggest_search_query(event_data):
                 "filter": [
                     {
                         "bool": {
-                            "should": [
-                                {
-                                    "nested": {
-                                        "path": "propertys",
-                                        "query": {
-                                            "bool": {
-                                                "should": [
-                                                    {
-                                                        "wildcard": {
-                                                            "propertys.address.keywordstring": query_string
-                                                        }
-                                                    },
-                                                    {
-                                                        "wildcard": {
-                                                            "propertys.landIdentifier.keywordstring": query_string
-                                                        }
-                                                    },
-                                                    {
-                                                        "wildcard": {
-                                                            "propertys.lotInUnregisteredPlan.keywordstring": query_string
-                                                        }
-                                                    }
-                                                ]
-                                            }
-                                        },
-                                        "inner_hits": {
-                                            "_source": "false",
-                                            "highlight": {
-                                                "fields": {
-                                                    "propertys.address.keywordstring": {
-                                                        "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                                                        "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                                                    },
-                                                    "propertys.landIdentifier.keywordstring": {
-                                                        "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                                                        "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                                                    },
-                                                    "propertys.lotInUnregisteredPlan.keywordstring": {
-                                                        "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                                                        "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                },
-                                {
-                                    "nested": {
-                                        "path": "parties",
-                                        "query": {
-                                            "bool": {
-                                                "should": [
-                                                    {
-                                                        "wildcard": {
-                                                            "parties.name.keywordstring": query_string
-                                                        }
-                                                    },
-                                                    {
-                                                        "wildcard": {
-                                                            "parties.titlePartyFullName.keywordstring": query_string
-                                                        }
-                                                    }
-                                                ]
-                                            }
-                                        },
-                                        "inner_hits": {
-                                            "_source": "false",
-                                            "highlight": {
-                                                "fields": {
-                                                    "parties.name.keywordstring": {
-                                                        "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                                                        "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                                                    },
-                                                    "parties.titlePartyFullName.keywordstring": {
-                                                        "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                                                        "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                },
-                                {
-                                    "bool": {
-                                        "should": [
-                                            {
-                                                "wildcard": {
-                                                    "participant.reference.keywordstring": query_string
-                                                }
-                                            },
-                                            {
-                                                "wildcard": {
-                                                    "workspace.number.keywordstring": query_string
-                                                }
-                                            },
-                                            {
-                                                "wildcard": {
-                                                    "workspace.jurisdiction.keywordstring": query_string
-                                                }
-                                            }
-                                        ]
-                                    }
-                                }
-                            ]
-                        }
-                    },
-                    {
-                        "query_string": {
-                            "query": "NOT ABANDONED",
-                            "fields": [
-                                "workspace.status"
-                            ]
-                        }
-                    },
-                    {
-                        "query_string": {
-                            "query": "ACTIVE",
-                            "fields": [
-                                "participant.status"
-                            ]
-                        }
-                    },
-                    {
-                        "bool": {
-                            "should": [{"term": {"workspace.workgroups": w}} for w in profile_data['workgroups']]
+                            "should": [build_route_query(path, fields, query_string)
+                                       for path, fields in SUGGEST_ROUTES[route]]
                         }
                     },
-                    {
-                        "bool": {
-                            "should": [
-                                {"term": {
-                                    "participant.subscriberId": profile_data['subscriber_id']}}
-                            ]
-                        }
-                    }
+                    {"terms": {"workspace.workgroups": profile_data['workgroups']}}
                 ]
             }
         },
-        "_source": "false",
-        "highlight": {
-            "fields": {
-                "participant.reference.keywordstring": {
-                    "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                    "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                },
-                "workspace.number.keywordstring": {
-                    "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                    "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                },
-                "workspace.jurisdiction.keywordstring": {
-                    "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
-                    "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
-                }
+        "sort": SEARCH_SORT,
+        "_source": False,
+        "highlight": WORKSPACE_HIGHLIGHT
+    }
+    if not subscriber_aliases():
+        query['query']['bool']['filter'] += subscriber_filters(profile_data['subscriber_id'])
+    return query
+
+
+def subscriber_filters(subscriber_id):
+    # The security filters a subscriber alias holds, for queries on the whole index.
+    return [
+        WORKSPACE_STATUS_FILTER,
+        PARTICIPANT_STATUS_FILTER,
+        {"term": {"participant.subscriberId": subscriber_id}}
+    ]
+
+
+def without_alias(query, subscriber_id):
+    # A copy of an alias query with the alias filters inline, so it can search ES_INDEX. The query is shared, so it
+    # is copied down to the filter list rather than changed.
+    filters = query['query']['bool']['filter'] + subscriber_filters(subscriber_id)
+    bool_query = dict(query['query']['bool'], filter=filters)
+    return dict(query, query=dict(query['query'], bool=bool_query))
+
+
+def build_suggestion_query(event_data, profile_data, query_string, route):
+    # Every suggestion document is one value, so the hit itself is the suggestion and nothing is nested.
+    query_filter = [
+        {"match": {SUGGESTION_VALUE_FIELD: {"query": query_string, "operator": "and"}}},
+        {"terms": {"workspace.workgroups": profile_data['workgroups']}},
+        WORKSPACE_STATUS_FILTER,
+        PARTICIPANT_STATUS_FILTER,
+        {"term": {"participant.subscriberId": profile_data['subscriber_id']}}
+    ]
+    if route != 'all':
+        query_filter.append({"terms": {"field": SUGGESTION_ROUTE_FIELDS[route]}})
+    return {
+        "size": event_data['page_size'],
+        "from": event_data['from_record'],
+        "query": {
+            "bool": {
+                "filter": query_filter
             }
+        },
+        "sort": SUGGESTION_SORT,
+        "_source": ["field"],
+        "highlight": SUGGESTION_HIGHLIGHT
+    }
+
+
+def flattened_mode():
+    # The embedded engine indexes whole workspaces, so it always runs the nested query.
+    return SUGGEST_INDEX_MODE.lower() == 'flattened' and not embedded_engine()
+
+
+def search_sort():
+    return SUGGESTION_SORT if flattened_mode() else SEARCH_SORT
+
+
+def classify_query(query_string):
+    # Picks the query branches the input can match by its shape, anything unclear runs all of them.
+    if not str2bool(SUGGEST_ROUTING):
+        return 'all'
+    if query_string.isdigit() and len(query_string) >= int(SUGGEST_ROUTE_NUMBER_MIN_DIGITS):
+        return 'number'
+    if LAND_IDENTIFIER_PATTERN.fullmatch(query_string):
+        return 'land_identifier'
+    if TEXT_PATTERN.fullmatch(query_string):
+        return 'text'
+    return 'all'
+
+
+def build_route_query(path, fields, query_string):
+    if path in NESTED_INNER_HITS:
+        return build_nested_query(path, fields, query_string)
+    return {
+        "bool": {
+            "should": build_match_queries(fields, query_string)
         }
     }
-    LOGGER.info('%s %s', LOG_PREFIX, json.dumps(query, indent=2))
-    return query
 
 
-def needs_escaping(character):
-    escape_chars = {
-        '\\': True, '+': True, '-': True, '!': True,
-        '(': True, ')': True, ':': True, '^': True,
-        '[': True, ']': True, '\"': True, '{': True,
-        '}': True, '~': True, '*': True, '?': True,
-        '|': True, '&': True, '/': True
+def build_nested_query(path, fields, query_string):
+    return {
+        "nested": {
+            "path": path,
+            "query": {
+                "bool": {
+                    "should": build_match_queries(fields, query_string)
+                }
+            },
+            "inner_hits": NESTED_INNER_HITS[path]
+        }
     }
-    return escape_chars.get(character, False)
 
 
-def search(query):
+def build_match_queries(fields, query_string):
+    return [{"match": {field + SUGGEST_FIELD_SUFFIX: {"query": query_string, "operator": "and"}}} for field in fields]
+
+
+def build_highlight(fields):
+    return {
+        "fields": {
+            field + SUGGEST_FIELD_SUFFIX: {
+                "fragment_size": int(SEARCH_FIELD_DISPLAY_SIZE),
+                "number_of_fragments": int(SEARCH_FIELD_DISPLAY_FRAGMENTS)
+            } for field in fields
+        }
+    }
+
+
+# Static parts of the suggest query, built once at import and shared by every query, so they must not be mutated.
+PROPERTYS_SEARCH_FIELDS = ["propertys.address", "propertys.landIdentifier", "propertys.lotInUnregisteredPlan"]
+PARTIES_SEARCH_FIELDS = ["parties.name", "parties.titlePartyFullName"]
+WORKSPACE_SEARCH_FIELDS = ["participant.reference", "workspace.number", "workspace.jurisdiction"]
+NESTED_INNER_HITS = {
+    "propertys": {
+        "_source": False,
+        "highlight": build_highlight(PROPERTYS_SEARCH_FIELDS)
+    },
+    "parties": {
+        "_source": False,
+        "highlight": build_highlight(PARTIES_SEARCH_FIELDS)
+    }
+}
+WORKSPACE_HIGHLIGHT = build_highlight(WORKSPACE_SEARCH_FIELDS)
+
+# Query branches per input shape, as (nested path or "workspace", fields), in the order of the full query.
+# References are free text, so every route keeps them.
+SUGGEST_ROUTES = {
+    "all": [("propertys", PROPERTYS_SEARCH_FIELDS), ("parties", PARTIES_SEARCH_FIELDS),
+            ("workspace", WORKSPACE_SEARCH_FIELDS)],
+    # Long numbers are workspace numbers.
+    "number": [("workspace", ["participant.reference", "workspace.number"])],
+    # Land identifiers, also unit numbers of addresses such as 12/5.
+    "land_identifier": [("propertys", PROPERTYS_SEARCH_FIELDS), ("workspace", ["participant.reference"])],
+    # Without digits nothing can match a workspace number.
+    "text": [("propertys", PROPERTYS_SEARCH_FIELDS), ("parties", PARTIES_SEARCH_FIELDS),
+             ("workspace", ["participant.reference", "workspace.jurisdiction"])]
+}
+LAND_IDENTIFIER_PATTERN = re.compile(r'\d+/\d*')
+TEXT_PATTERN = re.compile(r'[^\d/]+')
+# Exact term filters on the keyword subfields, cached by Elastic search across requests.
+WORKSPACE_STATUS_FILTER = {
+    "bool": {
+        "must_not": {"term": {"workspace.status.keyword": "ABANDONED"}}
+    }
+}
+PARTICIPANT_STATUS_FILTER = {"term": {"participant.status.keyword": "ACTIVE"}}
+
+# Score order with a unique tiebreak, a workspace document belongs to one participant, so search_after is stable.
+SEARCH_SORT = [
+    {"_score": "desc"},
+    {"workspace.id": "asc"},
+    {"participant.id": "asc"}
+]
+
+# Suggestion documents keep the display name in field, and sort by their position within the workspace after it.
+SUGGESTION_VALUE_FIELD = "value" + SUGGEST_FIELD_SUFFIX
+SUGGESTION_HIGHLIGHT = build_highlight(["value"])
+SUGGESTION_SORT = SEARCH_SORT + [{"position": "asc"}]
+SUGGESTION_ROUTE_FIELDS = {route: [MATCHED_FIELDS[field] for path, fields in branches for field in fields
+                                   if field in MATCHED_FIELDS]
+                           for route, branches in SUGGEST_ROUTES.items() if route != 'all'}
+
+# Highlight key and display name of the matched fields in each section of a hit, in MATCHED_FIELDS order.
+WORKSPACE_HIGHLIGHT_FIELDS = [(field + SUGGEST_FIELD_SUFFIX, display_value) for field, display_value
+                              in MATCHED_FIELDS.items() if field in WORKSPACE_SEARCH_FIELDS]
+NESTED_HIGHLIGHT_FIELDS = {
+    "propertys": [(field + SUGGEST_FIELD_SUFFIX, display_value) for field, display_value
+                  in MATCHED_FIELDS.items() if field in PROPERTYS_SEARCH_FIELDS],
+    "parties": [(field + SUGGEST_FIELD_SUFFIX, display_value) for field, display_value
+                in MATCHED_FIELDS.items() if field in PARTIES_SEARCH_FIELDS]
+}
+
+# Only the timing, the highlights, the suggestion field names, and the totals used to tell whether a result set is
+# complete, are sent back.
+SEARCH_FILTER_PATH = ','.join([
+    'took',
+    'timed_out',
+    'hits.total',
+    'hits.hits._source',
+    'hits.hits.highlight',
+    'hits.hits.sort',
+    'hits.hits.inner_hits.*.hits.total',
+    'hits.hits.inner_hits.*.hits.hits.highlight'
+])
+
+# The same filter applied to every response of an _msearch.
+MSEARCH_FILTER_PATH = ','.join(['responses.error'] + ['responses.' + path for path in SEARCH_FILTER_PATH.split(',')])
+
+# Queries are sent compact, through orjson when it is installed.
+try:
+    import orjson
+
+    def serialize_query(query):
+        return orjson.dumps(query)
+except ImportError:
+    QUERY_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+    def serialize_query(query):
+        return QUERY_ENCODER.encode(query)
+
+
+def cached_search(event_data):
+    key = cache_key(event_data)
+    if RESULT_CACHE is None:
+        return coalesce(key, lambda: json.dumps(run_search(event_data)[0]))
+
+    metrics = CURRENT_METRICS.get()
+    with metrics.stage('cache'):
+        entry = cached_entry(key)
+    metrics.properties['cache'] = 'miss' if entry is None else 'hit'
+    if entry is None:
+        entry = coalesce(key, lambda: store_entry(key, *run_search(event_data)))
+    return entry['body']
+
+
+def run_search(event_data):
+    with CURRENT_METRICS.get().stage('build'):
+        query = build_suggest_search_query(event_data)
+    try:
+        return search_results(query, search_url(event_data))
+    except IndexNotFoundError as err:
+        # The alias of a new subscriber may not be created yet.
+        LOGGER.warning('%s Subscriber alias %s not found, searching %s', LOG_PREFIX, err, ES_INDEX)
+        return search_results(without_alias(query, event_data['subscriber_id']), ES_URL)
+
+
+def embedded_engine():
+    return SUGGEST_ENGINE.lower() == 'embedded'
+
+
+def get_embedded_index():
+    global EMBEDDED_INDEX
+    if EMBEDDED_INDEX is None:
+        with EMBEDDED_INDEX_LOCK:
+            if EMBEDDED_INDEX is None:
+                try:
+                    from search_lambda.suggest.ngram_index import NgramIndex
+                except ImportError:
+                    # Inside the lambda archive the modules sit at the top level.
+                    from ngram_index import NgramIndex
+                try:
+                    EMBEDDED_INDEX = NgramIndex(SUGGEST_ENGINE_INDEX_PATH)
+                except (OSError, ValueError) as err:
+                    LOGGER.error('%s Unable to open the embedded index %s: %s', LOG_PREFIX,
+                                 SUGGEST_ENGINE_INDEX_PATH, err)
+                    raise InternalError('Error opening the embedded suggest index')
+    return EMBEDDED_INDEX
+
+
+def subscriber_aliases():
+    # Subscriber aliases are set up on the workspace index, the embedded engine and the suggestion index filter in the
+    # query instead.
+    return bool(SUGGEST_SUBSCRIBER_ALIAS) and not embedded_engine() and not flattened_mode()
+
+
+def search_index(event_data):
+    # The index or alias a query searches instead of ES_INDEX, None searches ES_INDEX.
+    if flattened_mode():
+        return SUGGEST_SUGGESTION_INDEX
+    if not subscriber_aliases():
+        return None
+    return SUGGEST_SUBSCRIBER_ALIAS.format(event_data['subscriber_id'])
+
+
+def search_url(event_data):
+    index = search_index(event_data)
+    if index is None:
+        return ES_URL
+    return ES_SCHEME + ES_HOST + "/" + index + "/_search"
+
+
+def coalesce(key, fn):
+    if not str2bool(SUGGEST_SINGLE_FLIGHT):
+        return fn()
+    return SINGLE_FLIGHT.do(key, fn)
+
+
+def batch_search(batch):
+    # Cached queries are answered from the cache, the rest run together in one _msearch.
+    responses = [None] * len(batch)
+    # Identical queries in a batch are searched once, keyed like the cache.
+    pending = OrderedDict()
+    for position, event_data in enumerate(batch):
+        if isinstance(event_data, ValidationError):
+            responses[position] = {'status': HTTPStatus.BAD_REQUEST.value, 'error': event_data.data}
+            continue
+        key = cache_key(event_data)
+        entry = cached_entry(key) if RESULT_CACHE is not None else None
+        if entry is not None:
+            responses[position] = {'results': entry['results'], 'cursor': entry['cursor']}
+        elif key in pending:
+            pending[key][1].append(position)
+        else:
+            pending[key] = (build_suggest_search_query(event_data), search_index(event_data), [position])
+    if not pending:
+        return responses
+
+    es_responses = msearch([query for query, index, positions in pending.values()],
+                           [index for query, index, positions in pending.values()])
+    # Subscribers whose alias is not created yet are searched again on ES_INDEX, key[1] is the subscriber id.
+    missing = [(n, without_alias(query, key[1])) for n, ((key, (query, index, positions)), resp_json)
+               in enumerate(zip(pending.items(), es_responses)) if index is not None and index_not_found(resp_json)]
+    if missing:
+        for (n, query), resp_json in zip(missing, msearch([query for n, query in missing])):
+            es_responses[n] = resp_json
+    for (key, (query, index, positions)), resp_json in zip(pending.items(), es_responses):
+        try:
+            workspace_results, complete = shape_results(query, resp_json)
+        except InternalError as err:
+            workspace_results = {'status': HTTPStatus.INTERNAL_SERVER_ERROR.value, 'error': err.data}
+        else:
+            if RESULT_CACHE is not None:
+                store_entry(key, workspace_results, complete)
+        for position in positions:
+            responses[position] = workspace_results
+    return responses
+
+
+def cached_entry(key):
+    entry = RESULT_CACHE.get(key)
+    if entry is None and str2bool(SUGGEST_CACHE_PREFIX_REUSE):
+        entry = RESULT_CACHE.get_prefix(key)
+        if entry is not None:
+            entry = filter_entry(entry, key[0])
+            RESULT_CACHE.put(key, entry)
+    return entry
+
+
+def store_entry(key, workspace_results, complete):
+    entry = {'body': json.dumps(workspace_results), 'results': workspace_results['results'],
+             'cursor': workspace_results['cursor'], 'complete': complete}
+    RESULT_CACHE.put(key, entry)
+    return entry
+
+
+def cache_key(event_data):
+    # The route decides which fields are searched, so it is part of the key like the query itself.
+    query_string = unquote_plus(event_data['q'].lower())
+    return (query_string, str(event_data['subscriber_id']), tuple(sorted(event_data['work_groups'])),
+            str(event_data['page_size']), str(event_data['from_record']), event_data.get('cursor'),
+            classify_query(query_string))
+
+
+def analyze(value):
+    # The lowercase, asciifolding and trim of the ngram_analyzer.
+    folded = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(char for char in folded if not unicodedata.combining(char)).strip()
+
+
+def ngrams(value):
+    text = analyze(value)
+    return {text[start:start + NGRAM_SIZE] for start in range(len(text) - NGRAM_SIZE + 1)}
+
+
+def filter_entry(entry, query):
+    # Keep the highlighted values of the shorter prefix that hold every gram of the longer query, as its match does.
+    query_grams = ngrams(query)
+    results = []
+    for result in entry['results']:
+        for display_value, fragments in result.items():
+            matched = [fragment for fragment in fragments
+                       if query_grams <= ngrams(fragment.replace('<em>', '').replace('</em>', ''))]
+            if matched:
+                results.append({display_value: matched})
+    return {'body': json.dumps({'results': results, 'cursor': entry['cursor']}), 'results': results,
+            'cursor': entry['cursor'], 'complete': entry['complete']}
+
+
+def search(query, url=None):
+    workspace_results, complete = search_results(query, url)
+    return json.dumps(workspace_results)
+
+
+def search_results(query, url=None):
+    # Returns the shaped results, and whether they hold every match of the query rather than one page of them.
+    metrics = CURRENT_METRICS.get()
+    if embedded_engine():
+        with metrics.stage('embedded'):
+            resp_json = get_embedded_index().search(query)
+        metrics.record_search(query, resp_json, 0)
+        with metrics.stage('shape'):
+            return shape_results(query, resp_json)
+    url = url or ES_URL
     headers = {"Content-Type": "application/json"}
     try:
-        LOGGER.info('%s DOING Elastic Search: %s', LOG_PREFIX, ES_URL)
-        resp = requests.get(ES_URL, headers=headers, data=json.dumps(
-            query), timeout=int(HTTP_TIMEOUT))
+        LOGGER.info('%s DOING Elastic Search: %s', LOG_PREFIX, url)
+        filter_path = SEARCH_FILTER_PATH
+        with metrics.stage('serialize'):
+            if metrics.sampled:
+                # The profile is only logged when the request turns out slow.
+                data = serialize_query(dict(query, profile=True))
+                filter_path += ',profile'
+            else:
+                data = serialize_query(query)
+        with metrics.stage('elasticsearch'):
+            resp = SESSION.get(url, params={'filter_path': filter_path}, headers=headers, data=data,
+                               timeout=(float(HTTP_CONNECT_TIMEOUT), float(HTTP_READ_TIMEOUT)))
+        if resp.status_code == HTTPStatus.NOT_FOUND and url != ES_URL:
+            raise IndexNotFoundError(url)
         if resp.status_code != HTTPStatus.OK:
             LOGGER.error('%s Elastic search error: %s', LOG_PREFIX, resp)
             raise InternalError('Error connecting to Elastic Search')
         LOGGER.info('%s DONE Elastic Search: %s', LOG_PREFIX, resp.status_code)
-        resp_json = json.loads(resp.text)
+        with metrics.stage('parse'):
+            resp_json = json.loads(resp.content)
         LOGGER.info('ES_RESPONSE: %s', resp_json)
+        metrics.record_search(query, resp_json, len(resp.content))
+        with metrics.stage('shape'):
+            return shape_results(query, resp_json)
+
+    except requests.exceptions.HTTPError as errh:
+        LOGGER.error('%s %s %s', LOG_PREFIX, 'ES HTTPError:', errh)
+        raise
 
-        # Get workspaces search results list and get the highlighted sections for each of them.
-        try:
-            workspaces = resp_json['hits']['hits']
-        except KeyError as err:
-            LOGGER.error('%s %s %s', LOG_PREFIX,
-                         'ES suggest query error:', err)
-            raise InternalError('Error running generated suggest search query')
 
-        workspace_results = {"results": []}
-        LOGGER.info('%s WORKSPACES: %s', LOG_PREFIX, workspaces)
-        for workspace in workspaces or []:
-            # Get non nested main sections.
-            try:
-                matched_main_sections = workspace['highlight']
-                for matched_field, display_value in MATCHED_FIELDS.items():
-                    if matched_field + '.keywordstring' in matched_main_sections:
-                        workspace_results['results'].append(
-                            {display_value: matched_main_sections[matched_field + '.keywordstring']})
-            except KeyError:
-                pass
-
-            # Get nested propertys sections.
-            try:
-                property_sections = workspace['inner_hits']['propertys']['hits']['hits']
-                for property_section in property_sections:
-                    matched_propertys_sections = property_section['highlight']
-                    for matched_field, display_value in MATCHED_FIELDS.items():
-                        if matched_field + '.keywordstring' in matched_propertys_sections:
-                            workspace_results['results'].append(
-                                {display_value: matched_propertys_sections[matched_field + '.keywordstring']})
-            except (KeyError, IndexError):
-                pass
-
-            # Get nested parties sections.
-            try:
-                parties_sections = workspace['inner_hits']['parties']['hits']['hits']
-                for parties_section in parties_sections:
-                    matched_partie_sections = parties_section['highlight']
-                    for matched_field, display_value in MATCHED_FIELDS.items():
-                        if matched_field + '.keywordstring' in matched_partie_sections:
-                            workspace_results['results'].append(
-                                {display_value: matched_partie_sections[matched_field + '.keywordstring']})
-            except (KeyError, IndexError):
-                pass
-        return json.dumps(workspace_results)
+def msearch(queries, indices=None):
+    # Returns one search response per query, in query order. A query with an index searches it instead of ES_INDEX.
+    if embedded_engine():
+        with CURRENT_METRICS.get().stage('embedded'):
+            return [get_embedded_index().search(query) for query in queries]
+    indices = indices or [None] * len(queries)
+    body = b''.join(as_bytes(json.dumps({'index': index} if index else {})) + b'\n' +
+                    as_bytes(serialize_query(query)) + b'\n' for query, index in zip(queries, indices))
+    headers = {"Content-Type": "application/x-ndjson"}
+    try:
+        LOGGER.info('%s DOING Elastic Multi Search: %s %s queries', LOG_PREFIX, ES_MSEARCH_URL, len(queries))
+        with CURRENT_METRICS.get().stage('elasticsearch'):
+            resp = SESSION.post(ES_MSEARCH_URL, params={'filter_path': MSEARCH_FILTER_PATH}, headers=headers,
+                                data=body, timeout=(float(HTTP_CONNECT_TIMEOUT), float(HTTP_READ_TIMEOUT)))
+        CURRENT_METRICS.get().add('response_bytes', len(resp.content))
+        if resp.status_code != HTTPStatus.OK:
+            LOGGER.error('%s Elastic search error: %s', LOG_PREFIX, resp)
+            raise InternalError('Error connecting to Elastic Search')
+        LOGGER.info('%s DONE Elastic Multi Search: %s', LOG_PREFIX, resp.status_code)
+        responses = json.loads(resp.content).get('responses', [])
+        if len(responses) != len(queries):
+            LOGGER.error('%s Elastic multi search returned %s responses for %s queries', LOG_PREFIX,
+                         len(responses), len(queries))
+            raise InternalError('Error running generated suggest search query')
+        return responses
 
     except requests.exceptions.HTTPError as errh:
         LOGGER.error('%s %s %s', LOG_PREFIX, 'ES HTTPError:', errh)
         raise
 
 
+def index_not_found(resp_json):
+    error = resp_json.get('error')
+    return isinstance(error, dict) and error.get('type') == 'index_not_found_exception'
+
+
+def as_bytes(data):
+    return data.encode('utf-8') if isinstance(data, str) else data
+
+
+def shape_results(query, resp_json):
+    # Get workspaces search results list and get the highlighted sections for each of them.
+    workspaces = response_hits(resp_json)
+    if flattened_mode():
+        return shape_suggestion_results(query, resp_json, workspaces)
+    workspace_results = {"results": [], "cursor": next_cursor(query, workspaces)}
+    LOGGER.info('%s WORKSPACES: %s', LOG_PREFIX, workspaces)
+    results = workspace_results['results']
+    for workspace in workspaces or []:
+        # Get non nested main sections, then the nested propertys and parties sections.
+        add_highlights(results, workspace.get('highlight'), WORKSPACE_HIGHLIGHT_FIELDS)
+        inner_hits = workspace.get('inner_hits', {})
+        for path, fields in NESTED_HIGHLIGHT_FIELDS.items():
+            for section in inner_hits.get(path, {}).get('hits', {}).get('hits', []):
+                add_highlights(results, section.get('highlight'), fields)
+    return workspace_results, is_complete(query, resp_json, workspaces)
+
+
+def response_hits(resp_json):
+    try:
+        # filter_path leaves the hits list out when nothing matched.
+        return resp_json['hits'].get('hits', [])
+    except KeyError as err:
+        LOGGER.error('%s %s %s %s', LOG_PREFIX, 'ES suggest query error:', err, resp_json.get('error'))
+        raise InternalError('Error running generated suggest search query')
+
+
+def shape_suggestion_results(query, resp_json, suggestions):
+    results = []
+    for suggestion in suggestions:
+        fragments = suggestion.get('highlight', {}).get(SUGGESTION_VALUE_FIELD)
+        display_value = suggestion.get('_source', {}).get('field')
+        if fragments and display_value:
+            results.append({display_value: fragments})
+    return {"results": results, "cursor": next_cursor(query, suggestions)}, is_complete(query, resp_json, suggestions)
+
+
+def add_highlights(results, highlight, fields):
+    if highlight:
+        for highlight_field, display_value in fields:
+            fragments = highlight.get(highlight_field)
+            if fragments is not None:
+                results.append({display_value: fragments})
+
+
+def next_cursor(query, workspaces):
+    # A full page may have more hits after it, the cursor holds the sort values of its last hit.
+    if not workspaces or len(workspaces) < int(query.get('size', SEARCH_PAGE_SIZE)):
+        return None
+    sort_values = workspaces[-1].get('sort')
+    if sort_values is None:
+        return None
+    return encode_cursor(sort_values)
+
+
+def encode_cursor(sort_values):
+    cursor = base64.urlsafe_b64encode(json.dumps(sort_values, separators=(',', ':')).encode('utf-8'))
+    return cursor.decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValidationError("Invalid cursor")
+    if not isinstance(sort_values, list) or len(sort_values) != len(search_sort()):
+        raise ValidationError("Invalid cursor")
+    return sort_values
+
+
+def is_complete(query, resp_json, workspaces):
+    if query.get('search_after') is not None or int(query.get('from', 0)) != 0:
+        return False
+    if hits_total(resp_json['hits']) > len(workspaces or []):
+        return False
+    for workspace in workspaces or []:
+        for inner_hits in workspace.get('inner_hits', {}).values():
+            if hits_total(inner_hits['hits']) > len(inner_hits['hits'].get('hits', [])):
+                return False
+    return True
+
+
+def hits_total(hits):
+    # Elastic search 7 reports the total as an object, 6 as a number.
+    total = hits.get('total', 0)
+    return total['value'] if isinstance(total, dict) else total
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
 def get_event_data(event):
     try:
         query_params = event['queryStringParameters']
@@ -326,9 +960,11 @@ def get_event_data(event):
         q = query_params['q']
     except (KeyError, Exception):
         raise ValidationError("Missing q query string")
-    if len(q) < int(SEARCH_MIN_LENGTH):
+    # Counted as the index analyzes it, a query shorter than one gram matches nothing.
+    min_length = max(int(SEARCH_MIN_LENGTH), NGRAM_SIZE)
+    if len(analyze(unquote_plus(q))) < min_length:
         raise ValidationError(
-            "Search query needs at least " + str(SEARCH_MIN_LENGTH) + " characters")
+            "Search query needs at least " + str(min_length) + " characters")
     try:
         page_size = query_params['size']
     except KeyError:
@@ -337,6 +973,20 @@ def get_event_data(event):
         from_record = query_params['from']
     except KeyError:
         from_record = int(SEARCH_FROM)
+    try:
+        cursor = query_params['cursor']
+        search_after = decode_cursor(cursor)
+    except KeyError:
+        cursor = None
+        search_after = None
+    if search_after is None:
+        try:
+            from_value = int(from_record)
+        except ValueError:
+            raise ValidationError("from needs to be a number")
+        if from_value > int(SEARCH_MAX_FROM):
+            raise ValidationError(
+                "from can be at most " + str(SEARCH_MAX_FROM) + ", use the cursor to page further")
     try:
         work_groups_str = query_params['workGroups']
         work_groups = work_groups_str.split(",")
@@ -346,16 +996,59 @@ def get_event_data(event):
         subscriber_id = query_params['subscriberId']
     except KeyError:
         raise ValidationError("Missing subscriberId query string")
+    if subscriber_aliases() and not str(subscriber_id).isdigit():
+        # The subscriber id becomes part of the alias name in the search url.
+        raise ValidationError("subscriberId needs to be a number")
 
     return {
         'q': q,
         'page_size': page_size,
         'from_record': from_record,
+        'cursor': cursor,
+        'search_after': search_after,
         'work_groups': work_groups,
         'subscriber_id': subscriber_id
     }
 
 
+def get_batch_event_data(event):
+    # Each query of a batch takes the same parameters as the query string of a single suggest request.
+    body = event['body']
+    try:
+        if event.get('isBase64Encoded'):
+            body = base64.b64decode(body)
+        queries = json.loads(body)['queries']
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise ValidationError("Missing queries list in request body")
+    if not isinstance(queries, list) or not queries:
+        raise ValidationError("Missing queries list in request body")
+    if len(queries) > int(SUGGEST_BATCH_MAX_QUERIES):
+        raise ValidationError(
+            "A batch can hold at most " + str(SUGGEST_BATCH_MAX_QUERIES) + " queries")
+    batch = []
+    for query_params in queries:
+        try:
+            if not isinstance(query_params, dict):
+                raise ValidationError("Each query needs to be an object")
+            query_params = {name: batch_param(name, value) for name, value in query_params.items()}
+            batch.append(get_event_data({'queryStringParameters': query_params}))
+        except ValidationError as err:
+            batch.append(err)
+    return batch
+
+
+def batch_param(name, value):
+    # JSON values become the query string value they stand for, e.g. "workGroups": [1086, 724] is "1086,724".
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    if name == 'workGroups' and isinstance(value, list) and value and \
+            all(isinstance(item, (str, int)) and not isinstance(item, bool) for item in value):
+        return ','.join(str(item) for item in value)
+    raise ValidationError(name + " needs to be a string or a number")
+
+
 def build_profile(subscriber_id, workgroups):
     return {
         'subscriber_id': subscriber_id,
@@ -385,3 +1078,11 @@ class InternalError(Exception):
 
     def __str__(self):
         return repr(self.data)
+
+
+class IndexNotFoundError(Exception):
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return repr(self.data)
@@ -0,0 +1,191 @@
+"""
+Standalone asyncio HTTP server for search suggest, for running behind a load balancer on containers.
+
+Serves GET /suggest with the same query string contract as the API Gateway event, and GET /health.
+Elastic search is queried through one aiohttp connection pool per worker process. Run it from the
+localstack directory:
+
+    python -m search_lambda.suggest.server --port 8080 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+from http import HTTPStatus
+
+import aiohttp
+from aiohttp import web
+
+from search_lambda.suggest import search_suggest
+
+LOGGER = logging.getLogger()
+
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = os.getenv('SERVER_PORT', '8080')
+SERVER_WORKERS = os.getenv('SERVER_WORKERS', str(os.cpu_count() or 1))
+# Connections each worker keeps open to Elastic search, shared by all its concurrent requests.
+SERVER_ES_POOL_MAXSIZE = os.getenv('SERVER_ES_POOL_MAXSIZE', '100')
+
+LOG_PREFIX = search_suggest.LOG_PREFIX
+
+SINGLE_FLIGHT = web.AppKey('single_flight')
+ES_SESSION = web.AppKey('es_session', aiohttp.ClientSession)
+
+
+class AsyncSingleFlight(object):
+    """
+    Runs one search per key at a time on the event loop, requests arriving while it runs await its result.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            # Shielded so one waiter going away does not cancel the search for the others.
+            return await asyncio.shield(future)
+        future = asyncio.ensure_future(fn())
+        self._calls[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                del self._calls[key]
+            else:
+                future.add_done_callback(lambda done: self._calls.pop(key, None))
+
+
+def create_app():
+    app = web.Application()
+    app[SINGLE_FLIGHT] = AsyncSingleFlight()
+    app.cleanup_ctx.append(es_session)
+    app.router.add_get('/suggest', handle_suggest)
+    app.router.add_get('/health', handle_health)
+    return app
+
+
+async def es_session(app):
+    connector = aiohttp.TCPConnector(limit=int(SERVER_ES_POOL_MAXSIZE))
+    timeout = aiohttp.ClientTimeout(sock_connect=float(search_suggest.HTTP_CONNECT_TIMEOUT),
+                                    sock_read=float(search_suggest.HTTP_READ_TIMEOUT))
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        app[ES_SESSION] = session
+        yield
+
+
+async def handle_health(request):
+    return to_web_response(search_suggest.create_response(HTTPStatus.OK.value, "UP"))
+
+
+async def handle_suggest(request):
+    # Same contract as the API Gateway event, repeated query string parameters keep their last value.
+    event = {'queryStringParameters': dict(request.query) or None}
+    return to_web_response(await suggest(request.app, event))
+
+
+async def suggest(app, event):
+    try:
+        if not event['queryStringParameters']:
+            return search_suggest.create_response(HTTPStatus.OK.value, "UP")
+        event_data = search_suggest.get_event_data(event)
+        LOGGER.info('%s %s %s', LOG_PREFIX, 'EVENT_DATA:', event_data)
+        results = await cached_search(app, event_data)
+        return search_suggest.create_response(HTTPStatus.OK.value, results)
+    except search_suggest.ValidationError as err:
+        return search_suggest.create_response(HTTPStatus.BAD_REQUEST.value, err.data)
+    except search_suggest.InternalError as err:
+        return search_suggest.create_response(HTTPStatus.INTERNAL_SERVER_ERROR.value, err.data)
+    except asyncio.TimeoutError as err:
+        LOGGER.error('%s %s %s', LOG_PREFIX, 'Timeout Error:', err)
+        return search_suggest.create_response(HTTPStatus.SERVICE_UNAVAILABLE.value, "Timeout Error with user API")
+    except aiohttp.ClientConnectionError as err:
+        LOGGER.error('%s %s %s', LOG_PREFIX, 'Error Connecting:', err)
+        return search_suggest.create_response(HTTPStatus.SERVICE_UNAVAILABLE.value, "Error Connecting to user API")
+    except aiohttp.ClientError as err:
+        LOGGER.error('%s %s %s', LOG_PREFIX, 'Requeset Error:', err)
+        return search_suggest.create_response(HTTPStatus.SERVICE_UNAVAILABLE.value, "Requeset Error with user API")
+
+
+async def cached_search(app, event_data):
+    # The result cache is shared with the lambda code path, coalescing happens on the event loop.
+    key = search_suggest.cache_key(event_data)
+    cache = search_suggest.RESULT_CACHE
+    if cache is not None:
+        entry = search_suggest.cached_entry(key)
+        if entry is not None:
+            return entry['body']
+
+    async def run():
+        workspace_results, complete = await search_results(app[ES_SESSION],
+                                                           search_suggest.build_suggest_search_query(event_data),
+                                                           search_suggest.search_url(event_data))
+        if cache is not None:
+            return search_suggest.store_entry(key, workspace_results, complete)['body']
+        return json.dumps(workspace_results)
+
+    if not search_suggest.str2bool(search_suggest.SUGGEST_SINGLE_FLIGHT):
+        return await run()
+    return await app[SINGLE_FLIGHT].do(key, run)
+
+
+async def search_results(session, query, url):
+    if search_suggest.embedded_engine():
+        # The embedded index answers in process, without a round trip to wait on.
+        return search_suggest.search_results(query, url)
+    headers = {"Content-Type": "application/json"}
+    LOGGER.info('%s DOING Elastic Search: %s', LOG_PREFIX, url)
+    async with session.get(url, params={'filter_path': search_suggest.SEARCH_FILTER_PATH},
+                           headers=headers, data=search_suggest.serialize_query(query)) as resp:
+        if resp.status != HTTPStatus.OK:
+            LOGGER.error('%s Elastic search error: %s', LOG_PREFIX, resp)
+            raise search_suggest.InternalError('Error connecting to Elastic Search')
+        resp_json = json.loads(await resp.read())
+    LOGGER.info('%s DONE Elastic Search: %s', LOG_PREFIX, resp.status)
+    return search_suggest.shape_results(query, resp_json)
+
+
+def to_web_response(response):
+    return web.Response(status=response['statusCode'], text=response['body'],
+                        headers=response['headers'])
+
+
+def run_worker(host, port):
+    # Every worker binds the port with SO_REUSEPORT, the kernel spreads connections across them.
+    web.run_app(create_app(), host=host, port=port, reuse_port=True, print=None)
+
+
+def serve(host, port, workers):
+    if workers <= 1:
+        run_worker(host, port)
+        return
+    processes = [multiprocessing.Process(target=run_worker, args=(host, port), daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        for worker in processes:
+            worker.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    LOGGER.warning('%s Serving on %s:%s with %s workers', LOG_PREFIX, host, port, workers)
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=int(SERVER_PORT))
+    parser.add_argument('--workers', type=int, default=int(SERVER_WORKERS))
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,88 @@
+import json
+import tempfile
+import unittest
+from unittest import mock
+from os import path
+from search_lambda.suggest import search_suggest
+from search_lambda.suggest import ngram_index
+
+basepath = path.dirname(__file__)
+SAMPLE_FILE = path.join(basepath, '..', '..', '..', 'es', 'workspaces-10000-10002.txt')
+
+
+def suggest_event(q, subscriber_id='4281', **params):
+    return {'queryStringParameters': dict({'q': q, 'workGroups': '1086', 'subscriberId': subscriber_id}, **params)}
+
+
+class TestNgramIndex(unittest.TestCase):
+    """
+    Embedded suggest engine tests
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_path = path.join(self.tmp_dir.name, 'workspace.ngram')
+        with open(SAMPLE_FILE, 'rb') as lines:
+            sample = lines.read().splitlines()
+        # The second workspace is abandoned, and a fourth one is indexed and then deleted.
+        second = json.loads(sample[3])
+        second['workspace']['status'] = 'ABANDONED'
+        sample[3] = json.dumps(second).encode('utf-8')
+        sample += [b'{"index":{"_id":"10003-1000003"}}', sample[1], b'{"delete":{"_id":"10003-1000003"}}']
+        ngram_index.build_index(sample, self.index_path)
+        self.patches = [
+            mock.patch.object(search_suggest, 'SUGGEST_ENGINE', 'embedded'),
+            mock.patch.object(search_suggest, 'SUGGEST_ENGINE_INDEX_PATH', self.index_path),
+            mock.patch.object(search_suggest, 'EMBEDDED_INDEX', None),
+            mock.patch.object(search_suggest, 'RESULT_CACHE', None),
+            mock.patch.object(search_suggest, 'SESSION')
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        if search_suggest.EMBEDDED_INDEX is not None:
+            search_suggest.EMBEDDED_INDEX.close()
+        for patch in self.patches:
+            patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_lambda_handler_answers_from_the_embedded_index(self):
+        res = search_suggest.lambda_handler(suggest_event('COLLINS'), None)
+        self.assertEqual(res['statusCode'], 200)
+        self.assertEqual(json.loads(res['body']),
+                         {'results': [{'address': ['<em>123 Collins St Melbourne VIC 3000</em>']}], 'cursor': None})
+
+        res = search_suggest.lambda_handler(suggest_event('collins', subscriber_id='1'), None)
+        self.assertEqual(json.loads(res['body']), {'results': [], 'cursor': None})
+        search_suggest.SESSION.get.assert_not_called()
+
+    def test_abandoned_workspaces_are_filtered_and_pages_follow_the_cursor(self):
+        res = search_suggest.lambda_handler(suggest_event('jay', size='1'), None)
+        first = json.loads(res['body'])
+        self.assertEqual(first['results'], [{'partyName': ['<em>Davina Jay</em>']}])
+
+        res = search_suggest.lambda_handler(suggest_event('jay', size='1', cursor=first['cursor']), None)
+        second = json.loads(res['body'])
+        # Cayden Jay is a title party name, which is searched but not returned.
+        self.assertEqual(second['results'], [])
+        self.assertIsNotNone(second['cursor'])
+        res = search_suggest.lambda_handler(suggest_event('jay', size='1', cursor=second['cursor']), None)
+        self.assertEqual(json.loads(res['body']), {'results': [], 'cursor': None})
+
+        res = search_suggest.lambda_handler(suggest_event('bourke'), None)
+        self.assertEqual(json.loads(res['body']), {'results': [], 'cursor': None})
+
+    def test_match_needs_every_gram_of_the_query_in_one_value(self):
+        index = ngram_index.NgramIndex(self.index_path)
+        query = {'query': {'match': {'propertys.address.ngram': {'query': 'FLINDERS ST melb', 'operator': 'and'}}}}
+        self.assertEqual(index.search(query)['hits']['total'], 1)
+        query['query']['match']['propertys.address.ngram']['query'] = 'flindérs collins'
+        self.assertEqual(index.search(query)['hits']['total'], 0)
+        query['query']['match']['propertys.address.ngram']['operator'] = 'or'
+        self.assertEqual(index.search(query)['hits']['total'], 2)
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
+import io
 import unittest
 import json
+import threading
+from unittest import mock
+import requests
 from jsondiff import diff
+from search_lambda.suggest import search_suggest
 from search_lambda.suggest.search_suggest import lambda_handler
 from search_lambda.suggest.search_suggest import build_suggest_search_query
 from os import path
@@ -59,6 +64,15 @@ class TestSearchSuggest(unittest.TestCase):
         self.assertEqual(res['statusCode'], 400)
         self.assertEqual(res['body'], 'Search query needs at least 3 characters')
 
+        # Trailing spaces are trimmed by the analyzer, so they don't count towards the length.
+        for q in ('ab ', 'ab+', ' ab', 'é%20'):
+            event['queryStringParameters']['q'] = q
+            res = lambda_handler(event, None)
+            self.assertEqual(res['statusCode'], 400, q)
+        with mock.patch.object(search_suggest, 'SEARCH_MIN_LENGTH', '1'):
+            res = lambda_handler(event, None)
+        self.assertEqual(res['body'], 'Search query needs at least 3 characters')
+
     def test_suggests_query(self):
         filepath = path.abspath(path.join(basepath, "data", "complete_suggestions_query.json"))
         # Given
@@ -73,7 +87,8 @@ class TestSearchSuggest(unittest.TestCase):
             }
 
             # When
-            actual = build_suggest_search_query(event_data)
+            with mock.patch.object(search_suggest, 'SUGGEST_ROUTING', 'False'):
+                actual = build_suggest_search_query(event_data)
             # print('QUERY:', json.dumps(actual, indent=2))
 
             # Then
@@ -81,6 +96,358 @@ class TestSearchSuggest(unittest.TestCase):
             if not difference == {}:
                 self.fail('Invalid generated search suggestions query: {0}'.format(difference))
 
+    def test_search_reuses_pooled_session_with_split_timeouts(self):
+        with mock.patch.object(search_suggest.SESSION, 'get') as get:
+            get.return_value.status_code = 200
+            get.return_value.content = b'{"hits": {"total": 0}}'
+            search_suggest.search({'size': 10})
+            search_suggest.search({'size': 10})
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(get.call_args[1]['timeout'], (3.0, 15.0))
+        self.assertEqual(get.call_args[1]['params'], {'filter_path': search_suggest.SEARCH_FILTER_PATH})
+
+    def test_flattened_mode_searches_the_suggestion_index_without_nested_queries(self):
+        event = {'queryStringParameters': {'q': 'collins', 'size': '2', 'workGroups': '1086',
+                                           'subscriberId': '4281'}}
+        es_response = {'took': 2, 'hits': {'total': 3, 'hits': [
+            {'_source': {'field': 'address'}, 'sort': [0.0, 10000, 1000000, 4],
+             'highlight': {'value.ngram': ['<em>123 Collins St Melbourne VIC 3000</em>']}},
+            {'_source': {'field': 'partyName'}, 'sort': [0.0, 10001, 1000001, 5],
+             'highlight': {'value.ngram': ['<em>Collins Bank</em>']}}]}}
+        with mock.patch.object(search_suggest, 'SUGGEST_INDEX_MODE', 'flattened'), \
+                mock.patch.object(search_suggest, 'RESULT_CACHE', None), \
+                mock.patch.object(search_suggest.SESSION, 'get') as get:
+            get.return_value.status_code = 200
+            get.return_value.content = json.dumps(es_response).encode('utf-8')
+            res = lambda_handler(event, None)
+            body = json.loads(res['body'])
+            self.assertEqual(body['results'], [{'address': ['<em>123 Collins St Melbourne VIC 3000</em>']},
+                                               {'partyName': ['<em>Collins Bank</em>']}])
+            self.assertEqual(search_suggest.decode_cursor(body['cursor']), [0.0, 10001, 1000001, 5])
+
+        self.assertTrue(get.call_args[0][0].endswith('/workspace_suggestions/_search'))
+        query = json.loads(get.call_args[1]['data'])
+        self.assertNotIn('nested', json.dumps(query))
+        self.assertEqual(query['sort'], search_suggest.SUGGESTION_SORT)
+        # Text routes leave out the workspace numbers.
+        self.assertIn({'terms': {'field': ['address', 'landIdentifier', 'lotInUnregisteredPlan', 'partyName',
+                                           'subscriberRef', 'jurisdiction']}}, query['query']['bool']['filter'])
+        self.assertIn({'term': {'participant.subscriberId': '4281'}}, query['query']['bool']['filter'])
+
+    def test_connection_errors_map_to_service_unavailable(self):
+        event = {
+            "queryStringParameters": {
+                "q": "collins",
+                "workGroups": "724,1299",
+                "subscriberId": "55555"
+            }
+        }
+        for error in (requests.exceptions.ConnectionError('refused'), requests.exceptions.Timeout('slow')):
+            with mock.patch.object(search_suggest.SESSION, 'get', side_effect=error):
+                res = lambda_handler(event, None)
+            self.assertEqual(res['statusCode'], 503)
+
+    def test_cached_search_reuses_results_for_same_query_and_profile(self):
+        cache = search_suggest.SuggestCache(10, 30, 0)
+        event_data = {'q': 'Mel', 'page_size': 10, 'from_record': 0, 'work_groups': ['2', '1'], 'subscriber_id': '5'}
+        same_profile = dict(event_data, q='mel', work_groups=['1', '2'])
+        with mock.patch.object(search_suggest, 'RESULT_CACHE', cache), \
+                mock.patch.object(search_suggest, 'search_results') as search_results:
+            results = [{'address': ['<em>123 Collins St</em>']}]
+            search_results.return_value = ({'results': results, 'cursor': None}, True)
+            first = search_suggest.cached_search(event_data)
+            second = search_suggest.cached_search(same_profile)
+            search_suggest.cached_search(dict(event_data, subscriber_id='6'))
+        self.assertEqual(first, second)
+        self.assertEqual(search_results.call_count, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_cache_expires_and_evicts_entries(self):
+        cache = search_suggest.SuggestCache(2, 30, 0)
+        cache.put(('a',), {'body': 'a'})
+        cache.put(('b',), {'body': 'b'})
+        cache.get(('a',))
+        cache.put(('c',), {'body': 'c'})
+        self.assertIsNone(cache.get(('b',)))
+        self.assertEqual(cache.get(('a',)), {'body': 'a'})
+        self.assertEqual(cache.evictions, 1)
+        with mock.patch.object(search_suggest.time, 'monotonic', return_value=search_suggest.time.monotonic() + 31):
+            self.assertIsNone(cache.get(('a',)))
+
+    def test_cached_search_filters_complete_prefix_results(self):
+        cache = search_suggest.SuggestCache(10, 30, 0)
+        event_data = {'q': 'coll', 'page_size': 10, 'from_record': 0, 'work_groups': ['1'], 'subscriber_id': '5'}
+        results = [{'address': ['<em>123 Collins St Melbourne</em>']}, {'partyName': ['<em>Colleen Jay</em>']},
+                   {'partyName': ['<em>Colléen Jay</em>']}]
+        with mock.patch.object(search_suggest, 'RESULT_CACHE', cache), \
+                mock.patch.object(search_suggest, 'SUGGEST_CACHE_PREFIX_REUSE', 'True'), \
+                mock.patch.object(search_suggest, 'search_results') as search_results:
+            search_results.return_value = ({'results': results, 'cursor': None}, True)
+            search_suggest.cached_search(event_data)
+            narrowed = search_suggest.cached_search(dict(event_data, q='colli'))
+            folded = search_suggest.cached_search(dict(event_data, q='colle'))
+            search_results.return_value = ({'results': results, 'cursor': None}, False)
+            search_suggest.cached_search(dict(event_data, q='mel'))
+            search_suggest.cached_search(dict(event_data, q='melb'))
+        self.assertEqual(json.loads(narrowed),
+                         {'results': [{'address': ['<em>123 Collins St Melbourne</em>']}], 'cursor': None})
+        # The index folds accents, so the longer query matches the accented value as its grams do.
+        self.assertEqual(json.loads(folded)['results'],
+                         [{'partyName': ['<em>Colleen Jay</em>']}, {'partyName': ['<em>Colléen Jay</em>']}])
+        self.assertEqual(search_results.call_count, 3)
+        self.assertEqual(cache.prefix_hits, 2)
+
+    def test_cache_key_holds_the_route(self):
+        event_data = {'q': '190010001', 'page_size': 10, 'from_record': 0, 'work_groups': ['1'], 'subscriber_id': '5'}
+        self.assertEqual(search_suggest.cache_key(event_data)[-1], 'number')
+        with mock.patch.object(search_suggest, 'SUGGEST_ROUTING', 'False'):
+            self.assertEqual(search_suggest.cache_key(event_data)[-1], 'all')
+        self.assertIsNone(search_suggest.RESULT_CACHE)
+
+    def test_is_complete_checks_paging_and_totals(self):
+        hits = {'total': 1, 'hits': [{'inner_hits': {'parties': {'hits': {'total': 2, 'hits': [{}, {}]}}}}]}
+        self.assertTrue(search_suggest.is_complete({'from': 0}, {'hits': hits}, hits['hits']))
+        self.assertFalse(search_suggest.is_complete({'from': 10}, {'hits': hits}, hits['hits']))
+        self.assertFalse(search_suggest.is_complete({'from': 0}, {'hits': dict(hits, total=5)}, hits['hits']))
+
+    def test_search_shapes_filtered_highlights(self):
+        es_response = {'hits': {'total': 2, 'hits': [
+            {'highlight': {'workspace.number.ngram': ['<em>190010000</em>']},
+             'inner_hits': {
+                 'parties': {'hits': {'total': 1, 'hits': [
+                     {'highlight': {'parties.name.ngram': ['<em>Davina Jay</em>']}}]}},
+                 'propertys': {'hits': {'total': 1, 'hits': [
+                     {'highlight': {'propertys.address.ngram': ['<em>123 Collins St Melbourne VIC 3000</em>'],
+                                    'propertys.landIdentifier.ngram': ['<em>11111/111</em>']}}]}}}},
+            {'inner_hits': {'propertys': {'hits': {'total': 0}}}}]}}
+        with mock.patch.object(search_suggest.SESSION, 'get') as get:
+            get.return_value.status_code = 200
+            get.return_value.content = json.dumps(es_response).encode('utf-8')
+            results, complete = search_suggest.search_results({'from': 0})
+        self.assertEqual(results, {'cursor': None, 'results': [
+            {'workspaceNumber': ['<em>190010000</em>']},
+            {'landIdentifier': ['<em>11111/111</em>']},
+            {'address': ['<em>123 Collins St Melbourne VIC 3000</em>']},
+            {'partyName': ['<em>Davina Jay</em>']}]})
+        self.assertTrue(complete)
+
+    def test_deep_from_is_rejected_and_cursor_pages_with_search_after(self):
+        params = {"q": "VIC", "workGroups": "1", "subscriberId": "5"}
+        response = lambda_handler({"queryStringParameters": dict(params, **{"from": "500"})}, None)
+        self.assertEqual(response['statusCode'], 400)
+
+        cursor = search_suggest.encode_cursor([1.5, 190010000, 42])
+        event_data = search_suggest.get_event_data({"queryStringParameters": dict(params, cursor=cursor)})
+        query = build_suggest_search_query(event_data)
+        self.assertEqual(query['search_after'], [1.5, 190010000, 42])
+        self.assertEqual(query['from'], 0)
+        self.assertFalse(search_suggest.is_complete(query, {'hits': {'total': 0}}, []))
+
+        response = lambda_handler({"queryStringParameters": dict(params, cursor='not-a-cursor')}, None)
+        self.assertEqual(response['statusCode'], 400)
+
+    def test_full_page_returns_cursor_of_last_hit(self):
+        workspaces = [{'sort': [2.0, 1, 1]}, {'sort': [1.0, 2, 7]}]
+        cursor = search_suggest.next_cursor({'size': 2}, workspaces)
+        self.assertEqual(search_suggest.decode_cursor(cursor), [1.0, 2, 7])
+        self.assertIsNone(search_suggest.next_cursor({'size': 10}, workspaces))
+
+    def test_batch_runs_valid_queries_in_one_msearch(self):
+        body = json.dumps({'queries': [
+            {'q': 'collins', 'workGroups': '1', 'subscriberId': 5},
+            {'q': 'co', 'workGroups': '1', 'subscriberId': 5},
+            {'q': 'jay', 'workGroups': '1', 'subscriberId': 5}]})
+        es_response = {'responses': [
+            {'hits': {'total': 1, 'hits': [
+                {'highlight': {'workspace.number.ngram': ['<em>190010000</em>']}}]}},
+            {'error': {'type': 'search_phase_execution_exception'}}]}
+        with mock.patch.object(search_suggest, 'RESULT_CACHE', None), \
+                mock.patch.object(search_suggest.SESSION, 'post') as post:
+            post.return_value.status_code = 200
+            post.return_value.content = json.dumps(es_response).encode('utf-8')
+            response = lambda_handler({'queryStringParameters': None, 'body': body}, None)
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(post.call_args[0][0], search_suggest.ES_MSEARCH_URL)
+        self.assertEqual(len(post.call_args[1]['data'].splitlines()), 4)
+        responses = json.loads(response['body'])['responses']
+        self.assertEqual(responses[0], {'results': [{'workspaceNumber': ['<em>190010000</em>']}], 'cursor': None})
+        self.assertEqual(responses[1]['status'], 400)
+        self.assertEqual(responses[2]['status'], 500)
+
+        too_many = json.dumps({'queries': [{'q': 'collins'}] * 11})
+        response = lambda_handler({'queryStringParameters': None, 'body': too_many}, None)
+        self.assertEqual(response['statusCode'], 400)
+
+        batch = search_suggest.get_batch_event_data({'body': json.dumps({'queries': [
+            {'q': 'collins', 'workGroups': [1086, '724'], 'subscriberId': 4281, 'size': 5},
+            {'q': 'collins', 'workGroups': [], 'subscriberId': 4281},
+            {'q': 'collins', 'workGroups': '1086', 'subscriberId': [4281]},
+            {'q': 'collins', 'workGroups': {'id': 1086}, 'subscriberId': 4281}]})})
+        self.assertEqual((batch[0]['work_groups'], batch[0]['subscriber_id'], batch[0]['page_size']),
+                         (['1086', '724'], '4281', '5'))
+        self.assertEqual([err.data for err in batch[1:]], ['workGroups needs to be a string or a number',
+                                                           'subscriberId needs to be a string or a number',
+                                                           'workGroups needs to be a string or a number'])
+
+        for body in ('not base64!', 'e30='):
+            response = lambda_handler({'queryStringParameters': None, 'body': body, 'isBase64Encoded': True}, None)
+            self.assertEqual(response['statusCode'], 400)
+
+    def test_concurrent_identical_queries_share_one_search(self):
+        event_data = {'q': 'Collins', 'page_size': 10, 'from_record': 0, 'work_groups': ['1'], 'subscriber_id': '5'}
+        started = threading.Event()
+        release = threading.Event()
+        bodies = []
+
+        def slow_search(query, url=None):
+            started.set()
+            release.wait(5)
+            return {'results': [{'address': ['<em>123 Collins St</em>']}], 'cursor': None}, True
+
+        def suggest():
+            bodies.append(search_suggest.cached_search(event_data))
+
+        flight = search_suggest.SingleFlight()
+        with mock.patch.object(search_suggest, 'RESULT_CACHE', search_suggest.SuggestCache(10, 30, 0)), \
+                mock.patch.object(search_suggest, 'SINGLE_FLIGHT', flight), \
+                mock.patch.object(search_suggest, 'search_results', side_effect=slow_search) as search_results:
+            leader = threading.Thread(target=suggest)
+            leader.start()
+            started.wait(5)
+            followers = [threading.Thread(target=suggest) for _ in range(3)]
+            for follower in followers:
+                follower.start()
+            for _ in range(500):
+                if flight.coalesced == 3:
+                    break
+                release.wait(0.01)
+            release.set()
+            for thread in [leader] + followers:
+                thread.join(5)
+        self.assertEqual(search_results.call_count, 1)
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertEqual(len(bodies), 4)
+
+    def test_single_flight_shares_errors_and_forgets_finished_calls(self):
+        flight = search_suggest.SingleFlight()
+        with self.assertRaises(search_suggest.InternalError):
+            flight.do('k', mock.Mock(side_effect=search_suggest.InternalError('down')))
+        self.assertEqual(flight.do('k', lambda: 'up'), 'up')
+
+    def test_classifier_routes_query_branches_by_input_shape(self):
+        self.assertEqual(search_suggest.classify_query('190010001'), 'number')
+        self.assertEqual(search_suggest.classify_query('3000'), 'all')
+        self.assertEqual(search_suggest.classify_query('11111/111'), 'land_identifier')
+        self.assertEqual(search_suggest.classify_query('davina jay'), 'text')
+        self.assertEqual(search_suggest.classify_query('123 collins'), 'all')
+
+        event_data = {'q': '190010001', 'page_size': 10, 'from_record': 0, 'work_groups': ['1'], 'subscriber_id': '5'}
+        branches = build_suggest_search_query(event_data)['query']['bool']['filter'][0]['bool']['should']
+        self.assertEqual(branches, [{'bool': {'should': [
+            {'match': {'participant.reference.ngram': {'query': '190010001', 'operator': 'and'}}},
+            {'match': {'workspace.number.ngram': {'query': '190010001', 'operator': 'and'}}}]}}])
+        branches = build_suggest_search_query(dict(event_data, q='11111/111'))['query']['bool']['filter'][0]
+        self.assertEqual([branch['nested']['path'] for branch in branches['bool']['should'] if 'nested' in branch],
+                         ['propertys'])
+
+    def test_subscriber_alias_mode_searches_the_filtered_alias(self):
+        params = {'q': 'collins', 'workGroups': '1,2', 'subscriberId': '4281'}
+        with mock.patch.object(search_suggest, 'SUGGEST_SUBSCRIBER_ALIAS', 'workspace_subscriber_{}'), \
+                mock.patch.object(search_suggest, 'RESULT_CACHE', None), \
+                mock.patch.object(search_suggest.SESSION, 'get') as get, \
+                mock.patch.object(search_suggest.SESSION, 'post') as post:
+            event_data = search_suggest.get_event_data({'queryStringParameters': params})
+            filters = build_suggest_search_query(event_data)['query']['bool']['filter']
+            get.return_value.status_code = 200
+            get.return_value.content = b'{"hits": {"total": 0}}'
+            search_suggest.cached_search(event_data)
+            post.return_value.status_code = 200
+            post.return_value.content = b'{"responses": [{"hits": {"total": 0}}]}'
+            search_suggest.batch_search([event_data])
+            with self.assertRaises(search_suggest.ValidationError):
+                search_suggest.get_event_data({'queryStringParameters': dict(params, subscriberId='1/../x')})
+        self.assertEqual(filters[1:], [{'terms': {'workspace.workgroups': ['1', '2']}}])
+        self.assertTrue(get.call_args[0][0].endswith('/workspace_subscriber_4281/_search'))
+        self.assertEqual(json.loads(post.call_args[1]['data'].splitlines()[0]), {'index': 'workspace_subscriber_4281'})
+
+    def test_subscriber_without_an_alias_is_searched_with_inline_filters(self):
+        params = {'q': 'collins', 'workGroups': '1', 'subscriberId': '4281'}
+        not_found = {'error': {'type': 'index_not_found_exception'}, 'status': 404}
+        hits = {'hits': {'total': 1, 'hits': [{'highlight': {'workspace.number.ngram': ['<em>190010000</em>']}}]}}
+        with mock.patch.object(search_suggest, 'SUGGEST_SUBSCRIBER_ALIAS', 'workspace_subscriber_{}'), \
+                mock.patch.object(search_suggest, 'RESULT_CACHE', None), \
+                mock.patch.object(search_suggest.SESSION, 'get') as get, \
+                mock.patch.object(search_suggest.SESSION, 'post') as post:
+            missing, found = mock.Mock(status_code=404, content=json.dumps(not_found).encode('utf-8')), \
+                mock.Mock(status_code=200, content=json.dumps(hits).encode('utf-8'))
+            get.side_effect = [missing, found]
+            res = lambda_handler({'queryStringParameters': params}, None)
+            post.side_effect = [mock.Mock(status_code=200, content=json.dumps({'responses': [not_found]})),
+                                mock.Mock(status_code=200, content=json.dumps({'responses': [hits]}))]
+            batch = search_suggest.batch_search([search_suggest.get_event_data({'queryStringParameters': params})])
+            # The shared query parts are left as they were.
+            shared = build_suggest_search_query(search_suggest.get_event_data({'queryStringParameters': params}))
+        expected = {'results': [{'workspaceNumber': ['<em>190010000</em>']}], 'cursor': None}
+        self.assertEqual((res['statusCode'], json.loads(res['body'])), (200, expected))
+        self.assertEqual(batch, [expected])
+        self.assertEqual(get.call_args[0][0], search_suggest.ES_URL)
+        filters = json.loads(get.call_args[1]['data'])['query']['bool']['filter']
+        self.assertIn({'term': {'participant.subscriberId': '4281'}}, filters)
+        self.assertEqual(json.loads(post.call_args[1]['data'].splitlines()[0]), {})
+        self.assertIn({'term': {'participant.subscriberId': '4281'}},
+                      json.loads(post.call_args[1]['data'].splitlines()[1])['query']['bool']['filter'])
+        self.assertEqual(len(shared['query']['bool']['filter']), 2)
+
+    def test_metrics_are_written_as_emf_with_a_sampled_slow_query_log(self):
+        event = {'queryStringParameters': {'q': 'collins', 'workGroups': '1', 'subscriberId': '5'}}
+        with mock.patch.object(search_suggest, 'METRICS_ENABLED', 'True'), \
+                mock.patch.object(search_suggest, 'SLOW_QUERY_MS', '0.001'), \
+                mock.patch.object(search_suggest, 'SLOW_QUERY_SAMPLE_RATE', '1'), \
+                mock.patch.object(search_suggest, 'RESULT_CACHE', None), \
+                mock.patch.object(search_suggest.SESSION, 'get') as get, \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+                self.assertLogs(search_suggest.LOGGER, 'WARNING') as logs:
+            get.return_value.status_code = 200
+            get.return_value.content = b'{"took": 7, "timed_out": false, "hits": {"total": 0}, ' \
+                                       b'"profile": {"shards": [{"id": "[n1][workspace][0]"}]}}'
+            response = lambda_handler(event, None)
+        self.assertEqual(response['statusCode'], 200)
+        line = json.loads(stdout.getvalue())
+        metric_names = [metric['Name'] for metric in line['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        for name in ('validate_ms', 'build_ms', 'serialize_ms', 'elasticsearch_ms', 'parse_ms', 'shape_ms',
+                     'total_ms', 'response_bytes', 'hits'):
+            self.assertIn(name, metric_names)
+        self.assertEqual((line['Function'], line['es_took_ms'], line['route']), ('search_suggest', 7, 'text'))
+        # The sampled query is sent once with a profile, which is logged with its timings as it turned out slow.
+        self.assertEqual(get.call_count, 1)
+        self.assertTrue(json.loads(get.call_args[1]['data'])['profile'])
+        self.assertTrue(get.call_args[1]['params']['filter_path'].endswith(',profile'))
+        slow = [message for message in logs.output if 'Slow query' in message]
+        self.assertEqual(len(slow), 1)
+        self.assertIn('"elasticsearch_ms"', slow[0])
+        self.assertIn('"query": "collins"', slow[0])
+        self.assertIn('[n1][workspace][0]', slow[0])
+
+        with mock.patch.object(search_suggest, 'METRICS_ENABLED', 'True'), \
+                mock.patch.object(search_suggest, 'SLOW_QUERY_MS', '0.001'), \
+                mock.patch.object(search_suggest, 'SLOW_QUERY_SAMPLE_RATE', '0'), \
+                mock.patch.object(search_suggest, 'RESULT_CACHE', None), \
+                mock.patch.object(search_suggest.SESSION, 'get') as get, \
+                mock.patch('sys.stdout', new_callable=io.StringIO):
+            get.return_value.status_code = 200
+            get.return_value.content = b'{"took": 7, "timed_out": false, "hits": {"total": 0}}'
+            lambda_handler(event, None)
+        self.assertNotIn('profile', json.loads(get.call_args[1]['data']))
+        self.assertEqual(get.call_args[1]['params']['filter_path'], search_suggest.SEARCH_FILTER_PATH)
+
+        with mock.patch.object(search_suggest, 'emf_line') as emf_line:
+            lambda_handler({'queryStringParameters': None}, None)
+        emf_line.assert_not_called()
+        self.assertIs(search_suggest.CURRENT_METRICS.get(), search_suggest.NULL_METRICS)
+        search_suggest.NULL_METRICS.properties['route'] = 'text'
+        self.assertEqual(search_suggest.NULL_METRICS.properties, {})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+try:
+    import aiohttp
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+    from search_lambda.suggest import server
+except ImportError:
+    aiohttp = None
+from search_lambda.suggest import search_suggest
+
+ES_RESPONSE = {'hits': {'total': 1, 'hits': [{'highlight': {'workspace.number.ngram': ['<em>190010000</em>']}}]}}
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestSuggestServer(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.es_requests = []
+        es_app = web.Application()
+        es_app.router.add_get('/workspace/_search', self.es_search)
+        self.es_server = TestServer(es_app)
+        await self.es_server.start_server()
+        self.patches = [
+            mock.patch.object(search_suggest, 'ES_URL', str(self.es_server.make_url('/workspace/_search'))),
+            mock.patch.object(search_suggest, 'RESULT_CACHE', None)
+        ]
+        for patch in self.patches:
+            patch.start()
+        self.client = TestClient(TestServer(server.create_app()))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.es_server.close()
+        for patch in self.patches:
+            patch.stop()
+
+    async def es_search(self, request):
+        self.es_requests.append((dict(request.query), await request.json()))
+        await asyncio.sleep(0.05)
+        return web.json_response(ES_RESPONSE)
+
+    async def test_suggest_uses_query_string_contract(self):
+        resp = await self.client.get('/suggest', params={'q': 'mel', 'size': '10', 'from': '0',
+                                                         'workGroups': '55555', 'subscriberId': '55555'})
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(await resp.text()),
+                         {'results': [{'workspaceNumber': ['<em>190010000</em>']}], 'cursor': None})
+        params, query = self.es_requests[0]
+        self.assertEqual(params['filter_path'], search_suggest.SEARCH_FILTER_PATH)
+        self.assertEqual(query['size'], '10')
+
+        resp = await self.client.get('/suggest', params={'q': 'mel', 'workGroups': '55555'})
+        self.assertEqual(resp.status, 400)
+        self.assertEqual(await resp.text(), 'Missing subscriberId query string')
+        resp = await self.client.get('/health')
+        self.assertEqual(await resp.text(), 'UP')
+
+    async def test_concurrent_identical_requests_share_one_search(self):
+        params = {'q': 'collins', 'workGroups': '1', 'subscriberId': '5'}
+        responses = await asyncio.gather(*[self.client.get('/suggest', params=params) for _ in range(5)])
+        self.assertEqual([resp.status for resp in responses], [200] * 5)
+        self.assertEqual(len(self.es_requests), 1)
+        self.assertEqual(self.client.server.app[server.SINGLE_FLIGHT].coalesced, 4)
+
+    async def test_es_connection_errors_map_to_service_unavailable(self):
+        await self.es_server.close()
+        resp = await self.client.get('/suggest', params={'q': 'collins', 'workGroups': '1', 'subscriberId': '5'})
+        self.assertEqual(resp.status, 503)
+
+
+if __name__ == '__main__':
+    unittest.main()